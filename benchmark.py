@@ -0,0 +1,334 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+# Renders synthetic scenes for a fixed number of frames each, with the camera
+# circling the scene, and writes the frame times as JSON.  Run it headless, or
+# with vsync disabled, so that frames aren't limited to the display's rate.
+#
+#   python benchmark.py [--scenes NAME,...] [--suite FILE] [--frames N]
+#                       [--warmup N] [--set OPTION=VALUE ...] [--output FILE]
+
+from argparse import ArgumentParser
+from json import dump as dump_json, load as load_json, loads as load_json_value
+from math import pi, sin, cos, atan2, sqrt, ceil
+from random import Random
+from timeit import default_timer
+from numpy import array, percentile
+
+import os
+import sys
+
+os.environ['PATH'] += os.getcwd()+'\\assimp;'
+
+# the src package is imported before OpenGL, as it chooses the platform of a
+# headless context
+from src.cameras import Camera
+from src.entities import Entity, Character, UiEntity, UiMeas
+from src.demo_models import Cube, Sphere, Spider, Duck
+from src.models import UiModel
+from src.game import GameInstance as game
+
+from OpenGL.GL import glFinish, glGetString, GL_VENDOR, GL_RENDERER, GL_VERSION
+
+
+
+# The parameters of a scene, and their defaults:
+#   entities        the number of entities, laid out on a square grid
+#   models          the models the entities cycle through
+#   moving          the fraction of the entities which are characters, moving
+#                   every frame, the rest don't move
+#   static          whether the entities that don't move are added as static
+#   pointLights     the number of point lights, scattered over the grid
+#   shadowedLights  the number of directional lights, each casting shadows
+#   uiEntities      the number of UI entities drawn over the scene
+DefaultScene = {'entities':       1000,
+                'models':         ['cube'],
+                'moving':         0.,
+                'static':         True,
+                'pointLights':    0,
+                'shadowedLights': 1,
+                'uiEntities':     0}
+
+DefaultSuite = [{'name': 'cubes-1k',    'entities': 1000},
+                {'name': 'cubes-10k',   'entities': 10000},
+                {'name': 'cubes-100k',  'entities': 100000},
+                {'name': 'mixed-10k',   'entities': 10000, 'models': ['cube', 'sphere', 'spider', 'duck']},
+                {'name': 'moving-10k',  'entities': 10000, 'moving': 0.5},
+                {'name': 'lights-10k',  'entities': 10000, 'pointLights': 256},
+                {'name': 'shadows-10k', 'entities': 10000, 'shadowedLights': 4},
+                {'name': 'ui-1k',       'entities': 1000, 'uiEntities': 64}]
+
+Models = {'cube': Cube, 'sphere': Sphere, 'spider': Spider, 'duck': Duck}
+
+# the renderer's options, which are reported with the results and can be set
+# from the command line
+RendererOptions = ['instancing', 'frustumCulling', 'levelOfDetail', 'shadows',
+                   'shadowCaching', 'shadowCulling', 'depthPrepass']
+
+# the distance between neighbouring entities of the grid
+Spacing = 3.
+
+# every frame advances the scene by the same interval, so that runs are
+# repeatable
+FrameInterval = 1/60.
+
+Percentiles = [50, 90, 95, 99]
+
+
+
+class BenchmarkScene(object):
+	"""
+	A scene built from a set of parameters, see DefaultScene.  The entities and
+	lights are added to the renderer when it is created, and removed by
+	release().
+	"""
+	
+	def __init__(self, renderer, params):
+		self.renderer = renderer
+		
+		models = [Models[name] for name in params['models']]
+		for model_class in models:
+			renderer.addModel(model_class)
+		renderer.addModel(UiModel)
+		
+		num_entities = params['entities']
+		num_moving = int(num_entities * params['moving'])
+		side = int(ceil(sqrt(num_entities)))
+		self.extent = side * Spacing
+		
+		self.entities = []
+		self.characters = []
+		
+		for i in range(num_entities):
+			model_class = models[i % len(models)]
+			
+			if i < num_moving:
+				entity = Character(model_class)
+				entity.movement[2] = -1.
+				entity.movementSpeed = 2.
+				self.characters.append(entity)
+			else:
+				entity = Entity(model_class)
+			
+			entity.translate(((i % side - (side-1)/2.) * Spacing, 0., (i // side - (side-1)/2.) * Spacing))
+			entity.rotate((0., i * 2.39996, 0.))
+			
+			renderer.addEntity(entity, static=params['static'] and i >= num_moving)
+			self.entities.append(entity)
+		
+		random = Random(num_entities)
+		self.lights = []
+		
+		for i in range(params['shadowedLights']):
+			angle = 2*pi*i / params['shadowedLights']
+			light = renderer.getDirectionalLight()
+			light.setDirection([cos(angle), -1., sin(angle)])
+			light.setColour([0.75 / params['shadowedLights']] * 3)
+			self.lights.append(light)
+		
+		for i in range(params['pointLights']):
+			light = renderer.getPointLight()
+			light.setPosition([random.uniform(-0.5, 0.5) * self.extent, 1., random.uniform(-0.5, 0.5) * self.extent])
+			light.setAmplitude(5.)
+			light.setColour([random.random(), random.random(), random.random()])
+			self.lights.append(light)
+		
+		# the UI entities are tiled over the screen
+		self.uiEntities = []
+		columns = int(ceil(sqrt(params['uiEntities'])))
+		for i in range(params['uiEntities']):
+			size = 100. / columns
+			entity = UiEntity(horiz_offset = UiMeas(i % columns * size, "%"),
+			                  vert_offset  = UiMeas(i // columns * size, "%"),
+			                  width        = UiMeas(size * 0.8, "%"),
+			                  height       = UiMeas(size * 0.8, "%"))
+			renderer.addUiEntity(entity)
+			self.uiEntities.append(entity)
+	
+	
+	def update(self, time_passed):
+		# characters walk in circles
+		for character in self.characters:
+			character.rotate((0., time_passed, 0.))
+			character.update(time_passed)
+	
+	
+	def release(self):
+		for entity in self.entities:
+			self.renderer.removeEntity(entity)
+		for entity in self.uiEntities:
+			self.renderer.removeUiEntity(entity)
+		for light in self.lights:
+			self.renderer.releaseLight(light)
+
+
+
+class PathCamera(Camera):
+	""" Circles the centre of the scene once over a run, looking at it. """
+	
+	def __init__(self, radius, height):
+		super(PathCamera, self).__init__((0., height, radius))
+		self.radius = radius
+		self.height = height
+		self.setProgress(0.)
+	
+	
+	def setProgress(self, progress):
+		# type: (float) -> None
+		""" Moves the camera to a point of its path, from 0 at the start to 1 at the end. """
+		angle = 2*pi*progress
+		self._pos = array((self.radius*sin(angle), self.height, self.radius*cos(angle)))
+		self.az = -angle
+		self.el = atan2(self.height, self.radius)
+
+
+
+def summarise(times):
+	# type: (List[float]) -> Dict[str, float]
+	""" The mean, maximum and percentiles of a list of times, in milliseconds. """
+	times = array(times) * 1000.
+	summary = {'mean': float(times.mean()), 'max': float(times.max())}
+	for p, value in zip(Percentiles, percentile(times, Percentiles)):
+		summary['p%d' % p] = float(value)
+	return summary
+
+
+
+def run_scene(params, frames, warmup):
+	# type: (Dict[str, Any], int, int) -> Dict[str, Any]
+	"""
+	Renders a scene for a number of frames, after some frames which aren't
+	timed, in which shaders are compiled and the shadow caches filled.
+	
+	\return The frame times, the time of each of the renderer's phases, the
+	        time spent waiting for the GPU to finish the frame and the GPU time
+	        of each of the renderer's passes, as well as the renderer's stats
+	        for the last frame, with numpy values converted so that they can be
+	        written as JSON.
+	"""
+	renderer = game.renderer
+	scene = BenchmarkScene(renderer, params)
+	
+	radius = max(10., min(scene.extent, renderer.max_z) * 0.4)
+	camera = PathCamera(radius, radius*0.25 + 2.)
+	renderer.camera = camera
+	
+	frame_times = []
+	phase_times = {}
+	gpu_times = {}
+	
+	# GPU times arrive a few frames late, they are collected for the timed
+	# frames whose results arrive before the run ends
+	timers = renderer.gpuTimers
+	first_gpu_frame = timers.frame + warmup
+	last_gpu_frame = None
+	
+	for frame in range(-warmup, frames):
+		camera.setProgress(float(max(frame, 0)) / frames)
+		
+		start = default_timer()
+		scene.update(FrameInterval)
+		renderer.update(FrameInterval)
+		
+		# wait for the GPU, so that each frame's time includes its rendering
+		finish_start = default_timer()
+		glFinish()
+		end = default_timer()
+		
+		if frame >= 0:
+			frame_times.append(end - start)
+			for name, time in renderer.phaseTimes.items():
+				phase_times.setdefault(name, []).append(time)
+			phase_times.setdefault('finish', []).append(end - finish_start)
+		
+		if timers.resultFrame >= first_gpu_frame and timers.resultFrame != last_gpu_frame:
+			last_gpu_frame = timers.resultFrame
+			for name, time in timers.times.items():
+				gpu_times.setdefault(name, []).append(time)
+	
+	scene.release()
+	
+	return {'params':    params,
+	        'frames':    frames,
+	        'frameTime': summarise(frame_times),
+	        'phases':    dict((name, summarise(times)) for name, times in phase_times.items()),
+	        'gpuPasses': dict((name, summarise(times)) for name, times in gpu_times.items()),
+	        'stats':     dict((name, getattr(value, 'tolist', lambda: value)())
+	                          for name, value in renderer.frameStats.items())}
+
+
+
+def main():
+	parser = ArgumentParser(description="Renders synthetic scenes and reports their frame times as JSON.")
+	parser.add_argument('--scenes', help="comma separated names of the scenes to run, all of them by default")
+	parser.add_argument('--suite', help="a JSON file holding a list of scenes to run instead of the default ones")
+	parser.add_argument('--frames', type=int, default=300, help="the number of frames timed in each scene")
+	parser.add_argument('--warmup', type=int, default=30, help="the number of frames run before timing each scene")
+	parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+	                    help="sets a renderer option, one of: " + ", ".join(RendererOptions))
+	parser.add_argument('--output', help="the file the results are written to, stdout by default")
+	args = parser.parse_args()
+	
+	suite = DefaultSuite
+	if args.suite:
+		with open(args.suite) as suite_file:
+			suite = load_json(suite_file)
+	
+	if args.scenes:
+		names = args.scenes.split(',')
+		suite = [scene for scene in suite if scene['name'] in names]
+	
+	renderer = game.renderer
+	for setting in args.set:
+		option, value = setting.split('=', 1)
+		if option not in RendererOptions:
+			parser.error("Unknown renderer option: " + option)
+		setattr(renderer, option, load_json_value(value))
+	
+	results = {'gl':       {'vendor':   glGetString(GL_VENDOR),
+	                        'renderer': glGetString(GL_RENDERER),
+	                        'version':  glGetString(GL_VERSION)},
+	           'window':   {'size': list(renderer.window.size), 'headless': game.headless},
+	           'renderer': dict((option, getattr(renderer, option)) for option in RendererOptions),
+	           'warmup':   args.warmup,
+	           'scenes':   {}}
+	
+	for scene in suite:
+		params = dict(DefaultScene)
+		params.update(scene)
+		name = params.pop('name')
+		
+		sys.stderr.write("Running " + name + "\n")
+		results['scenes'][name] = run_scene(params, args.frames, args.warmup)
+	
+	if args.output:
+		with open(args.output, 'w') as output:
+			dump_json(results, output, indent=2, sort_keys=True)
+	else:
+		dump_json(results, sys.stdout, indent=2, sort_keys=True)
+
+
+
+if __name__ == '__main__':
+	main()
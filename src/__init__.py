@@ -21,3 +21,6 @@
 # DEALINGS IN THE SOFTWARE.                                                   #
 #                                                                             #
 #=============================================================================#
+
+# reads config.json, which may choose the platform PyOpenGL is imported for
+import config
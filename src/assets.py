@@ -0,0 +1,195 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+import hashlib
+import os
+from numpy import asarray, empty, dtype
+
+import pyassimp
+
+from cache_files import write_cache_file, map_cache_file
+from geometry import VertexDtype, index_dtype
+from materials import assimp_texture_file
+
+
+
+# The directory imported scenes are cached in.
+AssetCacheDir = 'asset_cache'
+
+# Changed whenever the contents or layout of the cache files change, so that
+# old files are no longer found.
+AssetCacheVersion = 2
+
+_Magic = 'OGLXSCN1'
+
+
+
+class MeshData(object):
+	"""
+	The geometry of one mesh of a scene, laid out ready for upload: vertices as
+	an array of VertexDtype, and index arrays as 16 or 32 bit values.
+	"""
+	
+	def __init__(self, vertex_data, index_data, lod_index_data, material_index):
+		self.vertexData = vertex_data
+		self.indexData  = index_data
+		self.lodIndexData = lod_index_data
+		self.materialIndex = material_index
+
+
+
+class MaterialData(object):
+	
+	def __init__(self, colour, texture_file):
+		self.colour = colour
+		self.textureFile = texture_file
+
+
+
+class SceneData(object):
+	
+	def __init__(self, meshes, materials):
+		self.meshes = meshes
+		self.materials = materials
+
+
+
+def import_scene(filename, processing):
+	# type: (str, int) -> SceneData
+	""" Imports a scene with AssImp, copying out everything that is needed from it. """
+	ai_scene = pyassimp.load(filename, processing=processing)
+	
+	try:
+		meshes = []
+		for ai_mesh in ai_scene.meshes:
+			vertex_data = empty(len(ai_mesh.vertices), dtype=VertexDtype)
+			vertex_data['position'] = ai_mesh.vertices
+			# texture coordinates have 3 components, but only the first 2 are wanted
+			vertex_data['uv']       = ai_mesh.texturecoords[0][:, 0:2]
+			vertex_data['normal']   = ai_mesh.normals
+			
+			index_data = asarray(ai_mesh.faces, dtype=index_dtype(len(vertex_data))).reshape(-1)
+			
+			meshes.append(MeshData(vertex_data, index_data, [], ai_mesh.materialindex))
+		
+		materials = [MaterialData([1., 1., 1.], assimp_texture_file(ai_mat)) for ai_mat in ai_scene.materials]
+	
+	finally:
+		pyassimp.release(ai_scene)
+	
+	return SceneData(meshes, materials)
+
+
+
+def scene_cache_file(filename, processing, options):
+	# type: (str, int, Any) -> str
+	"""
+	Returns the path a scene is cached at, which is keyed by a hash of the
+	source file's contents, the processing flags and the options.
+	"""
+	key = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		key.update(f.read())
+	key.update(repr((AssetCacheVersion, processing, options)))
+	
+	return os.path.join(AssetCacheDir, key.hexdigest() + '.bin')
+
+
+
+def save_scene(scene, cache_file):
+	# type: (SceneData, str) -> None
+	""" Writes a scene to a cache file, see write_cache_file. """
+	arrays = []
+	
+	def place(data):
+		arrays.append(data)
+		return len(arrays) - 1
+	
+	meshes = []
+	for mesh in scene.meshes:
+		meshes.append({'vertices':  place(mesh.vertexData),
+		               'indexType': mesh.indexData.dtype.str,
+		               'indices':   [place(index_data)
+		                             for index_data in [mesh.indexData] + list(mesh.lodIndexData)],
+		               'material':  mesh.materialIndex})
+	
+	materials = [{'colour': list(material.colour), 'texture': material.textureFile}
+	             for material in scene.materials]
+	
+	write_cache_file(cache_file, _Magic, {'meshes': meshes, 'materials': materials}, arrays)
+
+
+
+def load_cached_scene(cache_file):
+	# type: (str) -> SceneData
+	"""
+	Maps a scene's cache file into memory.  The arrays of the scene are views of
+	the mapping, see map_cache_file.
+	
+	Raises IOError if there is no such file and ValueError if it isn't valid.
+	"""
+	header, arrays = map_cache_file(cache_file, _Magic)
+	
+	meshes = []
+	for mesh in header['meshes']:
+		index_type = dtype(str(mesh['indexType']))
+		index_arrays = [arrays[index].view(index_type) for index in mesh['indices']]
+		
+		meshes.append(MeshData(arrays[mesh['vertices']].view(VertexDtype),
+		                       index_arrays[0], index_arrays[1:], mesh['material']))
+	
+	materials = [MaterialData(material['colour'], material['texture']) for material in header['materials']]
+	
+	return SceneData(meshes, materials)
+
+
+
+def load_scene(filename, processing, prepare=None, options=None):
+	# type: (str, int, Optional[Callable[[SceneData], None]], Any) -> SceneData
+	"""
+	Loads a scene from the asset cache, or on a cache miss imports it with
+	AssImp and adds it to the cache.
+	
+	Only the scene file itself is hashed, so changes to the files it refers to,
+	such as the materials of an OBJ file, aren't noticed.
+	
+	\param prepare  Called with a newly imported scene before it is cached, to
+	                add data derived from it, such as levels of detail.
+	\param options  Anything else that the prepared scene depends on, its repr
+	                is part of the cache key.
+	"""
+	cache_file = scene_cache_file(filename, processing, options)
+	
+	try:
+		return load_cached_scene(cache_file)
+	except (IOError, OSError, ValueError, KeyError):
+		pass
+	
+	scene = import_scene(filename, processing)
+	if prepare is not None:
+		prepare(scene)
+	
+	save_scene(scene, cache_file)
+	
+	return scene
@@ -0,0 +1,143 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+import json
+import os
+from tempfile import mkstemp
+from numpy import memmap, array, uint8
+
+
+
+# every array in a cache file starts on a multiple of this
+_Alignment = 16
+
+
+
+def _aligned(offset):
+	return -(-offset // _Alignment) * _Alignment
+
+
+
+def write_file_atomically(filename, write):
+	# type: (str, Callable[[file], None]) -> None
+	"""
+	Writes a file through a unique temporary file, which is renamed into place
+	once it is complete, so that a partly written file is never loaded.  Errors
+	are ignored, the caches written this way are only an optimisation.
+	
+	\param write  Called with the temporary file, opened for writing in binary
+	              mode, to write the file's contents.
+	"""
+	directory = os.path.dirname(filename) or '.'
+	temp_file = None
+	try:
+		# another thread may create the directory at the same time
+		try:
+			os.makedirs(directory)
+		except OSError:
+			if not os.path.isdir(directory):
+				raise
+		
+		# the temporary file is unique, as other threads or processes may be
+		# writing the same file
+		handle, temp_file = mkstemp(dir=directory, suffix='.tmp')
+		
+		with os.fdopen(handle, 'wb') as f:
+			write(f)
+		
+		os.rename(temp_file, filename)
+		temp_file = None
+	except (IOError, OSError):
+		pass
+	finally:
+		# renaming onto an existing file fails on Windows, where another thread
+		# has already written it
+		if temp_file is not None:
+			try:
+				os.remove(temp_file)
+			except OSError:
+				pass
+
+
+
+def write_cache_file(cache_file, magic, header, arrays):
+	# type: (str, str, Any, List[numpy.ndarray]) -> None
+	"""
+	Writes a cache file: the magic string, a JSON header, and then the contents
+	of each of the arrays, aligned so that they can be mapped in place.  The
+	file is written with write_file_atomically.
+	
+	\param header  Anything that can be encoded as JSON, which describes the
+	               arrays by their index in the list.
+	"""
+	places = []
+	size = 0
+	for data in arrays:
+		offset = _aligned(size)
+		places.append([offset, data.nbytes])
+		size = offset + data.nbytes
+	
+	header = json.dumps({'header': header, 'arrays': places})
+	header_size = len(magic) + 8 + len(header)
+	
+	def write(f):
+		f.write(magic)
+		f.write(array([len(header)], dtype='<u8').tostring())
+		f.write(header)
+		f.write('\0' * (_aligned(header_size) - header_size))
+		
+		size = 0
+		for data, (offset, nbytes) in zip(arrays, places):
+			f.write('\0' * (offset - size))
+			f.write(data.tostring())
+			size = offset + nbytes
+	
+	write_file_atomically(cache_file, write)
+
+
+
+def map_cache_file(cache_file, magic):
+	# type: (str, str) -> Tuple[Any, List[numpy.ndarray]]
+	"""
+	Maps a file written by write_cache_file into memory.  The file is only read
+	as the arrays are used, and they can be handed to OpenGL without being
+	copied.
+	
+	Raises IOError if there is no such file and ValueError if it isn't valid.
+	
+	\return The header, and the arrays as bytes to be viewed as their types.
+	"""
+	data = memmap(cache_file, dtype=uint8, mode='r')
+	
+	if data[:len(magic)].tostring() != magic:
+		raise ValueError("Not a cache file: " + cache_file)
+	
+	header_start = len(magic) + 8
+	header_size = int(data[len(magic):header_start].view('<u8')[0])
+	contents = json.loads(data[header_start:header_start + header_size].tostring())
+	data_start = _aligned(header_start + header_size)
+	
+	arrays = [data[data_start + offset:data_start + offset + nbytes] for offset, nbytes in contents['arrays']]
+	
+	return contents['header'], arrays
@@ -0,0 +1,128 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from numpy import einsum, isfinite, maximum, minimum, newaxis
+from numpy.linalg import norm
+
+from matrix_transforms import m_frustum_planes
+
+
+
+def spheres_inside(planes, centres, radii):
+	"""
+	Tests a set of spheres against a convex volume.
+	
+	\param planes   (p, 4) array of planes bounding the volume, as returned by
+	                m_frustum_planes.
+	\param centres  (n, 3) array of sphere centres.
+	\param radii    (n,) array of sphere radii.
+	\return  Boolean (n,) array, set for the spheres which are at least partly
+	         inside the volume.
+	"""
+	distances = centres.dot(planes[:, 0:3].T) + planes[:, 3]
+	return (distances >= -radii[:, None]).all(axis=1)
+
+
+
+def boxes_inside(planes, matrices, centres, extents):
+	"""
+	Tests a set of boxes against a convex volume.  Each box is axis-aligned in
+	its own space and transformed by an affine matrix, so is an oriented box in
+	the space of the planes.
+	
+	\param planes    (p, 4) array of planes bounding the volume, as returned by
+	                 m_frustum_planes.
+	\param matrices  (n, 4, 4) array of matrices transforming each box.
+	\param centres   (n, 3) array of box centres, before transformation.
+	\param extents   (n, 3) array of box half-sizes, before transformation.
+	\return  Boolean (n,) array, set for the boxes which are at least partly
+	         inside the volume.
+	"""
+	axes = matrices[:, 0:3, 0:3]
+	
+	world_centres = einsum('ni,nij->nj', centres, axes) + matrices[:, 3, 0:3]
+	distances = world_centres.dot(planes[:, 0:3].T) + planes[:, 3]
+	
+	# the distance the box extends towards each plane is the sum of its scaled
+	# axes projected onto the plane normal
+	radii = einsum('npi,ni->np', abs(einsum('nij,pj->npi', axes, planes[:, 0:3])), extents)
+	
+	return (distances >= -radii).all(axis=1)
+
+
+
+def entities_inside(planes, transforms):
+	# type: (numpy.ndarray, EntityTransforms) -> numpy.ndarray
+	"""
+	Tests the bounding volumes of a set of entities against a convex volume.
+	Each entity's bounding sphere is tested first, then the oriented bounding
+	box of those which pass.
+	
+	\return  Boolean array with an element for each entity of \p transforms, set
+	         for those which are at least partly inside the volume.
+	"""
+	inside = spheres_inside(planes, transforms.boundingCentres, transforms.boundingRadii)
+	
+	# models without bounds have infinite spheres and no meaningful box
+	bounded = inside & isfinite(transforms.boundingRadii)
+	inside[bounded] = boxes_inside(planes,
+	                               transforms.modelMatrices[bounded],
+	                               transforms.boxCentres[bounded],
+	                               transforms.boxExtents[bounded])
+	
+	return inside
+
+
+
+def shadow_caster_planes(light_matrix, centres, radii):
+	"""
+	Builds the planes bounding the region in which shadow casters can affect a
+	set of receivers, for a light with an orthographic view-projection matrix.
+	
+	This is the part of the light's volume covered by the receivers' bounding
+	spheres, extruded back towards the light so that occluders between the
+	light and its near plane are kept.  It therefore has no near plane.
+	
+	\param light_matrix  The light's (orthographic) view-projection matrix.
+	\param centres       (n, 3) array of receiver bounding sphere centres.
+	\param radii         (n,) array of receiver bounding sphere radii.
+	\return  (5, 4) array of planes, in the form returned by m_frustum_planes,
+	         or None if none of the receivers are inside the light's volume.
+	"""
+	if len(radii) == 0:
+		return None
+	
+	# the projection is affine, so each sphere maps to an ellipsoid whose extent
+	# along each clip space axis is its radius scaled by that axis' column
+	clip_centres = centres.dot(light_matrix[0:3, 0:3]) + light_matrix[3, 0:3]
+	clip_extents = radii[:, newaxis] * norm(light_matrix[0:3, 0:3], axis=0)
+	
+	lower = maximum((clip_centres - clip_extents).min(axis=0), -1.)
+	upper = minimum((clip_centres + clip_extents).max(axis=0),  1.)
+	
+	if (lower > upper).any():
+		return None
+	
+	planes = m_frustum_planes(light_matrix, lower, upper)
+	return planes[[0, 1, 2, 3, 5]]
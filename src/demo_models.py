@@ -0,0 +1,60 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from math import pi
+
+import pyassimp.postprocess
+
+from models import AssimpModel
+
+
+
+pyassimp_processing_flags = (pyassimp.postprocess.aiProcess_Triangulate |
+                             pyassimp.postprocess.aiProcess_OptimizeMeshes)
+
+
+class Cube(AssimpModel):
+	def __init__(self):
+		super(Cube, self).__init__("assets/obj/cube.obj", pyassimp_processing_flags)
+
+
+class Sphere(AssimpModel):
+	def __init__(self):
+		super(Sphere, self).__init__("assets/obj/sphere.dae", pyassimp_processing_flags)
+
+
+class Spider(AssimpModel):
+	def __init__(self):
+		super(Spider, self).__init__("assets/obj/spider.obj", pyassimp_processing_flags)
+		
+		self.rotate((0., pi/2, 0.))
+		self.translate((-0.05, 0., 0.))
+		self.scale((.01, .01, .01 ))
+
+
+class Duck(AssimpModel):
+	def __init__(self):
+		super(Duck, self).__init__("assets/obj/duck.dae", pyassimp_processing_flags)
+		
+		self.scale((.01, .01, .01))
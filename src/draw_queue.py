@@ -0,0 +1,121 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from collections import namedtuple
+
+
+
+# The state a draw needs, in order of how expensive it is to change.
+DrawKey = namedtuple('DrawKey', ['program', 'page', 'texture', 'colour', 'alpha'])
+
+
+# A single draw of a mesh.  The transforms drawn are entries [start, end) of
+# the EntityTransforms the queue was built from; an instanced record draws the
+# whole range as instances, otherwise the range is a single entity.
+DrawRecord = namedtuple('DrawRecord', ['key', 'mesh', 'start', 'end'])
+
+
+
+class DrawQueue(object):
+	"""
+	A list of draw records for a render pass, rebuilt each frame.  The records
+	are sorted by a key made up of the shader program, geometry page, texture
+	and material state needed by each draw, so that consecutive draws share as
+	much of that state as possible and it only needs to be changed when it
+	actually differs.  Records with equal keys are ordered by entity, so that
+	the meshes of one entity sharing a key can be drawn together.
+	
+	A queue holds either the opaque or the transparent meshes.  Transparent
+	meshes must be blended in order, so they are sorted by depth instead,
+	furthest first, and are never instanced.
+	"""
+	
+	def __init__(self):
+		self.records = []
+		self.instanced = False
+		
+		# the programs used by the records, by GL program name
+		self.programs = {}
+	
+	
+	def __len__(self):
+		return len(self.records)
+	
+	
+	def __iter__(self):
+		return iter(self.records)
+	
+	
+	@staticmethod
+	def sortKey(shader_program, mesh):
+		# type: (ShaderProgram, Mesh) -> DrawKey
+		""" Returns the key ordering draws of the mesh with the shader program. """
+		material = mesh.material
+		return DrawKey(shader_program.program, id(mesh.page),
+		               material.texture, tuple(material.colour), material.alpha)
+	
+	
+	def build(self, select_program, transforms, instanced, depths=None):
+		# type: (Callable[[Mesh], ShaderProgram], EntityTransforms, bool, Optional[ndarray]) -> None
+		"""
+		Fills the queue with a record for each mesh of each model in the
+		transforms, then sorts it.
+		
+		\param select_program  Gives the program each mesh will be drawn with.
+		\param transforms      The entities to draw.
+		\param instanced       If set, one record is made per mesh for all of the
+		                       entities sharing its model, otherwise one is made per
+		                       mesh per entity.
+		\param depths          The view depth of each entity.  If given the queue
+		                       holds the transparent meshes, sorted furthest first,
+		                       otherwise it holds the opaque meshes.
+		"""
+		transparent = depths is not None
+		if transparent:
+			instanced = False
+		
+		records = []
+		programs = {}
+		
+		for model, start, end in transforms.groups:
+			for mesh in model.meshes:
+				if mesh.material.transparent != transparent:
+					continue
+				
+				shader_program = select_program(mesh)
+				programs[shader_program.program] = shader_program
+				key = self.sortKey(shader_program, mesh)
+				
+				if instanced:
+					records.append(DrawRecord(key, mesh, start, end))
+				else:
+					records.extend(DrawRecord(key, mesh, i, i+1) for i in range(start, end))
+		
+		if transparent:
+			records.sort(key=lambda record: (-depths[record.start], record.start, record.key))
+		else:
+			records.sort(key=lambda record: (record.key, record.start))
+		self.records = records
+		self.instanced = instanced
+		self.programs = programs
@@ -0,0 +1,214 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from numpy import identity, zeros
+
+from matrix_transforms import *
+from models import UiModel
+
+
+
+class Entity(object):
+	"""
+	This class is for representing a 3d game object.
+	"""
+	
+	def __init__(self, model_class):
+		self._matrix = identity(4)
+		self._modelClass = model_class
+		
+		
+	@property
+	def pos(self):
+		return self._matrix[3][0:3]
+		
+	@property
+	def matrix(self):
+		""" Returns the current model matrix. """
+		return self._matrix
+		
+	#@property
+	#def normalMatrix(self):
+	#	return self.model.normalMatrix
+	
+	@property
+	def modelClass(self):
+		return self._modelClass
+	
+	
+	def translate(self, t):
+		"""
+		Move the entity relative to its current position /and rotation/.
+		"""
+		m_translate_in_place(self._matrix, t)
+		
+	def rotate(self, r):
+		""" Rotate the entity relative to its current rotation. """
+		m_rotate_in_place(self._matrix, r)
+
+
+
+class Character(Entity):
+	"""
+	This class extends the #Entity class to add mobility to the object.
+	"""
+	
+	def __init__(self, model_class):
+		super(Character, self).__init__(model_class)
+		
+		self.movement = zeros(3)
+		self.movementSpeed = 0.
+		self.heading = 0.
+		
+		
+	def update(self, time_passed):
+		""" Update the position of the object. """
+		movement = self.movement.dot(self.movementSpeed).dot(time_passed)
+		self.translate(movement)
+	
+	
+
+class PlayerCharacter(Character):
+	"""
+	This class extends the #Character class to add control methods.
+	"""
+	
+	def __init__(self, model_class):
+		super(PlayerCharacter, self).__init__(model_class)
+		
+		self.camera = None
+	
+	
+	def setCamera(self, camera):
+		self.camera = camera
+	
+	
+	def forwardsBackwards(self, mag):
+		self.movement[2] -= mag
+		if abs(self.movement[2]) > abs(mag):
+			self.movement[2] = -mag
+		
+	def leftRight(self, mag):
+		self.movement[0] += mag
+		if abs(self.movement[0]) > abs(mag):
+			self.movement[0] = mag
+	
+	
+	def update(self, time_passed):
+		if (self.movement[0] != 0 or self.movement[2] != 0):
+			if (self.camera):
+				self.rotate((0., self.camera.az-self.heading, 0.))
+			
+			self.heading = self.camera.az
+		
+		super(PlayerCharacter, self).update(time_passed)
+
+
+
+class UiModelVerticalAlignment:
+	Top    = 0
+	Centre = 1
+	Bottom = 2
+
+class UiModelHorizontalAlignment:
+	Left   = 0
+	Centre = 1
+	Right  = 2
+
+
+from re import compile, search
+
+ui_meas_re = compile("^([-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?)(?:\s*)([%(?:px)]*)")
+
+class UiMeas:
+	def __init__(self, val, type="sc"):
+		self.val  = val
+		self.type = type
+
+
+class UiEntity(Entity):
+
+	def __init__(self, horiz_offset = UiMeas(0, "%"),
+		                 vert_offset  = UiMeas(0, "%"),
+		                 width        = UiMeas(50, "%"),
+		                 height       = UiMeas(50, "%"),
+		                 horiz_align  = UiModelHorizontalAlignment.Left,
+		                 vert_align   = UiModelVerticalAlignment.Top,
+		                 model_class  = UiModel):
+		super(UiEntity, self).__init__(model_class)
+		
+		self.setLayout(horiz_offset, vert_offset, width, height, horiz_align, vert_align)
+	
+	
+	def setLayout(self, horiz_offset, vert_offset, width, height, horiz_align, vert_align):
+		""" Places the entity on the screen, replacing its matrix. """
+		self._matrix = identity(4)
+		
+		translation = [0., 0., 0.]
+		scale = [1., 1., 1.]
+		pre_scale_translation  = [0., 0., 0.]
+		post_scale_translation = [0., 0., 0.]
+		
+		if horiz_align == UiModelHorizontalAlignment.Left:
+			pre_scale_translation[0] = -1.
+			post_scale_translation[0] = .5
+			horiz_offset_scl = 1.
+		elif horiz_align == UiModelHorizontalAlignment.Right:
+			pre_scale_translation[0] = 1.
+			post_scale_translation[0] = -.5
+			horiz_offset_scl = -1.
+		
+		if vert_align == UiModelVerticalAlignment.Top:
+			pre_scale_translation[1] = 1.
+			post_scale_translation[1] = -.5
+			vert_offset_scl = -1.
+		elif vert_align == UiModelVerticalAlignment.Bottom:
+			pre_scale_translation[1] = -1.
+			post_scale_translation[1] = .5
+			vert_offset_scl = 1.
+		
+		if horiz_offset.type == "sc":
+			translation[0] = horiz_offset_scl*horiz_offset.val
+		elif horiz_offset.type == "%":
+			translation[0] = horiz_offset_scl*horiz_offset.val/50.
+		
+		if vert_offset.type == "sc":
+			translation[1] = vert_offset_scl*vert_offset.val
+		elif vert_offset.type == "%":
+			translation[1] = vert_offset_scl*vert_offset.val/50.
+		
+		if width.type == "sc":
+			scale[0] = width.val
+		elif width.type == "%":
+			scale[0] = width.val/50.
+		
+		if height.type == "sc":
+			scale[1] = height.val
+		elif height.type == "%":
+			scale[1] = height.val/50.
+		
+		m_translate_in_place(self._matrix, translation)
+		m_translate_in_place(self._matrix, pre_scale_translation)
+		m_scale_in_place(self._matrix, scale)
+		m_translate_in_place(self._matrix, post_scale_translation)
@@ -0,0 +1,227 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from numpy import array, zeros, empty, matmul, repeat, einsum, flatnonzero, argsort, concatenate, diff, split
+from numpy.linalg import norm
+
+from matrix_transforms import m_affine_inverse_transpose
+
+
+
+class EntityTransforms(object):
+	"""
+	This class holds the final model and normal matrices of a collection of
+	entities for the current frame, along with their world space bounding
+	volumes.  They are computed for all entities at once as (N, 4, 4) array
+	operations, and are then shared by every render pass.
+	
+	Entities are stored grouped by model, so that the matrices of all the
+	entities sharing a model are a contiguous slice of the arrays.  Each
+	entity also has a level of detail, which is the same for every entity of
+	a group.
+	"""
+	
+	# per-entity arrays, all indexed in the same order as entities
+	_arrays = ('modelMatrices', 'normalMatrices',
+	           'boxCentres', 'boxExtents',
+	           'boundingCentres', 'boundingRadii',
+	           'lods')
+	
+	def __init__(self):
+		self.entities = []
+		self.groups = []
+		self._clearArrays()
+	
+	
+	def __len__(self):
+		return len(self.entities)
+	
+	
+	def _clearArrays(self):
+		self.modelMatrices  = zeros((0, 4, 4))
+		self.normalMatrices = zeros((0, 4, 4))
+		
+		# model space bounding boxes, which are transformed by the model matrices
+		self.boxCentres = zeros((0, 3))
+		self.boxExtents = zeros((0, 3))
+		
+		# world space bounding spheres
+		self.boundingCentres = zeros((0, 3))
+		self.boundingRadii   = zeros(0)
+		
+		self.lods = zeros(0, dtype=int)
+		
+		self._instanceData = None
+	
+	
+	@property
+	def instanceData(self):
+		"""
+		Returns the model and normal matrices packed as the (N, 2, 4, 4) float32
+		array uploaded to the instance buffers.
+		"""
+		if self._instanceData is None:
+			self._instanceData = empty((len(self.entities), 2, 4, 4), dtype='float32')
+			self._instanceData[:, 0] = self.modelMatrices
+			self._instanceData[:, 1] = self.normalMatrices
+		
+		return self._instanceData
+	
+	
+	def update(self, entities, models, placeholder=None):
+		# type: (Iterable[Entity], Dict[Class, Model], Optional[Model]) -> None
+		"""
+		Recomputes the matrices and bounds for the given entities.
+		
+		\param entities     The entities to compute matrices for.
+		\param models       Mapping of model class to model instance, as held by
+		                    the renderer.
+		\param placeholder  The model used for entities whose model class isn't in
+		                    \p models, otherwise such entities are an error.
+		"""
+		grouped = {}
+		for entity in entities:
+			model = models.get(entity.modelClass, placeholder)
+			if model is None:
+				raise KeyError(entity.modelClass)
+			grouped.setdefault(model, []).append(entity)
+		
+		self.entities = []
+		self.groups = []
+		for model, group in grouped.items():
+			start = len(self.entities)
+			self.entities.extend(group)
+			self.groups.append((model, start, len(self.entities)))
+		
+		self._instanceData = None
+		
+		if not self.entities:
+			self._clearArrays()
+			return
+		
+		group_models = [model for model, start, end in self.groups]
+		group_sizes  = [end-start for model, start, end in self.groups]
+		
+		def per_entity(values):
+			return repeat(array(values), group_sizes, axis=0)
+		
+		entity_matrices = array([entity.matrix for entity in self.entities])
+		local_matrices  = per_entity([model.localMatrix for model in group_models])
+		
+		self.modelMatrices  = matmul(local_matrices, entity_matrices)
+		self.normalMatrices = m_affine_inverse_transpose(self.modelMatrices)
+		
+		self.boxCentres = per_entity([(model.aabbMax + model.aabbMin)/2. for model in group_models])
+		self.boxExtents = per_entity([(model.aabbMax - model.aabbMin)/2. for model in group_models])
+		
+		# the sphere radius grows by the largest scaling of the model matrix
+		axes = self.modelMatrices[:, 0:3, 0:3]
+		self.boundingCentres = einsum('ni,nij->nj', per_entity([model.boundingCentre for model in group_models]), axes) \
+		                       + self.modelMatrices[:, 3, 0:3]
+		self.boundingRadii   = per_entity([model.boundingRadius for model in group_models]) \
+		                       * norm(axes, axis=2).max(axis=1)
+		
+		self.lods = zeros(len(self.entities), dtype=int)
+	
+	
+	def select(self, mask):
+		# type: (numpy.ndarray) -> EntityTransforms
+		"""
+		Returns a new instance holding only the entities for which \p mask is set,
+		still grouped by model.  Models with no selected entities are dropped.
+		"""
+		groups = []
+		for model, group_start, group_end in self.groups:
+			indices = group_start + flatnonzero(mask[group_start:group_end])
+			if len(indices):
+				groups.append((model, indices))
+		
+		return self._take(groups)
+	
+	
+	def viewDepths(self, camera_matrix):
+		# type: (numpy.ndarray) -> numpy.ndarray
+		""" Returns the distance of each entity's bounding sphere centre in front of the camera. """
+		return -(self.boundingCentres.dot(camera_matrix[0:3, 2]) + camera_matrix[3, 2])
+	
+	
+	def sortedByDepth(self, camera_matrix, far_first=False):
+		# type: (numpy.ndarray, bool) -> EntityTransforms
+		"""
+		Returns a new instance holding the same entities, still grouped by model,
+		with the entities of each group ordered nearest to the camera first.  The
+		groups are ordered by their nearest entity.
+		
+		\param far_first  Reverses both orders.
+		"""
+		depths = self.viewDepths(camera_matrix)
+		if far_first:
+			depths = -depths
+		
+		groups = []
+		for model, group_start, group_end in self.groups:
+			indices = group_start + argsort(depths[group_start:group_end], kind='mergesort')
+			groups.append((model, indices))
+		
+		groups.sort(key=lambda group: depths[group[1][0]])
+		
+		return self._take(groups)
+	
+	
+	def splitByLod(self, lods):
+		# type: (numpy.ndarray) -> EntityTransforms
+		"""
+		Returns a new instance holding the same entities with the given levels of
+		detail.  Each group is split into one group per level, so a model may have
+		several groups.  Within a group the entities keep their order.
+		"""
+		groups = []
+		for model, group_start, group_end in self.groups:
+			indices = group_start + argsort(lods[group_start:group_end], kind='mergesort')
+			runs = flatnonzero(diff(lods[indices])) + 1
+			groups.extend((model, run) for run in split(indices, runs))
+		
+		split_transforms = self._take(groups)
+		split_transforms.lods = lods[concatenate([run for model, run in groups] or [zeros(0, dtype=int)])]
+		
+		return split_transforms
+	
+	
+	def _take(self, groups):
+		# type: (List[Tuple[Model, numpy.ndarray]]) -> EntityTransforms
+		""" Returns a new instance holding the given entities of each model, in order. """
+		taken = EntityTransforms()
+		indices = concatenate([group_indices for model, group_indices in groups] or [zeros(0, dtype=int)])
+		
+		taken.entities = [self.entities[i] for i in indices]
+		
+		start = 0
+		for model, group_indices in groups:
+			taken.groups.append((model, start, start+len(group_indices)))
+			start += len(group_indices)
+		
+		for name in self._arrays:
+			setattr(taken, name, getattr(self, name)[indices])
+		
+		return taken
@@ -22,14 +22,16 @@
 #                                                                             #
 #=============================================================================#
 
-from io import open
-from json import load as load_json
 from math import pi
 from sets import Set
 
 import pyglfw.pyglfw as glfw
 from pyglfw.pyglfw.window import Window as GlfwWindow
 
+from config import settings
+from headless import HeadlessWindow
+from profiler import profiler
+from profiler_overlay import ProfilerOverlay
 from renderer import Renderer
 from cameras import Camera, OrbitalCamera
 from events import DispatchTable
@@ -74,29 +76,41 @@ class Game(object):
 	"""
 	The object containing all information about the game.
 	"""
+	
+	# where the profiler's trace is written when the game ends, if it is enabled
+	ProfileTraceFile = "profile_trace.json"
+	
+	# the scopes shown by the profiler overlay
+	OverlayScopes = ['frame', 'GameData.update', 'Renderer.update', 'shadows',
+	                 'drawQueues', 'opaque', 'transparent', 'ui', 'swapBuffers', 'poll_events']
 
 	def __init__(self):
 		
-		with open("config.json") as cfg_file:
-			game_cfg = load_json(cfg_file)
-		
-		if not glfw.init():
-			raise RuntimeError("Failed to initialise GLFW")
-		
-		GlfwWindow.hint(samples = game_cfg["aaSamples"])
-		GlfwWindow.hint(context_ver_major = 3)
-		GlfwWindow.hint(context_ver_minor = 3)
-		GlfwWindow.hint(forward_compat = True)
-		GlfwWindow.hint(resizable = True)
-		GlfwWindow.hint(opengl_profile = GlfwWindow.CORE_PROFILE)
+		# headless games render offscreen, for machines without a display
+		self.headless = settings.get("headless", False)
 		
-		primary_monitor = None
-		if game_cfg["fullscreen"]:
-			primary_monitor = glfw.get_primary_monitor()
+		if self.headless:
+			self.window = HeadlessWindow(settings["screenWidth"], settings["screenHeight"],
+			                             settings["aaSamples"], settings.get("headlessPlatform", "egl"))
 		
-		self.window = GlfwWindow(game_cfg["screenWidth"], game_cfg["screenHeight"], "Tutorial", primary_monitor)
-		if not self.window:
-			raise RuntimeError("Failed to initialise window.")
+		else:
+			if not glfw.init():
+				raise RuntimeError("Failed to initialise GLFW")
+			
+			GlfwWindow.hint(samples = settings["aaSamples"])
+			GlfwWindow.hint(context_ver_major = 3)
+			GlfwWindow.hint(context_ver_minor = 3)
+			GlfwWindow.hint(forward_compat = True)
+			GlfwWindow.hint(resizable = True)
+			GlfwWindow.hint(opengl_profile = GlfwWindow.CORE_PROFILE)
+			
+			primary_monitor = None
+			if settings["fullscreen"]:
+				primary_monitor = glfw.get_primary_monitor()
+			
+			self.window = GlfwWindow(settings["screenWidth"], settings["screenHeight"], "Tutorial", primary_monitor)
+			if not self.window:
+				raise RuntimeError("Failed to initialise window.")
 		
 		self.window.make_current()
 		
@@ -116,6 +130,12 @@ class Game(object):
 		self.renderer = Renderer(self.window)
 		self.renderer.fov = pi/4.
 		
+		profiler.enabled = settings.get("profiler", False)
+		
+		self.profilerOverlay = None
+		if profiler.enabled and settings.get("profilerOverlay", False):
+			self.profilerOverlay = ProfilerOverlay(self.renderer, profiler, self.OverlayScopes)
+		
 		self.camera = None
 		
 		self.gameData = GameData()
@@ -126,7 +146,8 @@ class Game(object):
 	
 	
 	def __del__(self):
-		glfw.terminate()
+		if not self.headless:
+			glfw.terminate()
 		
 		
 	def run(self):
@@ -137,14 +158,32 @@ class Game(object):
 			time_passed = self.clock.tick(60.)
 			print "{0:.3f}\r".format(self.clock.fps),
 			
+			profiler.begin('frame')
+			
+			profiler.begin('GameData.update')
 			self.gameData.update(time_passed)
+			profiler.end()
 			
+			if self.profilerOverlay is not None:
+				self.profilerOverlay.update()
+			
+			profiler.begin('Renderer.update')
 			self.renderer.update(time_passed)
+			profiler.end()
+			
+			if not self.headless:
+				profiler.begin('poll_events')
+				glfw.poll_events()
+				profiler.end()
 			
-			glfw.poll_events()
+			profiler.end()
+			profiler.endFrame()
 			
 			if self.window.should_close:
 				self._terminate = True
+		
+		if profiler.enabled:
+			profiler.exportTrace(self.ProfileTraceFile)
 	
 	
 	def terminate(self):
@@ -152,8 +191,8 @@ class Game(object):
 		self._terminate = True
 			
 			
-	def addEntity(self, entity):
-		self.renderer.addEntity(entity)
+	def addEntity(self, entity, static=False):
+		self.renderer.addEntity(entity, static)
 	
 	def removeEntity(self, entity):
 		self.renderer.removeEntity(entity)
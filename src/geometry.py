@@ -0,0 +1,384 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from bisect import bisect
+from ctypes import c_void_p
+from numpy import array, identity, dtype
+from OpenGL.GL import *
+
+
+
+# Layout of a single vertex in the interleaved vertex buffer.
+VertexDtype = dtype([('position', 'f4', 3),
+                     ('uv',       'f4', 2),
+                     ('normal',   'f4', 3)])
+
+
+# Size of each instance record, a model matrix followed by a normal matrix.
+InstanceStride = 128
+
+
+
+def index_dtype(num_vertices):
+	# type: (int) -> str
+	""" Indices are 16 bit where the vertex count allows, and 32 bit otherwise. """
+	return 'uint16' if num_vertices <= 0x10000 else 'uint32'
+
+
+
+class FreeList(object):
+	"""
+	Hands out ranges of a fixed size space.  Free ranges are kept sorted by
+	offset; allocations take the first range that is large enough, and freed
+	ranges are merged back into their neighbours so the space does not fragment
+	into pieces too small to reuse.
+	"""
+	
+	def __init__(self, size):
+		self.size = size
+		self.ranges = [(0, size)]
+	
+	
+	def allocate(self, size):
+		# type: (int) -> int
+		""" \return The offset of a range of \p size units, or None if there is no room. """
+		for i, (offset, range_size) in enumerate(self.ranges):
+			if range_size >= size:
+				if range_size == size:
+					del self.ranges[i]
+				else:
+					self.ranges[i] = (offset + size, range_size - size)
+				return offset
+		
+		return None
+	
+	
+	def free(self, offset, size):
+		# type: (int, int) -> None
+		""" Returns a previously allocated range to the list. """
+		if size == 0:
+			return
+		
+		i = bisect(self.ranges, (offset, size))
+		
+		# merge with the following range
+		if i < len(self.ranges) and self.ranges[i][0] == offset + size:
+			size += self.ranges.pop(i)[1]
+		
+		# merge with the preceding range
+		if i > 0 and sum(self.ranges[i-1]) == offset:
+			offset, prev_size = self.ranges[i-1]
+			self.ranges[i-1] = (offset, prev_size + size)
+		else:
+			self.ranges.insert(i, (offset, size))
+	
+	
+	def used(self):
+		# type: () -> int
+		return self.size - sum(size for offset, size in self.ranges)
+
+
+
+class GeometryAllocation(object):
+	"""
+	The location of one mesh's vertices and indices within a geometry page.
+	Indices are relative to the mesh's first vertex, they are offset by
+	baseVertex when drawn.
+	"""
+	
+	def __init__(self, page, base_vertex, num_vertices, first_index, num_indices):
+		self.page = page
+		self.baseVertex  = base_vertex
+		self.numVertices = num_vertices
+		self.firstIndex  = first_index
+		self.numIndices  = num_indices
+		
+		# byte offset of the first index, as passed to the draw calls
+		self.indexOffset = first_index * page.indexSize
+
+
+
+class GeometryPage(object):
+	"""
+	A vertex buffer and index buffer pair that many meshes are allocated from,
+	with a single vertex array object binding them and the arena's instance
+	buffer to the shader attributes.  Every index in a page has the same type.
+	"""
+	
+	def __init__(self, arena, num_vertices, num_indices, index_type):
+		self.arena = arena
+		self.indexType = index_type
+		self.indexSize = 2 if index_type == GL_UNSIGNED_SHORT else 4
+		
+		self.vertices = FreeList(num_vertices)
+		self.indices  = FreeList(num_indices)
+		
+		self.vertexBuf, self.indexBuf = glGenBuffers(2)
+		
+		# the buffers are allocated through the copy target so that no vertex
+		# array object's index buffer binding is disturbed
+		glBindBuffer(GL_COPY_WRITE_BUFFER, self.vertexBuf)
+		glBufferData(GL_COPY_WRITE_BUFFER, num_vertices * VertexDtype.itemsize, None, GL_STATIC_DRAW)
+		glBindBuffer(GL_COPY_WRITE_BUFFER, self.indexBuf)
+		glBufferData(GL_COPY_WRITE_BUFFER, num_indices * self.indexSize, None, GL_STATIC_DRAW)
+		
+		self.vao = glGenVertexArrays(1)
+		self._instanceOffset = 0
+		
+		self.bindAttributes(arena.shaderProgram)
+		
+		
+	def __del__(self):
+		glDeleteBuffers(2, [self.vertexBuf, self.indexBuf])
+		glDeleteVertexArrays(1, [self.vao])
+		
+		
+	def bindAttributes(self, shader_program):
+		# type: (ShaderProgram) -> None
+		"""
+		Binds the page's buffers to the attribute points in the shader program,
+		within the page's vao.  After this is done every mesh in the page can be
+		drawn with just the vao bound.
+		"""
+		self.bind()
+		glBindBuffer(GL_ARRAY_BUFFER, self.vertexBuf)
+		
+		stride = VertexDtype.itemsize
+		
+		shader_program.vertexPosition.enable()
+		glVertexAttribPointer(shader_program.vertexPosition.location,
+		                      3, GL_FLOAT, False, stride, c_void_p(VertexDtype.fields['position'][1]))
+		
+		shader_program.vertexUv.enable()
+		glVertexAttribPointer(shader_program.vertexUv.location,
+		                      2, GL_FLOAT, False, stride, c_void_p(VertexDtype.fields['uv'][1]))
+		
+		shader_program.vertexNormal.enable()
+		glVertexAttribPointer(shader_program.vertexNormal.location,
+		                      3, GL_FLOAT, False, stride, c_void_p(VertexDtype.fields['normal'][1]))
+		
+		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexBuf)
+		
+		for attribute in (shader_program.instanceModelMatrix, shader_program.instanceNormalMatrix):
+			# a mat4 attribute occupies four consecutive locations, one per column
+			for column in range(4):
+				location = attribute.location + column
+				glEnableVertexAttribArray(location)
+				glVertexAttribDivisor(location, 1)
+		
+		self._bindInstanceAttributes(0)
+		
+		
+	def _bindInstanceAttributes(self, offset):
+		# type: (int) -> None
+		glBindBuffer(GL_ARRAY_BUFFER, self.arena.instanceBuf)
+		
+		shader_program = self.arena.shaderProgram
+		for attribute, matrix_offset in ((shader_program.instanceModelMatrix,  0),
+		                                 (shader_program.instanceNormalMatrix, 64)):
+			for column in range(4):
+				glVertexAttribPointer(attribute.location + column, 4, GL_FLOAT, False, InstanceStride,
+				                      c_void_p(offset + matrix_offset + 16*column))
+		
+		self._instanceOffset = offset
+		
+		
+	def setFirstInstance(self, index):
+		# type: (int) -> None
+		"""
+		Points the instance attributes at record \p index of the instance buffer,
+		so that instanced draws start from there.  The page must be bound.
+		"""
+		offset = index * InstanceStride
+		if offset != self._instanceOffset:
+			self._bindInstanceAttributes(offset)
+		
+		
+	def bind(self):
+		""" Binds the page's vao, unless it is already bound. """
+		if self.arena.boundPage is not self:
+			glBindVertexArray(self.vao)
+			self.arena.boundPage = self
+			self.arena.binds += 1
+		
+		# the instance buffer may have shrunk since the attributes were last
+		# pointed into it
+		if self._instanceOffset and self._instanceOffset >= self.arena.instanceBytes:
+			self._bindInstanceAttributes(0)
+		
+		
+	def upload(self, vertex_data, index_arrays):
+		# type: (ndarray, List[ndarray]) -> GeometryAllocation
+		"""
+		Copies a mesh's vertices and indices into the page.  The index arrays are
+		placed one after another, each is copied straight from its own memory.
+		
+		\return The allocation, or None if the page does not have room.
+		"""
+		num_indices = sum(len(index_data) for index_data in index_arrays)
+		
+		base_vertex = self.vertices.allocate(len(vertex_data))
+		if base_vertex is None:
+			return None
+		
+		first_index = self.indices.allocate(num_indices)
+		if first_index is None:
+			self.vertices.free(base_vertex, len(vertex_data))
+			return None
+		
+		allocation = GeometryAllocation(self, base_vertex, len(vertex_data), first_index, num_indices)
+		
+		glBindBuffer(GL_COPY_WRITE_BUFFER, self.vertexBuf)
+		glBufferSubData(GL_COPY_WRITE_BUFFER, base_vertex * VertexDtype.itemsize, vertex_data.nbytes, vertex_data)
+		glBindBuffer(GL_COPY_WRITE_BUFFER, self.indexBuf)
+		
+		offset = allocation.indexOffset
+		for index_data in index_arrays:
+			glBufferSubData(GL_COPY_WRITE_BUFFER, offset, index_data.nbytes, index_data)
+			offset += index_data.nbytes
+		
+		return allocation
+		
+		
+	def free(self, allocation):
+		# type: (GeometryAllocation) -> None
+		self.vertices.free(allocation.baseVertex, allocation.numVertices)
+		self.indices.free(allocation.firstIndex, allocation.numIndices)
+
+
+
+class GeometryArena(object):
+	"""
+	Owns the geometry of every mesh, suballocated from a few large pages so
+	that meshes can be drawn one after another without switching vertex array
+	objects.  Pages are made as they are needed, with one list of pages per
+	index type; a mesh too large for a default page is given one of its own.
+	
+	The arena also owns the instance buffer that every page's instance
+	attributes are bound to.
+	"""
+	
+	VertexPageSize = 1 << 20
+	IndexPageSize  = 1 << 22
+	
+	def __init__(self, shader_program):
+		# type: (ShaderProgram) -> None
+		"""
+		\param shader_program  The program whose attribute locations the pages
+		                       are bound to.  Other programs drawing from the
+		                       arena must use the same locations.
+		"""
+		self.shaderProgram = shader_program
+		self.pages = {GL_UNSIGNED_SHORT: [], GL_UNSIGNED_INT: []}
+		
+		self.boundPage = None
+		self.binds = 0
+		
+		self.instanceBytes = 0
+		
+		# start the instance buffer off with a single identity record, so that
+		# non-instanced draws never read outside of it
+		self.instanceBuf = glGenBuffers(1)
+		self.setInstances(array([[identity(4), identity(4)]], dtype='float32'))
+		
+		
+	def __del__(self):
+		glDeleteBuffers(1, [self.instanceBuf])
+		
+		
+	def allocate(self, vertex_data, index_arrays, index_type):
+		# type: (ndarray, List[ndarray], int) -> GeometryAllocation
+		"""
+		Uploads a mesh's geometry to the first page of its index type with room for
+		it.
+		
+		\param index_arrays  The mesh's index arrays, placed one after another.
+		"""
+		pages = self.pages[index_type]
+		
+		for page in pages:
+			allocation = page.upload(vertex_data, index_arrays)
+			if allocation is not None:
+				return allocation
+		
+		page = GeometryPage(self,
+		                    max(self.VertexPageSize, len(vertex_data)),
+		                    max(self.IndexPageSize, sum(len(index_data) for index_data in index_arrays)),
+		                    index_type)
+		pages.append(page)
+		
+		return page.upload(vertex_data, index_arrays)
+		
+		
+	def free(self, allocation):
+		# type: (GeometryAllocation) -> None
+		""" Returns the allocation's ranges to its page, for reuse by later meshes. """
+		allocation.page.free(allocation)
+		
+		
+	def setInstances(self, instance_data):
+		# type: (ndarray) -> None
+		""" Replaces the contents of the instance buffer. """
+		glBindBuffer(GL_ARRAY_BUFFER, self.instanceBuf)
+		glBufferData(GL_ARRAY_BUFFER, instance_data.nbytes, instance_data, GL_STREAM_DRAW)
+		self.instanceBytes = instance_data.nbytes
+		
+		
+	def unbind(self):
+		glBindVertexArray(0)
+		self.boundPage = None
+		
+		
+		
+def draw_meshes(meshes, lod=0):
+	# type: (List[Mesh], int) -> None
+	"""
+	Draws each of the meshes, which must all have been uploaded, with as few
+	calls as possible.  Consecutive meshes from the same page are drawn with a
+	single multi-draw call, so callers should group meshes by page where they
+	can.
+	
+	\param lod  The level of detail to draw each mesh at.
+	"""
+	i = 0
+	while i < len(meshes):
+		page = meshes[i].page
+		j = i + 1
+		while j < len(meshes) and meshes[j].page is page:
+			j += 1
+		
+		page.bind()
+		
+		if j - i == 1:
+			meshes[i].draw(lod)
+		else:
+			ranges = [mesh.lodRange(lod) for mesh in meshes[i:j]]
+			glMultiDrawElementsBaseVertex(GL_TRIANGLES,
+			                              array([count for offset, count in ranges], dtype='int32'),
+			                              page.indexType,
+			                              (c_void_p * len(ranges))(*[offset for offset, count in ranges]),
+			                              len(ranges),
+			                              array([mesh.allocation.baseVertex for mesh in meshes[i:j]], dtype='int32'))
+		
+		i = j
@@ -0,0 +1,115 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from numpy import zeros, int32, uint64
+from OpenGL.GL import *
+
+
+
+class GpuTimers(object):
+	"""
+	Times the passes of each frame on the GPU, with GL_TIME_ELAPSED queries.
+	
+	Each frame's queries are kept in a ring of Latency frames, and are only read
+	when the ring comes back round to the frame, by which time the GPU has
+	normally finished it, so reading them doesn't stall the pipeline.  If it
+	hasn't, the frame's results are dropped rather than waited for.  The results
+	are therefore Latency frames late.
+	
+	Time elapsed queries can't overlap, so neither can passes.  A pass may be
+	timed several times in a frame, its times are added together.  Only change
+	enabled between frames.
+	"""
+	
+	# the number of frames a frame's results are read after it
+	Latency = 3
+	
+	# queries are created this many at a time
+	QueryBlock = 16
+	
+	def __init__(self):
+		# timing can be turned off, in which case begin and end do nothing
+		self.enabled = True
+		
+		# the GPU time of each pass of the most recent frame whose results have
+		# been read, in seconds, and the number of that frame
+		self.times = {}
+		self.resultFrame = None
+		
+		# the number of the frame being timed
+		self.frame = 0
+		
+		# the (pass name, query) of each timed pass of each frame of the ring
+		self._ring = [[] for i in range(self.Latency)]
+		self._freeQueries = []
+		
+		self._available = zeros(1, dtype=int32)
+		self._result = zeros(1, dtype=uint64)
+	
+	
+	def beginFrame(self):
+		""" Reads the results of the frame Latency frames ago, whose queries are then reused by this one. """
+		queries = self._ring[self.frame % len(self._ring)]
+		if not queries:
+			return
+		
+		times = {}
+		for name, query in queries:
+			glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, self._available)
+			if not self._available[0]:
+				times = None
+				break
+			
+			glGetQueryObjectui64v(query, GL_QUERY_RESULT, self._result)
+			times[name] = times.get(name, 0.) + self._result[0] * 1e-9
+		
+		if times is not None:
+			self.times = times
+			self.resultFrame = self.frame - self.Latency
+		
+		self._freeQueries.extend(query for name, query in queries)
+		del queries[:]
+	
+	
+	def endFrame(self):
+		self.frame += 1
+	
+	
+	def begin(self, name):
+		# type: (str) -> None
+		""" Starts timing a pass, which lasts until end() is called. """
+		if not self.enabled:
+			return
+		
+		if not self._freeQueries:
+			self._freeQueries = [int(query) for query in glGenQueries(self.QueryBlock)]
+		
+		query = self._freeQueries.pop()
+		self._ring[self.frame % len(self._ring)].append((name, query))
+		glBeginQuery(GL_TIME_ELAPSED, query)
+	
+	
+	def end(self):
+		if self.enabled:
+			glEndQuery(GL_TIME_ELAPSED)
@@ -0,0 +1,205 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from ctypes import c_int, byref
+from numpy import empty, uint8
+from OpenGL.GL import *
+
+
+
+def _attributes(*values):
+	""" An attribute list for EGL or OSMesa, terminated by the last value. """
+	return (c_int * len(values))(*values)
+
+
+
+class HeadlessWindow(object):
+	"""
+	Stands in for a window where there is no display.  It creates an OpenGL 3.3
+	core context through EGL or OSMesa, which has no default framebuffer to draw
+	to, and an offscreen framebuffer of a fixed size that the renderer draws
+	into instead.
+	
+	PyOpenGL must have been imported for the same platform, with
+	PYOPENGL_PLATFORM set, which the config module does when the config selects
+	headless mode.  Only the parts of the window interface that the renderer and
+	the event dispatch use are provided.
+	"""
+	
+	should_close = False
+	
+	def __init__(self, width, height, samples=0, platform='egl'):
+		# type: (int, int, int, str) -> None
+		"""
+		\param samples   The number of samples per pixel of the framebuffer.
+		\param platform  'egl' or 'osmesa'.
+		"""
+		self.size = (width, height)
+		self.samples = samples
+		
+		if platform == 'egl':
+			self._createEglContext()
+		elif platform == 'osmesa':
+			self._createOsmesaContext()
+		else:
+			raise ValueError("Unknown headless platform: "+platform)
+		
+		# the framebuffer drawn into, and the one it is resolved into if it is
+		# multisampled
+		self.framebuffer = self._createFramebuffer(samples)
+		self._resolveBuffer = self._createFramebuffer(0) if samples else self.framebuffer
+	
+	
+	def _createEglContext(self):
+		from OpenGL import EGL
+		
+		self._display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+		major, minor = EGL.EGLint(), EGL.EGLint()
+		if not EGL.eglInitialize(self._display, byref(major), byref(minor)):
+			raise RuntimeError("Failed to initialise EGL")
+		
+		config = EGL.EGLConfig()
+		num_configs = EGL.EGLint()
+		EGL.eglChooseConfig(self._display,
+		                    _attributes(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+		                                EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+		                                EGL.EGL_NONE),
+		                    byref(config), 1, byref(num_configs))
+		if num_configs.value == 0:
+			raise RuntimeError("No EGL config supports desktop OpenGL")
+		
+		EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+		
+		# nothing is drawn to the surface, it is only needed to make the context
+		# current
+		self._surface = EGL.eglCreatePbufferSurface(self._display, config,
+		                                            _attributes(EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE))
+		
+		self._context = EGL.eglCreateContext(self._display, config, EGL.EGL_NO_CONTEXT,
+		                                     _attributes(EGL.EGL_CONTEXT_MAJOR_VERSION, 3,
+		                                                 EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+		                                                 EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+		                                                 EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+		                                                 EGL.EGL_NONE))
+		if not self._context:
+			raise RuntimeError("Failed to create an OpenGL 3.3 context through EGL")
+		
+		if not EGL.eglMakeCurrent(self._display, self._surface, self._surface, self._context):
+			raise RuntimeError("Failed to make the EGL context current")
+	
+	
+	def _createOsmesaContext(self):
+		from OpenGL import osmesa
+		
+		self._context = osmesa.OSMesaCreateContextAttribs(
+			_attributes(osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+			            osmesa.OSMESA_DEPTH_BITS, 24,
+			            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+			            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+			            osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+			            0),
+			None)
+		if not self._context:
+			raise RuntimeError("Failed to create an OpenGL 3.3 context through OSMesa")
+		
+		# OSMesa contexts always have a buffer in client memory, but as with EGL
+		# nothing is drawn to it
+		self._buffer = empty((1, 1, 4), dtype=uint8)
+		if not osmesa.OSMesaMakeCurrent(self._context, self._buffer, GL_UNSIGNED_BYTE, 1, 1):
+			raise RuntimeError("Failed to make the OSMesa context current")
+	
+	
+	def _createFramebuffer(self, samples):
+		# type: (int) -> int
+		width, height = self.size
+		
+		framebuffer = glGenFramebuffers(1)
+		glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+		
+		for internal_format, attachment in ((GL_RGBA8, GL_COLOR_ATTACHMENT0),
+		                                    (GL_DEPTH24_STENCIL8, GL_DEPTH_STENCIL_ATTACHMENT)):
+			renderbuffer = glGenRenderbuffers(1)
+			glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+			glRenderbufferStorageMultisample(GL_RENDERBUFFER, samples, internal_format, width, height)
+			glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+		
+		if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+			raise RuntimeError("Failed to create the offscreen framebuffer")
+		
+		return framebuffer
+	
+	
+	def make_current(self):
+		""" The context is made current when it is created. """
+		pass
+	
+	
+	def swap_buffers(self):
+		"""
+		Resolves the multisampled framebuffer, as presenting a window's would, and
+		flushes the frame's commands.
+		"""
+		if self.samples:
+			self._resolve()
+		glFlush()
+	
+	
+	def _resolve(self):
+		width, height = self.size
+		glBindFramebuffer(GL_READ_FRAMEBUFFER, self.framebuffer)
+		glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self._resolveBuffer)
+		glBlitFramebuffer(0, 0, width, height, 0, 0, width, height, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+	
+	
+	def readPixels(self):
+		# type: () -> numpy.ndarray
+		"""
+		Reads back the last frame, for checking or saving the output.
+		
+		\return The RGBA pixels, of shape (height, width, 4), top row first.
+		"""
+		width, height = self.size
+		
+		glBindFramebuffer(GL_READ_FRAMEBUFFER, self._resolveBuffer)
+		glPixelStorei(GL_PACK_ALIGNMENT, 1)
+		image = empty((height, width, 4), dtype=uint8)
+		glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE, image)
+		
+		# OpenGL's rows start at the bottom
+		return image[::-1]
+	
+	
+	# there are no events without a display
+	
+	def set_window_size_callback(self, callback):
+		pass
+	
+	def set_key_callback(self, callback):
+		pass
+	
+	def set_mouse_button_callback(self, callback):
+		pass
+	
+	def set_cursor_pos_callback(self, callback):
+		pass
@@ -0,0 +1,285 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from math import tan, log
+from sets import Set
+from numpy import array, zeros, empty, arange, linspace, sqrt, maximum, repeat, flatnonzero, bincount, cumsum, newaxis, dtype
+from OpenGL.GL import *
+
+
+
+# Layout of a single light in the light data texture buffer, two RGBA texels.
+ClusteredLightDtype = dtype([('position',  'f4', 3),
+                             ('amplitude', 'f4'),
+                             ('colour',    'f4', 3),
+                             ('radius',    'f4')])
+
+
+
+def influence_radii(colours, amplitudes, cutoff):
+	# type: (ndarray, ndarray, float) -> ndarray
+	"""
+	Solves the point light attenuation used by the fragment shader,
+	colour/((0.1/a)*r*r + (1/(a*a))*r + 1), for the distance at which each
+	light's brightest channel falls to \p cutoff.  Specular light is scaled by
+	the amplitude as well, so the brighter of the two is used.
+	
+	\param colours     (N, 3) array of light colours.
+	\param amplitudes  (N) array of light amplitudes.
+	\return (N) array of radii, beyond which each light can be ignored.
+	"""
+	a = maximum(amplitudes, 1e-6)
+	k = colours.max(axis=1)*maximum(a, 1.)/cutoff
+	
+	qa = 0.1/a
+	qb = 1./(a*a)
+	qc = 1. - k
+	
+	return maximum((sqrt(qb*qb - 4.*qa*qc) - qb)/(2.*qa), 0.)
+
+
+
+class ClusteredPointLight(object):
+	"""
+	A point light held by a LightClusters instance, with the same interface as
+	PointLight.
+	"""
+	
+	def __init__(self, clusters, index):
+		self._clusters = clusters
+		self._data = clusters.data[index:index+1]
+		self.index = index
+		self.enable()
+	
+	
+	def _set(self, field, value):
+		self._data[field] = value
+		self._clusters.dirty = True
+	
+	
+	def setAmplitude(self, a):
+		self._set('amplitude', a)
+	
+	def setColour(self, c):
+		self._set('colour', array(c))
+	
+	def setPosition(self, p):
+		self._set('position', array(p))
+	
+	
+	def enable(self):
+		self._clusters.enabled[self.index] = True
+	
+	def disable(self):
+		self._clusters.enabled[self.index] = False
+
+
+
+class LightClusters(object):
+	"""
+	Point lights which are assigned each frame to clusters: the cells of a grid
+	dividing the camera's view frustum into screen space tiles across, and
+	exponentially spaced slices in depth.  Each fragment then only shades the
+	lights of its own cluster, read from three texture buffers:
+	-	the light data, two RGBA texels per light
+	- the grid, an (offset, count) pair per cluster into the index list
+	- the index list, holding the lights of each cluster in turn
+	
+	A light is assigned to every cluster its sphere of influence overlaps.  The
+	test is made separately for the columns, rows and slices of the grid, which
+	is conservative, giving a box of clusters per light.  Everything is
+	vectorised over all of the lights at once.
+	"""
+	
+	GridX = 16
+	GridY = 9
+	GridZ = 24
+	
+	MaxLights = 1024
+	
+	# the fraction of a light's full brightness below which it is ignored
+	Cutoff = 1./256.
+	
+	def __init__(self):
+		self.data = zeros(self.MaxLights, dtype=ClusteredLightDtype)
+		self.enabled = zeros(self.MaxLights, dtype=bool)
+		self.dirty = True
+		
+		self._indexPool = Set(range(self.MaxLights))
+		
+		self.numClusters = self.GridX*self.GridY*self.GridZ
+		
+		# the grid and index list are replaced every frame, the light data only
+		# when a light changes
+		self.lightBuffer, self.gridBuffer, self.indexBuffer = glGenBuffers(3)
+		self.lightTexture, self.gridTexture, self.indexTexture = glGenTextures(3)
+		
+		for buf, texture, internal_format, size, usage in (
+		    (self.lightBuffer, self.lightTexture, GL_RGBA32F, self.data.nbytes,  GL_DYNAMIC_DRAW),
+		    (self.gridBuffer,  self.gridTexture,  GL_RG32UI,  self.numClusters*8, GL_STREAM_DRAW),
+		    (self.indexBuffer, self.indexTexture, GL_R32UI,   4,                  GL_STREAM_DRAW)):
+			glBindBuffer(GL_TEXTURE_BUFFER, buf)
+			glBufferData(GL_TEXTURE_BUFFER, size, None, usage)
+			glBindTexture(GL_TEXTURE_BUFFER, texture)
+			glTexBuffer(GL_TEXTURE_BUFFER, internal_format, buf)
+		
+		glBindTexture(GL_TEXTURE_BUFFER, 0)
+		
+		# maps a view depth to its slice, slice = log(depth)*depthScale + depthBias
+		self.depthScale = 0.
+		self.depthBias = 0.
+		
+		self.numIndices = 0
+		
+		
+	def __del__(self):
+		glDeleteBuffers(3, [self.lightBuffer, self.gridBuffer, self.indexBuffer])
+		glDeleteTextures([self.lightTexture, self.gridTexture, self.indexTexture])
+		
+		
+	def getLight(self):
+		# type: () -> ClusteredPointLight
+		if not self._indexPool:
+			raise Exception("No clustered lights left, the maximum is %d." % self.MaxLights)
+		
+		return ClusteredPointLight(self, self._indexPool.pop())
+		
+		
+	def releaseLight(self, light):
+		# type: (ClusteredPointLight) -> None
+		if light.index in self._indexPool:
+			raise Exception("Attempt to release light already in pool.")
+		light.disable()
+		self._indexPool.add(light.index)
+		
+		
+	def assign(self, camera_matrix, fov, aspect, near, far):
+		# type: (ndarray, float, float, float, float) -> Tuple[ndarray, ndarray]
+		"""
+		Finds the clusters overlapped by each enabled light.
+		
+		\param camera_matrix  The camera's world to view space matrix.
+		\param fov            (rad) The camera's field of view in the y direction.
+		\param aspect         The camera's aspect ratio, width/height.
+		\param near           Distance from the camera to the near side of the grid.
+		\param far            Distance from the camera to the far side of the grid.
+		\return The grid, a (numClusters, 2) array of offsets and counts, and the
+		        index list.
+		"""
+		active = flatnonzero(self.enabled)
+		
+		lights = self.data[active]
+		radii = lights['radius'][:, newaxis]
+		centres = lights['position'].dot(camera_matrix[0:3, 0:3]) + camera_matrix[3, 0:3]
+		depths = -centres[:, 2:3]
+		
+		# distances of each light from the planes bounding the columns and rows,
+		# which pass through the camera at the tiles' edges, and from the slices'
+		# boundaries
+		edges_x = linspace(-1., 1., self.GridX+1)*tan(fov/2.)*aspect
+		edges_y = linspace(-1., 1., self.GridY+1)*tan(fov/2.)
+		edges_z = near*(float(far)/near)**(arange(self.GridZ+1)/float(self.GridZ))
+		
+		distances_x = (centres[:, 0:1] - edges_x*depths)/sqrt(1. + edges_x*edges_x)
+		distances_y = (centres[:, 1:2] - edges_y*depths)/sqrt(1. + edges_y*edges_y)
+		distances_z = depths - edges_z
+		
+		in_x = (distances_x[:, :-1] > -radii) & (distances_x[:, 1:] < radii)
+		in_y = (distances_y[:, :-1] > -radii) & (distances_y[:, 1:] < radii)
+		in_z = (distances_z[:, :-1] > -radii) & (distances_z[:, 1:] < radii)
+		
+		# each light covers the box of clusters between its first and last
+		# overlapped column, row and slice
+		first_x, num_x = self._span(in_x)
+		first_y, num_y = self._span(in_y)
+		first_z, num_z = self._span(in_z)
+		
+		# enumerate every (cluster, light) pair, box by box
+		box_sizes = num_x*num_y*num_z
+		pair_lights = repeat(arange(len(active), dtype='int32'), box_sizes)
+		
+		i = arange(box_sizes.sum(), dtype='int32') - repeat(cumsum(box_sizes) - box_sizes, box_sizes)
+		row_size = num_x[pair_lights]
+		
+		x = first_x[pair_lights] + i % row_size
+		y = first_y[pair_lights] + (i // row_size) % num_y[pair_lights]
+		z = first_z[pair_lights] + i // (row_size*num_y[pair_lights])
+		clusters = (z*self.GridY + y)*self.GridX + x
+		
+		# a stable sort of small integers is a radix sort, so grouping the pairs
+		# by cluster is linear in their number
+		order = clusters.astype('uint16').argsort(kind='mergesort')
+		light_indices = pair_lights[order]
+		
+		counts = bincount(clusters, minlength=self.numClusters)
+		
+		grid = empty((self.numClusters, 2), dtype='uint32')
+		grid[:, 0] = cumsum(counts) - counts
+		grid[:, 1] = counts
+		
+		return grid, active[light_indices].astype('uint32')
+		
+		
+	@staticmethod
+	def _span(overlaps):
+		# type: (ndarray) -> Tuple[ndarray, ndarray]
+		"""
+		\param overlaps  (lights, cells) boolean array.
+		\return The index of each light's first overlapped cell, and the number of
+		        cells from there to its last, or zero if it overlaps none.
+		"""
+		num_cells = overlaps.shape[1]
+		first = overlaps.argmax(axis=1)
+		last = num_cells - 1 - overlaps[:, ::-1].argmax(axis=1)
+		
+		return first.astype('int32'), ((last - first + 1)*overlaps.any(axis=1)).astype('int32')
+		
+		
+	def update(self, camera_matrix, fov, aspect, near, far):
+		# type: (ndarray, float, float, float, float) -> None
+		""" Assigns the lights to clusters for the frame and uploads the results. """
+		
+		if self.dirty:
+			self.data['radius'] = influence_radii(self.data['colour'], self.data['amplitude'], self.Cutoff)
+			
+			glBindBuffer(GL_TEXTURE_BUFFER, self.lightBuffer)
+			glBufferSubData(GL_TEXTURE_BUFFER, 0, self.data.nbytes, self.data)
+			self.dirty = False
+		
+		grid, indices = self.assign(camera_matrix, fov, aspect, near, far)
+		
+		glBindBuffer(GL_TEXTURE_BUFFER, self.gridBuffer)
+		glBufferData(GL_TEXTURE_BUFFER, grid.nbytes, grid, GL_STREAM_DRAW)
+		
+		# an empty buffer can't back a texture, so keep at least one index
+		if not len(indices):
+			indices = zeros(1, dtype='uint32')
+		
+		glBindBuffer(GL_TEXTURE_BUFFER, self.indexBuffer)
+		glBufferData(GL_TEXTURE_BUFFER, indices.nbytes, indices, GL_STREAM_DRAW)
+		
+		self.numIndices = int(grid[:, 1].sum())
+		
+		self.depthScale = self.GridZ/log(float(far)/near)
+		self.depthBias = -log(near)*self.depthScale
@@ -22,7 +22,9 @@
 #                                                                             #
 #=============================================================================#
 
-from numpy import array, zeros, identity, cross
+from math import ceil
+from sets import Set
+from numpy import array, array_equal, zeros, identity, cross, floor, dtype
 from numpy.linalg import norm
 from OpenGL.GL import *
 
@@ -35,18 +37,90 @@ class LightType:
 	Point       = 2
 
 
+# Number of shadow map cascades of each directional light, the shaders are
+# built with the same number.
+NumShadowCascades = 3
+
+
+# Layouts matching the std140 LightBlock uniform block in the shaders.  The
+# members are ordered so that little padding is needed, std140 rounds the size
+# of a struct up to a multiple of 16 bytes.
+AmbientLightDtype = dtype([('colour',    'f4', 3),
+                           ('amplitude', 'f4')])
+
+IndexedLightDtype = dtype([('vector',      'f4', 3),
+                           ('amplitude',   'f4'),
+                           ('colour',      'f4', 3),
+                           ('type',        'i4'),
+                           ('shadowIndex', 'i4'),
+                           ('padding',     'i4', 3)])
+
+# One per shadow map, i.e. per layer of the shadow map array.  Only lights
+# which cast shadows are given one.
+ShadowDtype = dtype([('viewMatrix',    'f4', (4, 4)),
+                     ('cascadeScale',  'f4', (NumShadowCascades, 4)),
+                     ('cascadeOffset', 'f4', (NumShadowCascades, 4)),
+                     ('cascadeRect',   'f4', (NumShadowCascades, 4))])
+
+
+class LightBlock(object):
+	"""
+	The state of all lights, held in a NumPy structured array with the layout of
+	the LightBlock uniform block and backed by a uniform buffer object.  Lights
+	write into the array, and the whole block is uploaded in one call when any of
+	it has changed.
+	"""
+	
+	def __init__(self, num_lights, num_shadows, binding_point=0):
+		self.data = zeros((), dtype=dtype([('ambient', AmbientLightDtype),
+		                                   ('lights',  IndexedLightDtype, (num_lights,)),
+		                                   ('shadows', ShadowDtype, (num_shadows,))]))
+		self.ambient = self.data['ambient']
+		self.lights  = self.data['lights']
+		self.shadows = self.data['shadows']
+		
+		self.ambient['colour'] = (1., 1., 1.)
+		self.lights['shadowIndex'] = -1
+		
+		self.bindingPoint = binding_point
+		self.buffer = glGenBuffers(1)
+		
+		glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+		glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+		glBindBufferBase(GL_UNIFORM_BUFFER, self.bindingPoint, self.buffer)
+		
+		self.dirty = True
+	
+	
+	def __del__(self):
+		glDeleteBuffers(1, [self.buffer])
+	
+	
+	def upload(self):
+		""" Uploads the block to its buffer, if it has changed since the last upload. """
+		if self.dirty:
+			glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+			glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+			self.dirty = False
+
+
 class AmbientLight(object):
 
-	def __init__(self, amplitude_binding, colour_binding):
-		self._amplitude = amplitude_binding
-		self._colour    = colour_binding
+	def __init__(self, light_block):
+		self._block = light_block
+		self._data  = light_block.ambient
+	
+	
+	def _set(self, field, value):
+		self._data[field] = value
+		self._block.dirty = True
 	
 	
 	def setAmplitude(self, a):
-		self._amplitude.set(a)
+		self._set('amplitude', a)
 	
 	def setColour(self, c):
-		self._colour.set(array(c))
+		self._set('colour', array(c))
 		
 
 
@@ -54,81 +128,198 @@ class IndexedLight(AmbientLight):
 
 	ShadowMappingEnabled = False
 	
-	def __init__(self, type_binding, amplitude_binding, colour_binding, index):
-		super(IndexedLight, self).__init__(amplitude_binding, colour_binding)
-		self._type = type_binding
+	def __init__(self, light_block, index):
+		super(IndexedLight, self).__init__(light_block)
+		self._data = light_block.lights[index:index+1]
 		self.index = index
+		
+		# the light's layer of the shadow map array, if it has one
+		self.shadowIndex = None
 	
 	def enable(self):
 		raise NotImplementedError("Abstract method")
 	
 	def disable(self):
-		self._type.set(LightType.Disabled)
+		self._set('type', LightType.Disabled)
+
+
+
+class ShadowMapArray(object):
+	"""
+	The shadow maps of all lights, held as the layers of a single depth texture
+	array so that the shaders sample them all through one texture unit.  Lights
+	which cast shadows are given the lowest free layer, so that the shaders only
+	need to handle as many shadow maps as are in use.
+	"""
+	
+	def __init__(self, width, height, num_layers):
+		self.width  = width
+		self.height = height
+		self.numLayers = num_layers
+		
+		self._freeLayers = Set(range(num_layers))
+		
+		self.texture = glGenTextures(1)
+		
+		glBindTexture(GL_TEXTURE_2D_ARRAY, self.texture)
+		glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_DEPTH_COMPONENT,
+		             width, height, num_layers, 0, GL_DEPTH_COMPONENT,
+		             GL_FLOAT, None)
+		
+		glTexParameter(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+		glTexParameter(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+		glTexParameter(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_BORDER)
+		glTexParameter(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_BORDER)
+		glTexParameter(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_BORDER_COLOR, array([1.,1.,1.,1.]))
+	
+	
+	def __del__(self):
+		glDeleteTextures([self.texture])
+	
+	
+	def allocate(self):
+		# type: () -> Optional[int]
+		""" \return The lowest free layer, or None if all are in use. """
+		if not self._freeLayers:
+			return None
+		
+		layer = min(self._freeLayers)
+		self._freeLayers.remove(layer)
+		return layer
+	
+	
+	def free(self, layer):
+		# type: (int) -> None
+		self._freeLayers.add(layer)
+
+
+
+class ShadowCascade(object):
+	"""
+	One cascade of a directional light's shadow map, a square region of the
+	light's shadow atlas covering a slice of the camera frustum.  The cascade's
+	projection is an orthographic box in the light's view space, given as a
+	scale and offset which the shaders apply per fragment.
+	"""
+	
+	def __init__(self, index, x, y, resolution, interval):
+		self.index = index
+		self.x = x
+		self.y = y
+		self.resolution = resolution
+		self.interval = interval
+		
+		self.scale  = zeros(3)
+		self.offset = zeros(3)
+		
+		# world space to the cascade's clip space, for rendering the cascade
+		self.matrix = identity(4)
+		
+		# incremented whenever the matrix changes
+		self.version = 0
+		self.lightVersion = None
+	
+	
+	def due(self, frame, light_version):
+		# type: (int, int) -> bool
+		"""
+		\return True if the cascade should be fitted and rendered on \p frame.
+		        Cascades with the same interval are updated on different frames.
+		"""
+		return light_version != self.lightVersion or frame % self.interval == self.index % self.interval
 
 
 
 class DirectionalLight(IndexedLight):
+	"""
+	A light shining in a single direction, with a cascaded shadow map.  The
+	cascades are packed side by side into the light's layer of the shadow map
+	array, its shadow atlas, each with its own resolution and update interval in
+	frames.  If every layer is taken, or ShadowMappingEnabled is cleared, the
+	light casts no shadows.
+	"""
 	
 	ShadowMappingEnabled = True
-	ShadowResolutionX = 2048
-	ShadowResolutionY = 2048
-	
-	def __init__(self, type_binding,
-	                   amplitude_binding,
-	                   colour_binding,
-	                   direction_binding,
-	                   matrix_binding,
-	                   shadow_map_binding,
-	                   index):
-		super(DirectionalLight, self).__init__(type_binding, amplitude_binding, colour_binding, index)
-		self._direction = direction_binding
-		self._matrixBinding = matrix_binding
-		
-		self._type.set(LightType.Directional)
+	
+	# one entry per cascade, nearest first
+	CascadeResolutions = (1024, 1024, 512)
+	CascadeIntervals   = (1, 2, 4)
+	
+	# how far the cascades reach from the camera, and how the splits between
+	# them are placed: 0 spaces them evenly, 1 logarithmically
+	ShadowDistance = 50.
+	CascadeSplitWeight = 0.6
+	
+	def __init__(self, light_block, shadow_maps, index):
+		super(DirectionalLight, self).__init__(light_block, index)
+		
+		self._set('type', LightType.Directional)
 		self._directionVec = array([0., 0., -1.])
 		self._lightViewMatrix = identity(4)
 		
-		self.matrix = identity(4)
+		self.viewMatrix = identity(4)
 		
-		# create depth buffer for shadow calculations
-		self.depthBuffer  = glGenFramebuffers(1)
-		self.depthTexture = glGenTextures(1)
+		# incremented whenever the view matrix changes, so that the cascades and
+		# cached shadow maps can tell when they are out of date
+		self.version = 0
 		
-		glBindTexture(GL_TEXTURE_2D, self.depthTexture)
-		glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT,
-		             self.ShadowResolutionX, self.ShadowResolutionY, 0, GL_DEPTH_COMPONENT,
-		             GL_FLOAT, None)
+		self.atlasWidth  = sum(self.CascadeResolutions)
+		self.atlasHeight = max(self.CascadeResolutions)
 		
-		self._shadowMapBinding = shadow_map_binding
+		self._shadowMaps = shadow_maps
+		if self.ShadowMappingEnabled:
+			self.shadowIndex = shadow_maps.allocate()
+		self.depthBuffer = None
 		
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_BORDER)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_BORDER)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_BORDER_COLOR, array([1.,1.,1.,1.]))
+		self.cascades = []
+		x = 0
+		for i, (resolution, interval) in enumerate(zip(self.CascadeResolutions, self.CascadeIntervals)):
+			self.cascades.append(ShadowCascade(i, x, 0, resolution, interval))
+			x += resolution
 		
-		glBindFramebuffer(GL_FRAMEBUFFER, self.depthBuffer)
-		glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, self.depthTexture, 0)
-		glDrawBuffer(GL_NONE)
-		glReadBuffer(GL_NONE)
-		glBindFramebuffer(GL_FRAMEBUFFER, 0)
+		if self.shadowIndex is not None:
+			self._shadowData = light_block.shadows[self.shadowIndex:self.shadowIndex+1]
+			self._set('shadowIndex', self.shadowIndex)
+			
+			for cascade in self.cascades:
+				self._shadowData['cascadeRect'][0, cascade.index] = (float(cascade.x)/shadow_maps.width, 0.,
+				                                                    float(cascade.resolution)/shadow_maps.width,
+				                                                    float(cascade.resolution)/shadow_maps.height)
+			
+			# render shadow calculations into the light's layer
+			self.depthBuffer = glGenFramebuffers(1)
+			glBindFramebuffer(GL_FRAMEBUFFER, self.depthBuffer)
+			glFramebufferTextureLayer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, shadow_maps.texture, 0, self.shadowIndex)
+			glDrawBuffer(GL_NONE)
+			glReadBuffer(GL_NONE)
+			glBindFramebuffer(GL_FRAMEBUFFER, 0)
+	
+	
+	def releaseShadowMap(self):
+		""" Returns the light's layer to the shadow map array, it casts no shadows afterwards. """
+		if self.shadowIndex is not None:
+			glDeleteFramebuffers(1, [self.depthBuffer])
+			self._shadowMaps.free(self.shadowIndex)
+			self._set('shadowIndex', -1)
+			self.shadowIndex = None
+			self.depthBuffer = None
 
 	
 	def enable(self):
-		self._type.set(LightType.Directional)
+		self._set('type', LightType.Directional)
 	
 	
 	def setDirection(self, d):
 		self._directionVec = array(d)/norm(d)
-		self._direction.set(self._directionVec)
+		self._set('vector', self._directionVec)
 		
 		f = self._directionVec
 		s = cross(f, array([0.,1.,0.]))
+		s /= norm(s)
 		u = cross(s, f)
 		
-		# fixme - make this follow the camera, currently centered on 0,0,0 
-		pos = -f*20
-
+		# the view matrix only orients the light, the cascades are placed around
+		# the camera by fitCascade
 		self._lightViewMatrix[0,0] =  s[0]
 		self._lightViewMatrix[1,0] =  s[1]
 		self._lightViewMatrix[2,0] =  s[2]
@@ -138,35 +329,76 @@ class DirectionalLight(IndexedLight):
 		self._lightViewMatrix[0,2] = -f[0]
 		self._lightViewMatrix[1,2] = -f[1]
 		self._lightViewMatrix[2,2] = -f[2]
-		self._lightViewMatrix[3,0] = -s.dot(pos)
-		self._lightViewMatrix[3,1] = -u.dot(pos)
-		self._lightViewMatrix[3,2] =  f.dot(pos)
-		self.matrix = self._lightViewMatrix.dot(m_orthographic(-10., 10., -10., 10., 1., 40.))
+		self.viewMatrix = array(self._lightViewMatrix)
+		
+		if self.shadowIndex is not None:
+			self._shadowData['viewMatrix'] = self.viewMatrix
+			self._block.dirty = True
+		self.version += 1
+		
+		
+	def fitCascade(self, cascade, corners):
+		# type: (ShadowCascade, ndarray) -> None
+		"""
+		Fits the cascade's box around a slice of the camera frustum.  The box
+		bounds the slice's bounding sphere, so its size doesn't change as the
+		camera turns, and it is moved in whole texel steps, so that shadow edges
+		don't shimmer as the camera moves.
+		
+		\param corners  (8, 3) array of the slice's corners in world space.
+		"""
+		centre = corners.mean(axis=0)
+		radius = norm(corners - centre, axis=1).max()
+		
+		# round the radius up, so floating point error can't change it frame to frame
+		radius = ceil(radius*16.)/16.
 		
-		self._matrixBinding.set(self.matrix)
+		centre = centre.dot(self.viewMatrix[:3,:3]) + self.viewMatrix[3,:3]
+		
+		# depth is snapped too, so that the box only changes once the camera has
+		# moved by a whole texel
+		texel_size = 2.*radius/cascade.resolution
+		centre = floor(centre/texel_size)*texel_size
+		
+		# the light looks down -z, so the near side of the box has the larger z
+		scale  = array([1., 1., -1.])/radius
+		offset = array([-centre[0], -centre[1], centre[2]])/radius
+		
+		if (cascade.lightVersion == self.version and
+		    array_equal(scale, cascade.scale) and array_equal(offset, cascade.offset)):
+			return
+		
+		cascade.lightVersion = self.version
+		cascade.scale  = scale
+		cascade.offset = offset
+		
+		projection = identity(4)
+		projection[[0, 1, 2], [0, 1, 2]] = scale
+		projection[3, :3] = offset
+		cascade.matrix = self.viewMatrix.dot(projection)
+		cascade.version += 1
+		
+		self._shadowData['cascadeScale'][0, cascade.index, :3]  = scale
+		self._shadowData['cascadeOffset'][0, cascade.index, :3] = offset
+		self._block.dirty = True
 		
 		
 	def rotate(self, r):
 		pass # fixme
-	
-	
-	def setShadowMap(self):
-		self._shadowMapBinding.set(self.depthTexture)
 
 
 
 class PointLight(IndexedLight):
 	
-	def __init__(self, type_binding, position_binding, amplitude_binding, colour_binding, index):
-		super(PointLight, self).__init__(type_binding, amplitude_binding, colour_binding, index)
-		self._position = position_binding
-		self._type.set(LightType.Point)
+	def __init__(self, light_block, index):
+		super(PointLight, self).__init__(light_block, index)
+		self._set('type', LightType.Point)
 		
 	
 	def enable(self):
-		self._type.set(LightType.Point)
+		self._set('type', LightType.Point)
 	
 	
 	def setPosition(self, p):
-		self._position.set(array(p))
+		self._set('vector', array(p))
 	
\ No newline at end of file
@@ -0,0 +1,175 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from numpy import array, asarray, zeros, ones, floor, cross, einsum, lexsort, concatenate, \
+                  clip, tan, unique, argmin, roll, add
+from numpy.linalg import norm
+
+
+
+def simplify_indices(positions, indices, cell_size):
+	# type: (ndarray, ndarray, float) -> ndarray
+	"""
+	Simplifies a triangle mesh by vertex clustering.  Space is divided into
+	cubic cells and every vertex in a cell is merged into one representative,
+	which is the vertex of the cell with the least quadric error: the sum of
+	squared distances to the planes of the triangles around the cell, weighted
+	by their areas.  The representative is one of the mesh's own vertices, so
+	the result indexes the same vertex data as the original.
+	
+	\param positions  (n, 3) array of vertex positions.
+	\param indices    Flat array of triangle indices into \p positions.
+	\param cell_size  The width of the cells, in the units of the positions.
+	\return Flat array of the remaining triangles' indices, of the same type as
+	        \p indices.  Triangles that collapse, or that duplicate another, are
+	        dropped.
+	"""
+	positions = asarray(positions, dtype=float)
+	triangles = asarray(indices).reshape(-1, 3)
+	
+	# the quadric of each triangle's plane, weighted by its area
+	corners = positions[triangles]
+	normals = cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+	double_areas = norm(normals, axis=1)
+	valid = double_areas > 0.
+	
+	planes = zeros((len(triangles), 4))
+	planes[valid, 0:3] = normals[valid]/double_areas[valid, None]
+	planes[:, 3] = -einsum('ni,ni->n', planes[:, 0:3], corners[:, 0])
+	triangle_quadrics = einsum('ni,nj->nij', planes, planes)*(double_areas/2.)[:, None, None]
+	
+	# each vertex gathers the quadrics of its triangles, and each cell those of
+	# its vertices
+	vertex_quadrics = zeros((len(positions), 4, 4))
+	for corner in range(3):
+		add.at(vertex_quadrics, triangles[:, corner], triangle_quadrics)
+	
+	cells = floor((positions - positions.min(axis=0))/cell_size).astype(int)
+	cell_ids, vertex_cells = unique(cells, axis=0, return_inverse=True)
+	vertex_cells = vertex_cells.reshape(-1)
+	
+	cell_quadrics = zeros((len(cell_ids), 4, 4))
+	add.at(cell_quadrics, vertex_cells, vertex_quadrics)
+	
+	homogeneous = ones((len(positions), 4))
+	homogeneous[:, 0:3] = positions
+	errors = einsum('ni,nij,nj->n', homogeneous, cell_quadrics[vertex_cells], homogeneous)
+	
+	# the first vertex of each cell, once sorted by error within the cells
+	order = lexsort((errors, vertex_cells))
+	firsts = order[concatenate(([True], vertex_cells[order][1:] != vertex_cells[order][:-1]))]
+	representatives = zeros(len(cell_ids), dtype=int)
+	representatives[vertex_cells[firsts]] = firsts
+	
+	triangles = representatives[vertex_cells[triangles]]
+	
+	collapsed = ((triangles[:, 0] == triangles[:, 1]) |
+	             (triangles[:, 1] == triangles[:, 2]) |
+	             (triangles[:, 2] == triangles[:, 0]))
+	triangles = triangles[~collapsed]
+	
+	# rotate each triangle to start from its lowest index, keeping its winding,
+	# so that duplicates compare equal
+	rotations = argmin(triangles, axis=1)
+	for rotation in (1, 2):
+		rotate = rotations == rotation
+		triangles[rotate] = roll(triangles[rotate], -rotation, axis=1)
+	
+	triangles, first_seen = unique(triangles, axis=0, return_index=True)
+	triangles = triangles[first_seen.argsort()]
+	
+	return triangles.reshape(-1).astype(asarray(indices).dtype)
+
+
+
+def generate_lods(positions, indices, cell_sizes, reduction):
+	# type: (ndarray, ndarray, Sequence[float], float) -> List[ndarray]
+	"""
+	Simplifies a mesh into levels of detail, with simplify_indices.
+	
+	\param cell_sizes  The cell size each level is simplified with, finest first.
+	\param reduction   A level is only kept if it has at most this fraction of
+	                   the indices of the previous level.
+	\return The index arrays of the levels kept, finest first.
+	"""
+	levels = []
+	previous = indices
+	
+	for cell_size in cell_sizes:
+		index_data = simplify_indices(positions, indices, cell_size)
+		if len(index_data) == 0:
+			break
+		
+		if len(index_data) <= reduction*len(previous):
+			levels.append(index_data)
+			previous = index_data
+	
+	return levels
+
+
+
+class LodSelector(object):
+	"""
+	Chooses the level of detail each entity is drawn at from its size on
+	screen: the radius of its bounding sphere over the height of the view at
+	its distance.  Each level is used below a threshold size, and an entity
+	only changes level once its size has moved past the threshold by the
+	hysteresis fraction, so that entities near a threshold don't flicker
+	between levels.
+	"""
+	
+	# the screen sizes below which levels 1, 2, ... are used
+	Thresholds = (0.25, 0.1, 0.04)
+	Hysteresis = 0.15
+	
+	def __init__(self):
+		# the level each entity was last drawn at
+		self._levels = {}
+	
+	
+	def select(self, transforms, camera_pos, fov):
+		# type: (EntityTransforms, ndarray, float) -> ndarray
+		"""
+		\param camera_pos  The camera's position in world space.
+		\param fov         (rad) The camera's field of view in the y direction.
+		\return The level of each entity of \p transforms, limited to the levels
+		        its model has.
+		"""
+		distances = norm(transforms.boundingCentres - camera_pos, axis=1)
+		sizes = transforms.boundingRadii/(distances*tan(fov/2.) + 1e-6)
+		
+		# the levels an entity may be at, higher levels being coarser
+		thresholds = array(self.Thresholds)
+		finest   = (sizes[:, None] < thresholds*(1. - self.Hysteresis)).sum(axis=1)
+		coarsest = (sizes[:, None] < thresholds*(1. + self.Hysteresis)).sum(axis=1)
+		
+		previous = array([self._levels.get(entity, 0) for entity in transforms.entities], dtype=int)
+		levels = clip(previous, finest, coarsest)
+		
+		for model, start, end in transforms.groups:
+			levels[start:end] = levels[start:end].clip(0, model.numLods - 1)
+		
+		self._levels = dict(zip(transforms.entities, levels.tolist()))
+		
+		return levels
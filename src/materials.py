@@ -22,65 +22,84 @@
 #                                                                             #
 #=============================================================================#
 
-from PIL import Image
 from numpy import array
-from OpenGL.GL import *
+
+from textures import texture_registry
 
 import sys
 
 
 class Material(object):
+	"""
+	Materials hold a reference to a texture from the texture registry, which is
+	loaded when the material is created.  That needs no GL context and so can be
+	done on any thread, the GL texture itself isn't created until it is used.
+	"""
 
-	def __init__(self, colour, texture_img=None):
+	def __init__(self, colour, texture=None):
+		# type: (Any, Optional[Texture]) -> None
+		"""
+		\param texture  A texture acquired from the registry, whose reference the
+		                material takes over, or None for an untextured material.
+		"""
 		self.colour = array(colour)
 		self.alpha = 1.
+		self.textured = texture is not None
 		
-		self.texture = glGenTextures(1)
-		glBindTexture(GL_TEXTURE_2D, self.texture)
-		
-		if texture_img != None:
-			if texture_img.mode == "RGB":
-				gl_format = GL_RGB
-			elif texture_img.mode == "RGBA":
-				gl_format = GL_RGBA
-			else:
-				raise TypeError("Texture mode "+texture_img.mode+" not supported")
-				
-			glTexImage2D(GL_TEXTURE_2D, 0, GL_BGRA,
-			             texture_img.width, texture_img.height, 0, gl_format,
-			             GL_UNSIGNED_BYTE, texture_img.tobytes())
-
-		else:
-			glTexImage2D(GL_TEXTURE_2D, 0, GL_BGRA,
-			             1, 1, 0, GL_RGB,
-			             GL_UNSIGNED_BYTE, bytearray([255,255,255]))
+		if texture is None:
+			texture = texture_registry.white()
 		
-		#glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-		#glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
-		glGenerateMipmap(GL_TEXTURE_2D)
+		self.texture = texture
+	
+	
+	def upload(self):
+		""" Creates the GL texture now, rather than when the material is first drawn. """
+		texture_registry.use(self.texture)
+	
+	
+	def release(self):
+		""" Releases the material's texture.  The material can't be drawn after this. """
+		if self.texture is not None:
+			texture_registry.release(self.texture)
+			self.texture = None
+	
+	
+	@property
+	def transparent(self):
+		# type: () -> bool
+		""" Transparent materials are blended, so are drawn after everything else, back to front. """
+		return self.alpha < 1.
 
 
 
-class AssimpMaterial(Material):
+class FileMaterial(Material):
+	"""
+	A material textured from an image file, shared through the texture registry.
+	If the file can't be opened the material is left untextured.
+	"""
 
-	def __init__(self, ai_mat):
-		texture_img = None
+	def __init__(self, colour, filename):
+		texture = None
 		
 		try:
-			filename = ai_mat.properties.get(('file', 1))
 			if filename:
-				texture_img = Image.open(filename)
+				texture = texture_registry.acquire(filename)
 				
 		except IOError as e:
 			sys.stderr.write(str(e)+'\n')
 			pass
 	
-		super(AssimpMaterial, self).__init__([1.,1.,1.], texture_img)
-		
-		if texture_img != None:
-			texture_img.close()
-	
\ No newline at end of file
+		super(FileMaterial, self).__init__(colour, texture)
+
+
+
+def assimp_texture_file(ai_mat):
+	# type: (pyassimp.structs.Material) -> Optional[str]
+	return ai_mat.properties.get(('file', 1))
+
+
+
+class AssimpMaterial(FileMaterial):
+
+	def __init__(self, ai_mat):
+		super(AssimpMaterial, self).__init__([1.,1.,1.], assimp_texture_file(ai_mat))
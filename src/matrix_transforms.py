@@ -30,7 +30,7 @@
 #=============================================================================#
 
 from math import sin, cos, tan
-from numpy import array, identity, zeros, ones, copyto
+from numpy import array, identity, zeros, ones, empty, copyto, cross, einsum, newaxis
 from numpy.linalg import norm
 
 
@@ -228,3 +228,60 @@ def m_orthographic(left, right, bottom, top, min_z, max_z):
 	
 	return m
 
+
+
+def m_frustum_planes(m, lower=(-1., -1., -1.), upper=(1., 1., 1.)):
+	"""
+	Extracts the six planes bounding the volume which a view-projection matrix
+	maps to the box [lower..upper] in normalized device coordinates.  By default
+	this is the whole view volume.
+	
+	Each plane is returned as a row (a, b, c, d) of a 6 * 4 array, with the
+	normal (a, b, c) normalized and pointing into the volume, so a point p is
+	inside when a*p.x + b*p.y + c*p.z + d >= 0 for every plane.  The planes are
+	in the order -x, +x, -y, +y, -z (near), +z (far).
+	
+	\param m      View-projection matrix.
+	\param lower  Lower corner of the box in normalized device coordinates.
+	\param upper  Upper corner of the box in normalized device coordinates.
+	"""
+	planes = empty((6, 4))
+	
+	for axis in range(3):
+		planes[2*axis]   = m[:, axis] - lower[axis]*m[:, 3]
+		planes[2*axis+1] = upper[axis]*m[:, 3] - m[:, axis]
+	
+	planes /= norm(planes[:, 0:3], axis=1)[:, newaxis]
+	
+	return planes
+
+
+
+def m_affine_inverse_transpose(m):
+	"""
+	Computes transpose(inv(m)) for a stack of affine 4 * 4 matrices, as used for
+	normal matrices.  The closed-form inverse of the upper 3 * 3 block is used, so
+	the whole stack is inverted in a handful of vectorised operations.
+	
+	\param m  Array of shape (..., 4, 4) of affine matrices, i.e. with the
+	          translation in the last row and (0, 0, 0, 1) in the last column.
+	"""
+	a = m[..., 0:3, 0:3]
+	t = m[..., 3, 0:3]
+	
+	r = zeros(m.shape)
+	
+	# the rows of the cofactor matrix of a are the cross products of its rows,
+	# and the inverse transpose of a is its cofactor matrix over its determinant
+	r[..., 0, 0:3] = cross(a[..., 1, :], a[..., 2, :])
+	r[..., 1, 0:3] = cross(a[..., 2, :], a[..., 0, :])
+	r[..., 2, 0:3] = cross(a[..., 0, :], a[..., 1, :])
+	
+	det = einsum('...i,...i->...', a[..., 0, :], r[..., 0, 0:3])
+	r[..., 0:3, 0:3] /= det[..., newaxis, newaxis]
+	
+	# the inverse translation ends up in the last column once transposed
+	r[..., 0:3, 3] = -einsum('...ij,...j->...i', r[..., 0:3, 0:3], t)
+	r[..., 3, 3] = 1.
+	
+	return r
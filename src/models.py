@@ -22,12 +22,15 @@
 #                                                                             #
 #=============================================================================#
 
-from numpy import array, identity, zeros, ones
+from ctypes import c_void_p
+from numpy import array, asarray, identity, zeros, ones, empty, concatenate
+from numpy.linalg import norm
 from OpenGL.GL import *
 
-import pyassimp
-
-from materials import Material, AssimpMaterial
+from materials import Material, FileMaterial
+from assets import load_scene
+from geometry import VertexDtype, index_dtype
+from lod import generate_lods
 
 from matrix_transforms import *
 
@@ -35,73 +38,136 @@ from matrix_transforms import *
 
 class Mesh(object):
 	"""
-	This object encapsulates the opengl buffers that are needed for a specific 3d
-	mesh.  These include the vertex, UV, normal and index buffers.  It also
-	provides a vertex array object for binding these in a single call.  The
+	This object holds the geometry of a specific 3d mesh, as an interleaved
+	vertex array, holding the position, UV and normal of each vertex, and an
+	index array.  The geometry is kept on the CPU until the mesh is uploaded to
+	a geometry arena, which places it within one of its shared buffers.  The
 	material is also owned by the mesh object.
+	
+	Indices are relative to the mesh's first vertex, so they are stored as 16
+	bit values where the vertex count allows, and as 32 bit values otherwise.
+	
+	A mesh may have simplified levels of detail, each a further index array over
+	the same vertices.  They are uploaded after the full index array, and any of
+	them can be drawn by passing its level to the draw methods.
 	"""
 
 	def __init__(self, vertex_buf_data, uv_buf_data, normal_buf_data, index_buf_data, material):
-		self.vao = glGenVertexArrays(1)
+		# build the interleaved buffer in place, it is then uploaded without any
+		# further copies
+		vertex_data = empty(len(vertex_buf_data)//3, dtype=VertexDtype)
+		vertex_data['position'] = asarray(vertex_buf_data).reshape(-1, 3)
+		vertex_data['uv']       = asarray(uv_buf_data).reshape(-1, 2)
+		vertex_data['normal']   = asarray(normal_buf_data).reshape(-1, 3)
+		
+		index_data = asarray(index_buf_data, dtype=index_dtype(len(vertex_data)))
 		
-		self.vertexBuf, self.uvBuf, self.normalBuf, self.indexBuf = glGenBuffers(4)
+		self._setGeometry(vertex_data, index_data, [], material)
 		
-		glBindBuffer(GL_ARRAY_BUFFER, self.vertexBuf)
-		glBufferData(GL_ARRAY_BUFFER, vertex_buf_data, GL_STATIC_DRAW)
 		
-		glBindBuffer(GL_ARRAY_BUFFER, self.uvBuf)
-		glBufferData(GL_ARRAY_BUFFER, uv_buf_data, GL_STATIC_DRAW)
+	@classmethod
+	def fromArrays(cls, vertex_data, index_data, lod_index_data, material):
+		# type: (ndarray, ndarray, List[ndarray], Material) -> Mesh
+		"""
+		Creates a mesh from geometry that is already laid out for upload, such as
+		arrays mapped from the asset cache.  The arrays are uploaded as they are,
+		without being copied.
+		
+		\param vertex_data     Array of VertexDtype.
+		\param index_data      The full index array, of the type index_dtype gives
+		                       for the vertex count.
+		\param lod_index_data  The index arrays of the simplified levels of detail.
+		"""
+		mesh = cls.__new__(cls)
+		mesh._setGeometry(vertex_data, index_data, list(lod_index_data), material)
+		return mesh
+		
 		
-		glBindBuffer(GL_ARRAY_BUFFER, self.normalBuf)
-		glBufferData(GL_ARRAY_BUFFER, normal_buf_data, GL_STATIC_DRAW)
+	def _setGeometry(self, vertex_data, index_data, lod_index_data, material):
+		self.indexType = GL_UNSIGNED_SHORT if index_data.dtype == 'uint16' else GL_UNSIGNED_INT
 		
-		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexBuf)
-		glBufferData(GL_ELEMENT_ARRAY_BUFFER, array(index_buf_data, dtype='uint16'), GL_STATIC_DRAW)
+		self.vertexData = vertex_data
+		self.indexData  = index_data
+		self.lodIndexData = lod_index_data
 		
 		self.material = material
 		
-		self.numIndices = len(index_buf_data)
+		self.numVertices = len(vertex_data)
+		self.numIndices  = len(index_data)
+		
+		self.arena = None
+		self.allocation = None
+		self.page = None
+		
+		# the byte offset and count of the indices of each level of detail
+		self.lods = [(0, self.numIndices)]
+		self.lods.extend((0, len(index_data)) for index_data in self.lodIndexData)
 		
 		
 	def __del__(self):
-		glDeleteBuffers(4, [self.vertexBuf, self.uvBuf, self.normalBuf, self.indexBuf])
-		glDeleteVertexArrays(1, [self.vao])
+		self.release()
+		
+		
+	@property
+	def numLods(self):
+		# type: () -> int
+		return len(self.lods)
 		
 		
-	def bindAttributes(self, shader_program):
-		# type: (ShaderProgram) -> None
+	def upload(self, arena):
+		# type: (GeometryArena) -> None
 		"""
-		Binds the mesh's vao and binds the buffers to the attribute points in the
-		shader program.  After this is done the mesh can be bound simply by binding
-		the vao.
+		Copies the mesh's geometry into the arena, after which the CPU copy is
+		dropped.  The mesh can only be drawn once it has been uploaded.
 		"""
-		glBindVertexArray(self.vao)
+		self.allocation = arena.allocate(self.vertexData, [self.indexData] + self.lodIndexData, self.indexType)
+		self.arena = arena
+		self.page = self.allocation.page
 		
-		shader_program.vertexPosition.enable()
-		glBindBuffer(GL_ARRAY_BUFFER, self.vertexBuf)
-		glVertexAttribPointer(shader_program.vertexPosition.location,
-		                      3, GL_FLOAT, False, 0, None)
+		offset = self.allocation.indexOffset
+		self.lods = []
+		for lod_index_data in [self.indexData] + self.lodIndexData:
+			self.lods.append((offset, len(lod_index_data)))
+			offset += lod_index_data.nbytes
 		
-		shader_program.vertexUv.enable()
-		glBindBuffer(GL_ARRAY_BUFFER, self.uvBuf)
-		glVertexAttribPointer(shader_program.vertexUv.location,
-		                      2, GL_FLOAT, False, 0, None)
+		self.vertexData = None
+		self.indexData = None
+		self.lodIndexData = []
 		
-		shader_program.vertexNormal.enable()
-		glBindBuffer(GL_ARRAY_BUFFER, self.normalBuf)
-		glVertexAttribPointer(shader_program.vertexNormal.location,
-		                      3, GL_FLOAT, False, 0, None)
 		
-		glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.indexBuf)
+	def release(self):
+		""" Returns the mesh's space in the arena for reuse. """
+		if self.allocation is not None:
+			self.arena.free(self.allocation)
+			self.allocation = None
+			self.page = None
+		
+		
+	def lodRange(self, lod):
+		# type: (int) -> Tuple[int, int]
+		"""
+		\return The byte offset and count of the indices of level \p lod, or of the
+		        mesh's coarsest level if it has fewer levels.
+		"""
+		return self.lods[min(lod, len(self.lods) - 1)]
 		
 		
-	def draw(self):
-		""" Bind the texture and vertex array object, then draw the elements. """
-		#glActiveTexture(GL_TEXTURE0)
-		#glBindTexture(GL_TEXTURE_2D, self.material.texture)
+	def draw(self, lod=0):
+		""" Draw the elements, the mesh's page must be bound. """
+		offset, count = self.lodRange(lod)
+		glDrawElementsBaseVertex(GL_TRIANGLES, count, self.indexType,
+		                         c_void_p(offset), self.allocation.baseVertex)
 		
-		glBindVertexArray(self.vao)
-		glDrawElements(GL_TRIANGLES, self.numIndices, GL_UNSIGNED_SHORT, None)
+		
+	def drawInstanced(self, count, lod=0):
+		# type: (int, int) -> None
+		"""
+		Draw \p count instances of the mesh, the mesh's page must be bound with
+		its instance attributes pointing at the first instance.
+		"""
+		offset, num_indices = self.lodRange(lod)
+		glDrawElementsInstancedBaseVertex(GL_TRIANGLES, num_indices, self.indexType,
+		                                  c_void_p(offset), count, self.allocation.baseVertex)
 		
 
 		
@@ -120,55 +186,154 @@ class Model(object):
 	the model matrix defining the models position, orientation and scaling.
 	"""
 	
+	# the cell sizes the levels of detail are simplified with, as fractions of
+	# the model's bounding radius, and the reduction in indices each level must
+	# make to be kept
+	LodCellSizes = (1/32., 1/16., 1/8.)
+	LodReduction = 0.6
+	
 	def __init__(self):
 		self.meshes = []
 		self._pos = zeros(3)
 		self._rot = zeros(3)
 		self._scl = ones(3)
+		self._localMatrix = None
+		
+		# incremented whenever the model is moved, rotated or scaled, so that
+		# anything cached with its transform can tell when it is out of date
+		self.version = 0
+		
+		# bounding volumes in model space, models that don't compute their bounds
+		# have an infinite bounding sphere and are never culled
+		self.aabbMin = zeros(3)
+		self.aabbMax = zeros(3)
+		self.boundingCentre = zeros(3)
+		self.boundingRadius = float('inf')
+	
+	
+	@property
+	def numLods(self):
+		# type: () -> int
+		""" The number of levels of detail of the model's most detailed mesh. """
+		return max([mesh.numLods for mesh in self.meshes] or [1])
+	
+	
+	def upload(self, arena):
+		# type: (GeometryArena) -> None
+		"""
+		Creates the GL objects of the model: uploads its meshes to the arena and
+		creates its materials' textures.  Everything before this needs no GL
+		context, so models may be constructed on any thread.
+		"""
+		for mesh in self.meshes:
+			mesh.material.upload()
+			mesh.upload(arena)
+	
+	
+	def release(self):
+		""" Frees the model's space in the arena and releases its materials' textures. """
+		for mesh in self.meshes:
+			mesh.release()
+			mesh.material.release()
 	
 	
 	def scale(self, s):
 		self._scl *= s
+		self._localMatrix = None
+		self.version += 1
 	
 	def translate(self, t):
 		self._pos += t
+		self._localMatrix = None
+		self.version += 1
 		
 	def rotate(self, r):
 		self._rot += r
+		self._localMatrix = None
+		self.version += 1
+	
+	
+	@property
+	def localMatrix(self):
+		"""
+		Returns the model's own transform, which is applied before the entity
+		matrix.  This is cached until the model is next moved, rotated or scaled.
+		"""
+		if self._localMatrix is None:
+			matrix = identity(4)
+			m_translate_in_place(matrix, self._pos)
+			m_rotate_in_place   (matrix, self._rot)
+			m_scale_in_place    (matrix, self._scl)
+			self._localMatrix = matrix
+		
+		return self._localMatrix
 	
 	
 	def matrix(self, input_matrix):
 		""" Returns the model matrix for use by the shader program. """
-		matrix = input_matrix.copy()
-		m_translate_in_place(matrix, self._pos)
-		m_rotate_in_place   (matrix, self._rot)
-		m_scale_in_place    (matrix, self._scl)
-		return matrix
+		return self.localMatrix.dot(input_matrix)
+	
+	
+	def computeBounds(self, vertex_arrays):
+		# type: (List[numpy.ndarray]) -> None
+		"""
+		Computes the axis-aligned bounding box and the bounding sphere of the model
+		from the vertex positions of its meshes.  These are in model space, so do
+		not include the model's own transform.
+		
+		\param vertex_arrays  The vertex positions of each mesh, as flat or (n, 3)
+		                      arrays.
+		"""
+		vertices = concatenate([vertex_array.reshape(-1, 3) for vertex_array in vertex_arrays])
+		
+		self.aabbMin = vertices.min(axis=0)
+		self.aabbMax = vertices.max(axis=0)
+		self.boundingCentre = (self.aabbMin + self.aabbMax)/2.
+		self.boundingRadius = norm(vertices - self.boundingCentre, axis=1).max()
 
 
 
 class AssimpModel(Model):
 	"""
-	This model class is initialised from an AssImp scene.
+	This model class is imported from a file through AssImp.  Imported scenes
+	are kept in the asset cache, from which later loads map their geometry
+	without importing the file again.
 	"""
 	
-	def __init__(self, ai_scene):
+	def __init__(self, filename, processing=0):
+		# type: (str, int) -> None
+		"""
+		\param processing  AssImp post-processing flags.
+		"""
 		super(AssimpModel, self).__init__()
 		
-		materials = [AssimpMaterial(ai_mat) for ai_mat in ai_scene.materials]
+		scene = load_scene(filename, processing, self._prepareScene, (self.LodCellSizes, self.LodReduction))
 		
-		for ai_mesh in ai_scene.meshes:
-			#import sys
-			#sys.stderr.write(repr(ai_mesh.__dict__.keys())+'\n')
-			
-			# texturecoords is returned as an array of 3 elements, but we only want the first 2
-			uv_buf_data = [coord for uv_coords in ai_mesh.texturecoords[0] for coord in uv_coords[0:2]]
+		# only the materials used by meshes are created, as only they are released
+		materials = {}
+		
+		for mesh_data in scene.meshes:
+			index = mesh_data.materialIndex
+			if index not in materials:
+				materials[index] = FileMaterial(scene.materials[index].colour, scene.materials[index].textureFile)
 			
-			self.meshes.append(Mesh(ai_mesh.vertices.flatten(),
-			                        array(uv_buf_data, dtype='float32'),
-															ai_mesh.normals.flatten(),
-															ai_mesh.faces.flatten(),
-			                        materials[ai_mesh.materialindex]))
+			self.meshes.append(Mesh.fromArrays(mesh_data.vertexData,
+			                                   mesh_data.indexData,
+			                                   mesh_data.lodIndexData,
+			                                   materials[index]))
+		
+		self.computeBounds([mesh_data.vertexData['position'] for mesh_data in scene.meshes])
+	
+	
+	def _prepareScene(self, scene):
+		# type: (SceneData) -> None
+		""" Generates the levels of detail of a newly imported scene, so that they are cached with it. """
+		self.computeBounds([mesh_data.vertexData['position'] for mesh_data in scene.meshes])
+		cell_sizes = [size*self.boundingRadius for size in self.LodCellSizes]
+		
+		for mesh_data in scene.meshes:
+			mesh_data.lodIndexData = generate_lods(mesh_data.vertexData['position'], mesh_data.indexData,
+			                                       cell_sizes, self.LodReduction)
 
 	
 
@@ -181,8 +346,53 @@ class UiModel(Model):
 			mat = Material([1.,1.,1.])
 			mat.alpha = 0.5
 		
-		self.meshes.append(Mesh(array([[.5,.5,0.], [-.5,.5,0.], [-.5,-.5,0.], [.5,-.5,0.]], dtype='float32').flatten(),
+		vertices = array([[.5,.5,0.], [-.5,.5,0.], [-.5,-.5,0.], [.5,-.5,0.]], dtype='float32')
+		
+		self.meshes.append(Mesh(vertices.flatten(),
 		                        array([[1.,1.],    [0.,1.],     [0.,0.],      [1.,0.]    ], dtype='float32').flatten(),
 		                        array([[0.,0.,0.], [0.,0.,0.],  [0.,0.,0.],   [0.,0.,0.] ], dtype='float32').flatten(),
 		                        array([[0,1,2], [2,3,0], [0,2,1], [2,0,3]], dtype='uint16').flatten(),
-		                        mat))
\ No newline at end of file
+		                        mat))
+		
+		self.computeBounds([vertices])
+
+
+
+class BoxModel(Model):
+	"""
+	A unit cube centred on the origin, drawn in place of models which haven't
+	finished loading.
+	"""
+
+	def __init__(self, colour=(0.5, 0.5, 0.5)):
+		super(BoxModel, self).__init__()
+		
+		vertices = []
+		normals = []
+		indices = []
+		
+		# four vertices per face, so that each face has its own normal
+		for axis in range(3):
+			for sign in (1., -1.):
+				normal = zeros(3)
+				normal[axis] = sign
+				u = zeros(3)
+				v = zeros(3)
+				u[(axis + 1) % 3] = 0.5
+				v[(axis + 2) % 3] = 0.5*sign
+				centre = normal*0.5
+				
+				first = len(vertices)
+				vertices.extend([centre - u - v, centre + u - v, centre + u + v, centre - u + v])
+				normals.extend([normal]*4)
+				indices.extend([first, first+1, first+2, first+2, first+3, first])
+		
+		vertices = array(vertices, dtype='float32')
+		
+		self.meshes.append(Mesh(vertices.flatten(),
+		                        zeros(2*len(vertices), dtype='float32'),
+		                        array(normals, dtype='float32').flatten(),
+		                        array(indices, dtype='uint16'),
+		                        Material(colour)))
+		
+		self.computeBounds([vertices])
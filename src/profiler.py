@@ -0,0 +1,194 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from json import dump as dump_json
+from numpy import zeros
+
+try:
+	from time import perf_counter
+except ImportError:
+	# Python 2 has no perf_counter, this is the best clock on each platform
+	from timeit import default_timer as perf_counter
+
+
+
+class _Scope(object):
+	""" A context manager timing a scope, for when begin and end can't be paired by hand. """
+	
+	__slots__ = ('profiler', 'name')
+	
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+	
+	def __enter__(self):
+		self.profiler.begin(self.name)
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.profiler.end()
+
+
+
+class Profiler(object):
+	"""
+	Times nested scopes of the frame on the CPU.  Each scope is recorded as an
+	event in a fixed size ring buffer, so only the most recent Capacity events
+	are kept, which can be exported as a Chrome trace (chrome://tracing).  The
+	total time and number of calls of each scope in each frame are also kept
+	for the last StatsFrames frames, from which statistics() gives rolling
+	averages.
+	
+	When disabled, begin() and end() return straight away, so the call sites can
+	be left in place.  Only enable or disable it between frames.  Only the
+	context's thread is profiled.
+	"""
+	
+	Capacity = 1 << 16
+	
+	StatsFrames = 120
+	
+	def __init__(self):
+		self.enabled = False
+		
+		self._scopeNames = []
+		self._scopeIndices = {}
+		
+		# the scope, start, duration and nesting depth of each event of the ring
+		self._eventScopes    = [0] * self.Capacity
+		self._eventStarts    = [0.] * self.Capacity
+		self._eventDurations = [0.] * self.Capacity
+		self._eventDepths    = [0] * self.Capacity
+		self._numEvents = 0
+		
+		# the (scope index, start) of each open scope, innermost last
+		self._open = []
+		
+		# the total time and calls of each scope in the current frame, and in each
+		# frame of the statistics ring
+		self._frameTotals = []
+		self._frameCalls = []
+		self._history = [None] * self.StatsFrames
+		self._frame = 0
+	
+	
+	def begin(self, name):
+		# type: (str) -> None
+		""" Opens a scope, which lasts until the matching end(). """
+		if not self.enabled:
+			return
+		
+		index = self._scopeIndices.get(name)
+		if index is None:
+			index = self._scopeIndices[name] = len(self._scopeNames)
+			self._scopeNames.append(name)
+			self._frameTotals.append(0.)
+			self._frameCalls.append(0)
+		
+		self._open.append((index, perf_counter()))
+	
+	
+	def end(self):
+		""" Closes the innermost open scope. """
+		if not self.enabled or not self._open:
+			return
+		
+		end = perf_counter()
+		index, start = self._open.pop()
+		duration = end - start
+		
+		slot = self._numEvents % self.Capacity
+		self._eventScopes[slot] = index
+		self._eventStarts[slot] = start
+		self._eventDurations[slot] = duration
+		self._eventDepths[slot] = len(self._open)
+		self._numEvents += 1
+		
+		self._frameTotals[index] += duration
+		self._frameCalls[index] += 1
+	
+	
+	def scope(self, name):
+		# type: (str) -> _Scope
+		""" Returns a context manager which times its block as the named scope. """
+		return _Scope(self, name)
+	
+	
+	def endFrame(self):
+		""" Adds the current frame's totals to the statistics, and starts the next frame. """
+		if not self.enabled:
+			return
+		
+		self._history[self._frame % self.StatsFrames] = (self._frameTotals, self._frameCalls)
+		self._frameTotals = [0.] * len(self._scopeNames)
+		self._frameCalls = [0] * len(self._scopeNames)
+		self._frame += 1
+	
+	
+	def statistics(self):
+		# type: () -> Dict[str, Dict[str, float]]
+		"""
+		\return The mean and maximum total time of each scope per frame, in
+		        seconds, and its mean number of calls per frame, over the last
+		        StatsFrames frames.
+		"""
+		frames = [frame for frame in self._history if frame is not None]
+		if not frames:
+			return {}
+		
+		totals = zeros((len(frames), len(self._scopeNames)))
+		calls = zeros((len(frames), len(self._scopeNames)))
+		for i, (frame_totals, frame_calls) in enumerate(frames):
+			totals[i, :len(frame_totals)] = frame_totals
+			calls[i, :len(frame_calls)] = frame_calls
+		
+		return dict((name, {'mean':  float(totals[:, i].mean()),
+		                    'max':   float(totals[:, i].max()),
+		                    'calls': float(calls[:, i].mean())})
+		            for i, name in enumerate(self._scopeNames) if calls[:, i].any())
+	
+	
+	def exportTrace(self, filename):
+		# type: (str) -> None
+		""" Writes the events in the ring as a Chrome trace-event JSON file. """
+		first = max(0, self._numEvents - self.Capacity)
+		
+		events = []
+		for i in range(first, self._numEvents):
+			slot = i % self.Capacity
+			events.append({'name': self._scopeNames[self._eventScopes[slot]],
+			               'cat':  'cpu',
+			               'ph':   'X',
+			               'ts':   self._eventStarts[slot] * 1e6,
+			               'dur':  self._eventDurations[slot] * 1e6,
+			               'pid':  0,
+			               'tid':  0,
+			               'args': {'depth': self._eventDepths[slot]}})
+		
+		with open(filename, 'w') as trace_file:
+			dump_json({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+
+
+# The profiler all call sites share.
+profiler = Profiler()
@@ -0,0 +1,102 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from entities import UiEntity, UiMeas, UiModelHorizontalAlignment, UiModelVerticalAlignment
+from materials import Material
+from models import UiModel
+
+
+
+# the colours the rows of the overlay take in turn
+OverlayPalette = [[1.,  .25, .25],
+                  [.25, 1.,  .25],
+                  [.25, .25, 1. ],
+                  [1.,  1.,  .25],
+                  [1.,  .25, 1. ],
+                  [.25, 1.,  1. ]]
+
+
+
+def _bar_model(colour):
+	class ProfilerBarModel(UiModel):
+		def __init__(self):
+			material = Material(colour)
+			material.alpha = 0.75
+			super(ProfilerBarModel, self).__init__(material)
+	
+	return ProfilerBarModel
+
+# the renderer holds one model per class, so there is a class per colour
+BarModels = [_bar_model(colour) for colour in OverlayPalette]
+
+
+
+class ProfilerOverlay(object):
+	"""
+	Draws the profiler's rolling statistics over the scene, as a bar for each
+	of a list of scopes, one row per scope from the top of the screen, coloured
+	by OverlayPalette in turn.  Each bar's length is its scope's mean time per
+	frame, across the whole screen being FrameBudget.
+	"""
+	
+	FrameBudget = 1/30.
+	
+	# the height of each row, as a percentage of the screen height
+	RowHeight = 2.
+	
+	def __init__(self, renderer, profiler, scopes):
+		# type: (Renderer, Profiler, List[str]) -> None
+		self.renderer = renderer
+		self.profiler = profiler
+		self.scopes = scopes
+		
+		for model_class in BarModels:
+			renderer.addModel(model_class)
+		
+		self.bars = []
+		for row in range(len(scopes)):
+			bar = UiEntity(model_class=BarModels[row % len(BarModels)])
+			renderer.addUiEntity(bar)
+			self.bars.append(bar)
+		
+		self.update()
+	
+	
+	def update(self):
+		""" Resizes the bars to the current statistics. """
+		statistics = self.profiler.statistics()
+		
+		for row, (bar, scope) in enumerate(zip(self.bars, self.scopes)):
+			mean = statistics.get(scope, {}).get('mean', 0.)
+			# a bar can't be empty, as its normal matrix couldn't be computed
+			length = max(min(mean / self.FrameBudget, 1.) * 100., 0.1)
+			
+			bar.setLayout(UiMeas(0, "%"), UiMeas(row * self.RowHeight, "%"),
+			              UiMeas(length, "%"), UiMeas(self.RowHeight * 0.8, "%"),
+			              UiModelHorizontalAlignment.Left, UiModelVerticalAlignment.Top)
+	
+	
+	def release(self):
+		for bar in self.bars:
+			self.renderer.removeUiEntity(bar)
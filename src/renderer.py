@@ -24,15 +24,28 @@
 
 from math import pi, tan, sqrt
 from sets import Set
-from numpy import transpose, identity
-from numpy.linalg import inv
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from timeit import default_timer
+import sys
+from numpy import array, identity, zeros, ones, bincount
 from OpenGL.GL import *
 
-from shaders import VertexShader, FragmentShader, ShaderProgram
+from shaders import VertexShader, FragmentShader, ShaderProgram, TextureBinding, invalidate_texture_bindings
+from textures import texture_registry, init_texture_compression
+from shader_variants import ShaderVariants, ShaderFeatures, light_count_bucket
 from lighting import *
-from models import Model
+from light_clusters import LightClusters, ClusteredPointLight
+from models import Model, BoxModel
+from entity_transforms import EntityTransforms
+from culling import entities_inside, shadow_caster_planes
+from draw_queue import DrawQueue
+from geometry import GeometryArena, draw_meshes
+from shadows import ShadowMapCache, cascade_splits, frustum_slice_corners
+from lod import LodSelector
+from gpu_timers import GpuTimers
+from profiler import profiler
 
-from matrix_transforms import m_perspective, m_orthographic
+from matrix_transforms import m_perspective, m_orthographic, m_frustum_planes
 
 
 
@@ -50,6 +63,27 @@ class Renderer(object):
 	
 	NumLights = 20
 	
+	# directional lights take the first slots of the light block, and point
+	# lights the rest
+	MaxDirectionalLights = 4
+	
+	# the number of layers of the shadow map array, one per shadowed light
+	MaxShadowMaps = 4
+	
+	# texture units are fixed, so that they are the same in every variant of
+	# the render program
+	MaterialTextureUnit  = 0
+	ShadowMapTextureUnit = 1
+	ClusterTextureUnit   = 2
+	
+	# the number of threads models are constructed on by addModelAsync
+	LoaderThreads = 4
+	
+	# point lights are assigned to clusters of the view frustum and each
+	# fragment only shades those of its cluster, otherwise they take slots of
+	# the light block and every fragment shades every light
+	ClusteredLighting = True
+	
 	def __init__(self, window):
 		# type: (GlfwWindow) -> None
 		"""
@@ -62,34 +96,52 @@ class Renderer(object):
 		glDepthFunc(GL_LESS)
 		
 		glEnable(GL_CULL_FACE)
-		glEnable(GL_BLEND)
+		
+		# blending is only enabled for the passes that need it
 		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
 		
 		glClearColor(1., 1., 1., 0.)
 		
-		vertex_shader   = VertexShader(  shader_file='src/shaders/vertex_shader.glsl',
-		                                 consts={'NUM_LIGHTS': self.NumLights})
-		fragment_shader = FragmentShader(shader_file='src/shaders/fragment_shader.glsl',
-		                                 consts={'NUM_LIGHTS': self.NumLights})
-		
-		self.renderShader = ShaderProgram(vertex_shader, fragment_shader)
+		# textures are only compressed if the context supports it
+		init_texture_compression()
+		
+		shader_consts = {'NUM_LIGHTS':             self.NumLights,
+		                 'MAX_DIRECTIONAL_LIGHTS': self.MaxDirectionalLights,
+		                 'MAX_SHADOW_MAPS':        self.MaxShadowMaps,
+		                 'NUM_CASCADES':           NumShadowCascades,
+		                 'CLUSTER_GRID_X':         LightClusters.GridX,
+		                 'CLUSTER_GRID_Y':         LightClusters.GridY,
+		                 'CLUSTER_GRID_Z':         LightClusters.GridZ}
+		
+		self.lightBlock = LightBlock(self.NumLights, self.MaxShadowMaps)
+		self.aLight = AmbientLight(self.lightBlock)
+		
+		self.shadowMaps = ShadowMapArray(sum(DirectionalLight.CascadeResolutions),
+		                                 max(DirectionalLight.CascadeResolutions),
+		                                 self.MaxShadowMaps)
+		self._shadowMapBinding = TextureBinding(self.ShadowMapTextureUnit, GL_TEXTURE_2D_ARRAY)
+		
+		self.lightClusters = None
+		if self.ClusteredLighting:
+			self.lightClusters = LightClusters()
+			self._clusterBindings = [TextureBinding(self.ClusterTextureUnit + i, GL_TEXTURE_BUFFER)
+			                         for i in range(3)]
+			
+			# creating the buffer textures disturbs the texture bindings
+			invalidate_texture_bindings()
 		
-		self.renderShader.use()
+		# the render program is specialised for the lights in the scene and the
+		# material of each draw, so that nothing is paid for unused features
+		self.shaderVariants = ShaderVariants('src/shaders/vertex_shader.glsl',
+		                                     'src/shaders/fragment_shader.glsl',
+		                                     shader_consts, self._setupRenderProgram)
 		
-		self.renderShader.uniformInt('useLighting')
-		self.renderShader.uniformMatrix4('modelMatrix')
-		self.renderShader.uniformMatrix4('normalMatrix')
-		self.renderShader.uniformMatrix4('viewMatrix')
-		self.renderShader.uniformSampler('matTextureSampler')
-		self.renderShader.uniformVector3('matDiffuseColour')
-		self.renderShader.uniformFloat('matAlpha')
-		self.renderShader.uniformVector3('cameraPosition')
-		self.renderShader.attribute('vertexPosition')
-		self.renderShader.attribute('vertexUv')
-		self.renderShader.attribute('vertexNormal')
+		# the most basic variant, its attribute locations are shared by all of them
+		self.renderShader = self.shaderVariants.get(ShaderFeatures(0, 0, 0, False, True))
 		
-		self.aLight = AmbientLight(self.renderShader.uniformFloat('ambientLightAmplitude'),
-		                           self.renderShader.uniformVector3('ambientLightColour'))
+		# the program in use, and the uniforms shared by every draw of the pass
+		self._currentProgram = None
+		self._passUniforms = {}
 		
 		depth_vertex_shader = VertexShader(shader_file='src/shaders/depth_vertex_shader.glsl')
 		depth_fragment_shader = FragmentShader(shader_file='src/shaders/depth_fragment_shader.glsl')
@@ -98,12 +150,23 @@ class Renderer(object):
 		
 		self.depthShader.uniformMatrix4('modelMatrix')
 		self.depthShader.uniformMatrix4('viewMatrix')
+		self.depthShader.uniformInt('useInstancing')
+		
+		# the geometry of every model is held in a few shared buffers, bound with
+		# the render program's attribute locations which the depth program shares
+		self.geometry = GeometryArena(self.renderShader)
 		
-		self._lightIndexPool = Set(range(self.NumLights))
+		self._directionalSlots = Set(range(self.MaxDirectionalLights))
+		self._pointSlots = Set(range(self.MaxDirectionalLights, self.NumLights))
 		self._lights = {}
+		self._shadowCaches = {}
 		
 		self.window = window
 		self.aspectRatio = float(window.size[0])/float(window.size[1])
+		
+		# the framebuffer the scene is drawn into: a headless window's offscreen
+		# one, otherwise the window's default framebuffer
+		self.framebuffer = getattr(window, 'framebuffer', 0)
 		window.set_window_size_callback(self.resize)
 		
 		self.perspectiveMatrix = None
@@ -112,9 +175,76 @@ class Renderer(object):
 		self.camera = None
 		
 		self.models = {}
+		
+		# models being constructed on the loader threads, as (model class, load
+		# future, future returned by addModelAsync), they are uploaded by update()
+		# once loaded
+		self._loader = ThreadPoolExecutor(self.LoaderThreads)
+		self._loads = []
+		self._modelFutures = {}
+		
+		# drawn in place of models which aren't loaded
+		self.placeholderModel = BoxModel()
+		self.placeholderModel.upload(self.geometry)
+		invalidate_texture_bindings()
+		
 		self.entities = Set()
+		self.staticEntities = Set()
 		self.uiEntities = Set()
 		
+		# counters that change whenever the models, or the static entities, do
+		self._modelVersion = 0
+		self._staticVersion = 0
+		
+		# entities sharing a model are drawn with a single instanced draw call per
+		# mesh, if this is unset each entity is drawn individually
+		self.instancing = True
+		
+		self.transforms = EntityTransforms()
+		self.uiTransforms = EntityTransforms()
+		
+		# entities outside of the view frustum are skipped in the main pass
+		self.frustumCulling = True
+		
+		# entities are drawn with simplified meshes when they are small on screen,
+		# and shadow casters are drawn shadowLodBias levels coarser still
+		self.levelOfDetail = True
+		self.lodSelector = LodSelector()
+		self.shadowLodBias = 1
+		
+		# entities which cannot cast a shadow onto anything visible are skipped
+		# when rendering each light's shadow map
+		self.shadowCulling = True
+		
+		# directional lights cast shadows, if this is unset the shadow maps aren't
+		# rendered and the render program is built without them
+		self.shadows = True
+		
+		# shadow maps are only rendered when their light or casters have changed,
+		# and static casters are rendered into a separate layer which is reused
+		# until the static entities change
+		self.shadowCaching = True
+		
+		# the depth of the opaque entities is drawn before the main pass, which then
+		# only shades the fragments that are visible
+		self.depthPrepass = True
+		
+		# draws in the main pass are sorted to minimise texture and material
+		# changes, transparent draws are sorted back to front
+		self.drawQueue = DrawQueue()
+		self.transparentQueue = DrawQueue()
+		
+		# counters for the most recent frame
+		self.frameStats = {}
+		self._frame = 0
+		
+		# the CPU time taken by each phase of the most recent frame, in seconds
+		self.phaseTimes = {}
+		self._phaseStart = None
+		
+		# the GPU time taken by each pass, read a few frames late
+		self.gpuTimers = GpuTimers()
+		
 		
 		#self.once = True
 		
@@ -153,62 +283,204 @@ class Renderer(object):
 			self.perspectiveMatrix = m_perspective(self._fov, self.aspectRatio, self.min_z, self.max_z)
 		
 		
+	def _setupRenderProgram(self, program, features):
+		# type: (ShaderProgram, ShaderFeatures) -> None
+		""" Creates the uniforms and attributes of a variant of the render program. """
+		
+		program.uniformInt('useLighting')
+		program.uniformInt('useInstancing')
+		program.uniformMatrix4('modelMatrix')
+		program.uniformMatrix4('normalMatrix')
+		program.uniformMatrix4('viewMatrix')
+		program.uniformSampler('matTextureSampler', texture_unit=self.MaterialTextureUnit)
+		program.uniformVector3('matDiffuseColour')
+		program.uniformFloat('matAlpha')
+		program.uniformVector3('cameraPosition')
+		program.attribute('vertexPosition')
+		program.attribute('vertexUv')
+		program.attribute('vertexNormal')
+		program.attribute('instanceModelMatrix')
+		program.attribute('instanceNormalMatrix')
+		
+		program.uniformBlock('LightBlock').bind(self.lightBlock.bindingPoint)
+		
+		if features.shadowMaps:
+			program.uniformSampler('shadowMapSampler', target=GL_TEXTURE_2D_ARRAY,
+			                       texture_unit=self.ShadowMapTextureUnit)
+		
+		if features.clusteredLighting:
+			for i, name in enumerate(('clusterLightData', 'clusterGrid', 'clusterLightIndices')):
+				program.uniformSampler(name, target=GL_TEXTURE_BUFFER, texture_unit=self.ClusterTextureUnit + i)
+			program.uniformVector3('clusterScale')
+			program.uniformFloat('clusterDepthBias')
+		
+		
 	def getDirectionalLight(self):
-		index = self._lightIndexPool.pop()
-		s_index = str(index)
-		light = DirectionalLight(self.renderShader.uniformInt    ('lightType['+s_index+']'),
-		                         self.renderShader.uniformFloat  ('lightAmplitude['+s_index+']'),
-		                         self.renderShader.uniformVector3('lightColour['+s_index+']'),
-														 self.renderShader.uniformVector3('lightVector['+s_index+']'),
-		                         self.renderShader.uniformMatrix4('lightViewMatrix['+s_index+']'),
-		                         self.renderShader.uniformSampler('lightShadowMapSampler['+s_index+']'),
-														 index)
+		if not self._directionalSlots:
+			raise Exception("No directional lights left, the maximum is %d." % self.MaxDirectionalLights)
+		
+		# lights take the lowest free slots, so that the variants loop over as
+		# few as possible
+		index = min(self._directionalSlots)
+		self._directionalSlots.remove(index)
+		
+		light = DirectionalLight(self.lightBlock, self.shadowMaps, index)
 		self._lights[index] = light
+		if light.shadowIndex is not None:
+			self._shadowCaches[index] = [ShadowMapCache(light, cascade) for cascade in light.cascades]
+		
+		# creating the shadow map textures disturbs the texture bindings
+		invalidate_texture_bindings()
+		
 		return light
 	
 	def getPointLight(self):
-		index = self._lightIndexPool.pop()
-		s_index = str(index)
-		light = PointLight(self.renderShader.uniformInt    ('lightType['+s_index+']'),
-		                   self.renderShader.uniformVector3('lightVector['+s_index+']'),
-		                   self.renderShader.uniformFloat  ('lightAmplitude['+s_index+']'),
-		                   self.renderShader.uniformVector3('lightColour['+s_index+']'),
-		                   index)
+		if self.lightClusters is not None:
+			return self.lightClusters.getLight()
+		
+		if not self._pointSlots:
+			raise Exception("No point lights left, the maximum is %d." % len(range(self.MaxDirectionalLights, self.NumLights)))
+		
+		index = min(self._pointSlots)
+		self._pointSlots.remove(index)
+		
+		light = PointLight(self.lightBlock, index)
 		self._lights[index] = light
 		return light
 	
 	def releaseLight(self, light):
-		if light.index in self._lightIndexPool:
+		if isinstance(light, ClusteredPointLight):
+			self.lightClusters.releaseLight(light)
+			return
+		
+		if light.index not in self._lights:
 			raise Exception("Attempt to release light already in pool.")
 		del self._lights[light.index]
-		self._lightIndexPool.add(light.index)
-		self.renderShader.uniformInt('lightType['+str(light.index)+']').set(LightType.Disabled)
+		self._shadowCaches.pop(light.index, None)
+		
+		if isinstance(light, DirectionalLight):
+			light.releaseShadowMap()
+		
+		if light.index < self.MaxDirectionalLights:
+			self._directionalSlots.add(light.index)
+		else:
+			self._pointSlots.add(light.index)
+		
+		light.disable()
 	
 	
 	def addModel(self, model_class):
 		# type: (Class) -> None
-		""" Adds the model to the set and binds the buffers associated with the meshes. """
+		""" Adds the model to the set and uploads its meshes to the geometry arena. """
 		
-		if model_class not in self.models:
-			model = model_class()
-			self.models[model_class] = model
-			for mesh in model.meshes:
-				mesh.bindAttributes(self.renderShader)
-				
-			glBindVertexArray(0)
+		if model_class in self._modelFutures:
+			self.waitForModels([self._modelFutures[model_class]])
+		
+		elif model_class not in self.models:
+			self._installModel(model_class, model_class())
+	
+	def addModelAsync(self, model_class):
+		# type: (Class) -> Future
+		"""
+		Adds the model to the set in the background.  The model class is
+		constructed on a loader thread, where its files are parsed and its images
+		decoded, and it is uploaded on the context's thread by a later update().
+		Until then its entities are drawn with the placeholder model.
+		
+		\return A future whose result is the model, once it has been uploaded.
+		        Callbacks added to it are called on the context's thread.  Only
+		        update() and waitForModels() upload models, so wait for it with the
+		        latter rather than blocking on the future.
+		"""
+		if model_class in self._modelFutures:
+			return self._modelFutures[model_class]
+		
+		future = Future()
+		future.set_running_or_notify_cancel()
+		
+		if model_class in self.models:
+			future.set_result(self.models[model_class])
+		else:
+			self._modelFutures[model_class] = future
+			self._loads.append((model_class, self._loader.submit(model_class), future))
+		
+		return future
+	
+	def waitForModels(self, futures=None):
+		# type: (Optional[Iterable[Future]]) -> None
+		"""
+		Blocks until the models of the futures returned by addModelAsync, or all
+		of the models being loaded, have been loaded and uploaded.
+		"""
+		if futures is None:
+			futures = self._modelFutures.values()
+		futures = list(futures)
+		
+		while self._loads and not all(future.done() for future in futures):
+			wait([load for model_class, load, future in self._loads], return_when=FIRST_COMPLETED)
+			self._finishLoads()
+	
+	def _finishLoads(self):
+		""" Uploads the models whose loader threads have finished. """
+		
+		for entry in list(self._loads):
+			model_class, load, future = entry
+			if not load.done():
+				continue
+			
+			self._loads.remove(entry)
+			del self._modelFutures[model_class]
+			
+			try:
+				model = load.result()
+			except Exception as e:
+				sys.stderr.write("Failed to load "+model_class.__name__+": "+str(e)+'\n')
+				future.set_exception(e)
+				continue
+			
+			self._installModel(model_class, model)
+			future.set_result(model)
+	
+	def _installModel(self, model_class, model):
+		# type: (Class, Model) -> None
+		model.upload(self.geometry)
+		self.models[model_class] = model
+		self._modelVersion += 1
+		
+		# creating the material textures disturbs the texture bindings
+		invalidate_texture_bindings()
 	
 	def removeModel(self, model_class):
 		# type: (Class) -> None
-		""" Removes the specified model from the set. """
+		""" Removes the specified model from the set, freeing its space in the arena and releasing its textures. """
 		
-		del self.models[model_class]
+		model = self.models.pop(model_class)
+		model.release()
+		
+		self._modelVersion += 1
 	
 	
-	def addEntity(self, entity):
+	def addEntity(self, entity, static=False):
+		# type: (Entity, bool) -> None
+		"""
+		Adds an entity to the scene.
+		
+		\param static  Set for entities that will never move.  Their shadows are
+		               rendered once into each light's static layer, rather than
+		               every time the light's shadow map is rendered.
+		"""
 		self.entities.add(entity)
+		
+		if static:
+			self.staticEntities.add(entity)
+			self._staticVersion += 1
 	
 	def removeEntity(self, entity):
 		self.entities.discard(entity)
+		
+		if entity in self.staticEntities:
+			self.staticEntities.discard(entity)
+			self._staticVersion += 1
 	
 	
 	def addUiEntity(self, entity):
@@ -225,68 +497,523 @@ class Renderer(object):
 		
 		\param interval (s) The time passed since the previous frame.
 		"""
+		self._phaseStart = default_timer()
+		self.gpuTimers.beginFrame()
+		
+		for program in self.shaderVariants.programs():
+			program.resetUniformCacheStats()
+		self.depthShader.resetUniformCacheStats()
+		self.geometry.binds = 0
+		self.frameStats['programChanges'] = 0
+		
+		profiler.begin('loads')
+		self._finishLoads()
+		self.frameStats['modelsLoading'] = len(self._loads)
+		profiler.end()
+		
+		texture_registry.nextFrame()
+		uploads = texture_registry.uploads
+		evictions = texture_registry.evictions
+		
+		# every pass shares the matrices computed here
+		profiler.begin('transforms')
+		self.transforms.update(self.entities, self.models, self.placeholderModel)
+		self.uiTransforms.update(self.uiEntities, self.models, self.placeholderModel)
+		profiler.end()
+		
+		camera_matrix = self.camera.matrix
+		self.viewMatrix = camera_matrix.dot(self.perspectiveMatrix)
+		
+		transforms = self.transforms
+		if self.levelOfDetail:
+			profiler.begin('lod')
+			transforms = transforms.splitByLod(self.lodSelector.select(transforms, self.camera.pos, self._fov))
+			profiler.end()
+		
+		visible = transforms
+		if self.frustumCulling:
+			profiler.begin('culling')
+			visible = transforms.select(entities_inside(m_frustum_planes(self.viewMatrix), transforms))
+			profiler.end()
+		
+		self.frameStats['entitiesDrawn']  = len(visible)
+		self.frameStats['entitiesPerLod'] = bincount(visible.lods).tolist()
+		self.frameStats['entitiesCulled'] = len(transforms) - len(visible)
+		self.frameStats['shadowCastersDrawn']  = 0
+		self.frameStats['shadowCastersCulled'] = 0
+		
+		self._endPhase('prepare')
+		
 		# generate shadow maps for each light source
 		self.depthShader.use()
+		self.depthShader.useInstancing.set(int(self.instancing))
 		glCullFace(GL_FRONT)
 		
+		# casters between the light and its near plane are kept by the culling, so
+		# clamp them to the near plane rather than clipping them
+		glEnable(GL_DEPTH_CLAMP)
+		
+		# static casters are only drawn into the static layers, everything else is
+		# drawn into the shadow maps directly
+		if self.shadowCaching and self.staticEntities:
+			static = array([entity in self.staticEntities for entity in transforms.entities], dtype=bool)
+		else:
+			static = zeros(len(transforms), dtype=bool)
+		
+		# the models' own transforms are drawn into the static layers too, so
+		# moving a model must render them again
+		model_version = (self._modelVersion, sum(model.version for model in self.models.values()))
+		
+		self.frameStats['shadowMapsRendered'] = 0
+		self.frameStats['staticLayersRendered'] = 0
+		
+		self.gpuTimers.begin('shadows')
+		profiler.begin('shadows')
+		
 		for i in self._lights:
 			light = self._lights[i]
-			if light.ShadowMappingEnabled:
-				glViewport(0, 0, light.ShadowResolutionX, light.ShadowResolutionY)
-				glBindFramebuffer(GL_FRAMEBUFFER, light.depthBuffer)
-				glClear(GL_DEPTH_BUFFER_BIT)
+			if light.shadowIndex is not None and self.shadows:
+				splits = cascade_splits(self.min_z, min(self.max_z, light.ShadowDistance),
+				                        len(light.cascades), light.CascadeSplitWeight)
 				
-				self.depthShader.viewMatrix.set(light.matrix)
-				
-				for entity in self.entities:
-					model = self.models[entity.modelClass]
-					model_matrix = model.matrix(entity.matrix)
-					self.depthShader.modelMatrix.set(model_matrix)
+				for cascade, cache in zip(light.cascades, self._shadowCaches[i]):
+					# cascades which aren't due keep their previous box and map, fragments
+					# outside of it fall through to the next cascade
+					if not cascade.due(self._frame, light.version):
+						continue
 					
-					for mesh in model.meshes:
-						mesh.draw()
-				
-				light.setShadowMap()
-			
-		glBindFramebuffer(GL_FRAMEBUFFER, 0)
+					profiler.begin('shadowCascade')
+					
+					corners = frustum_slice_corners(camera_matrix, self._fov, self.aspectRatio,
+					                                splits[cascade.index], splits[cascade.index+1])
+					light.fitCascade(cascade, corners)
+					
+					casters = ones(len(transforms), dtype=bool)
+					if self.shadowCulling:
+						planes = shadow_caster_planes(cascade.matrix, visible.boundingCentres, visible.boundingRadii)
+						if planes is None:
+							casters[:] = False
+						else:
+							casters = entities_inside(planes, transforms)
+					
+					dynamic = transforms.select(casters & ~static)
+					
+					num_casters = int(casters.sum())
+					self.frameStats['shadowCastersDrawn']  += num_casters
+					self.frameStats['shadowCastersCulled'] += len(transforms) - num_casters
+					
+					if not self.shadowCaching:
+						cache.invalidate()
+					
+					static_changed  = cache.staticChanged(self._staticVersion, model_version)
+					casters_changed = cache.castersChanged(model_version, dynamic)
+					
+					if static_changed or casters_changed:
+						self.depthShader.viewMatrix.set(cascade.matrix)
+						
+						if static_changed:
+							# the static layer doesn't depend on what is visible, so that it
+							# remains valid as the camera moves within a texel
+							static_casters = transforms.select(static)
+							static_planes = m_frustum_planes(cascade.matrix)[[0, 1, 2, 3, 5]]
+							static_casters = static_casters.select(entities_inside(static_planes, static_casters))
+							
+							# nor on the camera's distance, so the static casters all use
+							# the same level of detail
+							static_casters.lods[:] = 0
+							
+							cache.hasStaticLayer = len(static_casters) > 0
+							if cache.hasStaticLayer:
+								glViewport(0, 0, cascade.resolution, cascade.resolution)
+								glBindFramebuffer(GL_FRAMEBUFFER, cache.staticBuffer)
+								glClear(GL_DEPTH_BUFFER_BIT)
+								self._drawDepth(static_casters, lod_bias=self.shadowLodBias)
+								self.frameStats['staticLayersRendered'] += 1
+						
+						if cache.hasStaticLayer:
+							cache.copyStaticLayer()
+						else:
+							# only clear the cascade's own region of the atlas
+							glBindFramebuffer(GL_FRAMEBUFFER, light.depthBuffer)
+							glEnable(GL_SCISSOR_TEST)
+							glScissor(cascade.x, cascade.y, cascade.resolution, cascade.resolution)
+							glClear(GL_DEPTH_BUFFER_BIT)
+							glDisable(GL_SCISSOR_TEST)
+						
+						glViewport(cascade.x, cascade.y, cascade.resolution, cascade.resolution)
+						self._drawDepth(dynamic, lod_bias=self.shadowLodBias)
+						self.frameStats['shadowMapsRendered'] += 1
+					
+					profiler.end()
+		
+		profiler.end()
+		self.gpuTimers.end()
+		
+		self._shadowMapBinding.set(self.shadowMaps.texture)
+		self._frame += 1
+		
+		self._endPhase('shadows')
+		
+		glDisable(GL_DEPTH_CLAMP)
+		glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
 		
-		self.renderShader.use()
 		glCullFace(GL_BACK)
 		
 		glViewport(0, 0, *self.window.size)
 		glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 		
-		self.viewMatrix = self.camera.matrix.dot(self.perspectiveMatrix)
-		self.renderShader.viewMatrix.set(self.viewMatrix)
-		self.renderShader.cameraPosition.set(self.camera.pos)
-		self.renderShader.useLighting.set(1)
+		self.lightBlock.upload()
+		
+		self._passUniforms = {'viewMatrix':     self.viewMatrix,
+		                      'cameraPosition': self.camera.pos,
+		                      'useLighting':    1,
+		                      'useInstancing':  int(self.instancing)}
+		
+		if self.lightClusters is not None:
+			profiler.begin('lightClusters')
+			self._updateLightClusters(camera_matrix)
+			profiler.end()
+		
+		# opaque entities are drawn nearest first, so that as few fragments as
+		# possible are shaded and then overdrawn
+		visible = visible.sortedByDepth(camera_matrix)
+		
+		profiler.begin('drawQueues')
+		select_program = self._programSelector(self._lightFeatures())
+		self.drawQueue.build(select_program, visible, self.instancing)
+		self.transparentQueue.build(select_program, visible, self.instancing,
+		                            visible.viewDepths(camera_matrix))
+		profiler.end()
+		
+		self.frameStats['opaqueDraws'] = len(self.drawQueue)
+		self.frameStats['transparentDraws'] = len(self.transparentQueue)
+		self.frameStats['textureBinds'] = 0
+		self.frameStats['materialChanges'] = 0
+		
+		self._endPhase('queues')
+		
+		if self.depthPrepass:
+			self.gpuTimers.begin('depthPrepass')
+			profiler.begin('depthPrepass')
+			self.depthShader.use()
+			self.depthShader.viewMatrix.set(self.viewMatrix)
+			
+			glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+			self._drawDepth(visible, opaque_only=True)
+			glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+			
+			# the depth buffer is complete for opaque geometry, so only the nearest
+			# fragment of each pixel passes
+			glDepthFunc(GL_EQUAL)
+			glDepthMask(GL_FALSE)
+			profiler.end()
+			self.gpuTimers.end()
+		
+		elif self.instancing:
+			self._uploadInstances(visible)
+		
+		self._currentProgram = None
+		self.gpuTimers.begin('opaque')
+		profiler.begin('opaque')
+		self.drawQueued(self.drawQueue, visible)
+		profiler.end()
+		self.gpuTimers.end()
+		self._endPhase('opaque')
+		
+		# transparent entities are tested against the opaque depth, but don't
+		# write it so that those behind them are still blended
+		glDepthFunc(GL_LESS)
+		glDepthMask(GL_FALSE)
+		glEnable(GL_BLEND)
 		
-		for entity in self.entities:
-			self.drawEntity(entity)
+		self.gpuTimers.begin('transparent')
+		profiler.begin('transparent')
+		self.drawQueued(self.transparentQueue, visible)
+		profiler.end()
+		self.gpuTimers.end()
+		self._endPhase('transparent')
+		
+		glDepthMask(GL_TRUE)
+		
+		self._passUniforms = {'viewMatrix':    identity(4),
+		                      'useLighting':   0,
+		                      'useInstancing': 0}
+		
+		self._currentProgram = None
+		self.gpuTimers.begin('ui')
+		profiler.begin('ui')
+		self.drawEntities(self.uiTransforms, self._programSelector(ShaderFeatures(0, 0, 0, False, True)))
+		profiler.end()
+		self.gpuTimers.end()
+		self._endPhase('ui')
+		
+		glDisable(GL_BLEND)
+		
+		self.geometry.unbind()
+		
+		render_hits, render_misses = 0, 0
+		for program in self.shaderVariants.programs():
+			hits, misses = program.uniformCacheStats()
+			render_hits += hits
+			render_misses += misses
+		
+		depth_hits, depth_misses = self.depthShader.uniformCacheStats()
+		self.frameStats['uniformCacheHits']   = render_hits + depth_hits
+		self.frameStats['uniformCacheMisses'] = render_misses + depth_misses
+		self.frameStats['vertexArrayBinds'] = self.geometry.binds
+		self.frameStats['shaderVariantsCompiled'] = self.shaderVariants.compiled
+		self.frameStats['shaderVariantsLoaded'] = self.shaderVariants.loadedFromCache
+		self.frameStats['textures'] = len(texture_registry)
+		self.frameStats['textureMemory'] = texture_registry.residentSize
+		self.frameStats['textureUploads'] = texture_registry.uploads - uploads
+		self.frameStats['textureEvictions'] = texture_registry.evictions - evictions
+		
+		self.gpuTimers.endFrame()
+		
+		profiler.begin('swapBuffers')
+		self.window.swap_buffers()
+		profiler.end()
+		self._endPhase('swap')
+	
+	
+	def _endPhase(self, name):
+		# type: (str) -> None
+		""" Records the time since the end of the previous phase as the time of the named one. """
+		now = default_timer()
+		self.phaseTimes[name] = now - self._phaseStart
+		self._phaseStart = now
 		
-		self.renderShader.viewMatrix.set(identity(4))
-		self.renderShader.useLighting.set(0)
 		
-		for entity in self.uiEntities:
-			self.drawEntity(entity)
+	def _lightFeatures(self):
+		# type: () -> ShaderFeatures
+		""" Returns the shader features needed by the current lights. """
 		
-		self.window.swap_buffers()
+		directional = [index + 1 for index in self._lights if index < self.MaxDirectionalLights]
+		point = [index + 1 - self.MaxDirectionalLights for index in self._lights if index >= self.MaxDirectionalLights]
+		shadow_maps = [light.shadowIndex + 1 for light in self._lights.values()
+		               if light.shadowIndex is not None and self.shadows]
+		
+		clustered = self.lightClusters is not None and bool(self.lightClusters.enabled.any())
+		
+		return ShaderFeatures(light_count_bucket(max(directional or [0])),
+		                      light_count_bucket(max(point or [0])),
+		                      light_count_bucket(max(shadow_maps or [0])),
+		                      clustered,
+		                      True)
+		
+		
+	def _programSelector(self, features):
+		# type: (ShaderFeatures) -> Callable[[Mesh], ShaderProgram]
+		"""
+		Returns a function giving the variant of the render program each mesh is
+		drawn with, for the features of a pass.
+		"""
+		programs = {}
+		
+		def select_program(mesh):
+			textured = mesh.material.textured
+			if textured not in programs:
+				programs[textured] = self.shaderVariants.get(features._replace(textured=textured))
+			return programs[textured]
+		
+		return select_program
+		
+		
+	def _useProgram(self, program):
+		# type: (ShaderProgram) -> bool
+		"""
+		Switches to the program, unless it is already in use, and sets the
+		uniforms shared by every draw of the current pass.
+		
+		\return True if the program was changed.
+		"""
+		if program is self._currentProgram:
+			return False
+		
+		program.use()
+		self._currentProgram = program
+		self.frameStats['programChanges'] += 1
+		
+		for name, value in self._passUniforms.items():
+			uniform = program.__dict__.get(name)
+			if uniform is not None:
+				uniform.set(value)
+		
+		return True
+		
+		
+	def _updateLightClusters(self, camera_matrix):
+		# type: (ndarray) -> None
+		""" Assigns the clustered lights for the frame and binds the results. """
+		
+		clusters = self.lightClusters
+		clusters.update(camera_matrix, self._fov, self.aspectRatio, self.min_z, self.max_z)
 		
+		width, height = self.window.size
+		self._passUniforms['clusterScale'] = array([float(clusters.GridX)/width,
+		                                            float(clusters.GridY)/height,
+		                                            clusters.depthScale], dtype='float32')
+		self._passUniforms['clusterDepthBias'] = clusters.depthBias
 		
-	def drawEntity(self, entity):
+		for binding, texture in zip(self._clusterBindings,
+		                            (clusters.lightTexture, clusters.gridTexture, clusters.indexTexture)):
+			binding.set(texture)
 		
-		model = self.models[entity.modelClass]
-		model_matrix = model.matrix(entity.matrix)
-		self.renderShader.modelMatrix.set(model_matrix)
+		self.frameStats['clusteredLights'] = int(clusters.enabled.sum())
+		self.frameStats['clusterLightIndices'] = clusters.numIndices
 		
-		normal_matrix = transpose(inv(model_matrix))
-		self.renderShader.normalMatrix.set(normal_matrix)
+		
+	def _drawDepth(self, transforms, opaque_only=False, lod_bias=0):
+		# type: (EntityTransforms, bool, int) -> None
+		"""
+		Draws the entities with the depth shader, which must be in use.
+		
+		\param opaque_only  Skip the meshes with transparent materials.
+		\param lod_bias     Added to the entities' levels of detail.
+		"""
+		def depth_meshes(model):
+			if opaque_only:
+				return [mesh for mesh in model.meshes if not mesh.material.transparent]
+			return model.meshes
+		
+		if self.instancing:
+			self._uploadInstances(transforms)
+			for model, start, end in transforms.groups:
+				for mesh in depth_meshes(model):
+					mesh.page.bind()
+					mesh.page.setFirstInstance(start)
+					mesh.drawInstanced(end-start, transforms.lods[start] + lod_bias)
+		
+		else:
+			for model, start, end in transforms.groups:
+				# depth only draws need no per-mesh state, so all of a model's
+				# meshes in one page go in a single call
+				meshes = sorted(depth_meshes(model), key=lambda mesh: id(mesh.page))
+				if not meshes:
+					continue
+				
+				lod = transforms.lods[start] + lod_bias
+				for model_matrix in transforms.modelMatrices[start:end]:
+					self.depthShader.modelMatrix.set(model_matrix)
+					draw_meshes(meshes, lod)
+		
+		
+	def _uploadInstances(self, transforms):
+		# type: (EntityTransforms) -> None
+		"""
+		Uploads the model and normal matrices of all of the entities to the
+		instance buffer.  Each model's instances are drawn from its range of
+		entries, starting at the group's start.
+		"""
+		if len(transforms):
+			self.geometry.setInstances(transforms.instanceData)
+		
+		
+	def drawQueued(self, queue, transforms):
+		# type: (DrawQueue, EntityTransforms) -> None
+		"""
+		Draw the records of a sorted draw queue.  The program, texture and
+		material uniforms are only set when they differ from those of the
+		previous record.
+		Consecutive non-instanced records for the same entity with the same key
+		are merged into a single multi-draw call.
+		
+		\param queue       The queue, built from \p transforms.
+		\param transforms  The transforms of the entities in the queue.  For
+		                   instanced queues these must already have been uploaded.
+		"""
+		program = None
+		texture = None
+		colour = None
+		alpha = None
+		entity_index = None
+		
+		texture_binds = 0
+		material_changes = 0
+		
+		records = queue.records
+		i = 0
+		
+		while i < len(records):
+			key, mesh, start, end = records[i]
+			material = mesh.material
+			
+			j = i + 1
+			if not queue.instanced:
+				while j < len(records) and records[j].start == start and records[j].key == key:
+					j += 1
+			
+			if program is None or key.program != program.program:
+				program = queue.programs[key.program]
+				self._useProgram(program)
+				program.useInstancing.set(int(queue.instanced))
+				
+				# uniforms belong to the program, so must be set again
+				colour = None
+				alpha = None
+				entity_index = None
+			
+			if key.texture != texture:
+				texture = key.texture
+				program.matTextureSampler.set(texture_registry.use(texture))
+				texture_binds += 1
+			
+			if key.colour != colour or key.alpha != alpha:
+				colour = key.colour
+				alpha = key.alpha
+				program.matDiffuseColour.set(material.colour)
+				program.matAlpha.set(material.alpha)
+				material_changes += 1
+			
+			if queue.instanced:
+				mesh.page.bind()
+				mesh.page.setFirstInstance(start)
+				mesh.drawInstanced(end-start, transforms.lods[start])
+			
+			else:
+				if start != entity_index:
+					entity_index = start
+					program.modelMatrix.set(transforms.modelMatrices[start])
+					program.normalMatrix.set(transforms.normalMatrices[start])
+				
+				draw_meshes([record.mesh for record in records[i:j]], transforms.lods[start])
+			
+			i = j
+		
+		self.frameStats['textureBinds'] += texture_binds
+		self.frameStats['materialChanges'] += material_changes
+		
+		
+	def drawEntities(self, transforms, select_program):
+		# type: (EntityTransforms, Callable[[Mesh], ShaderProgram]) -> None
+		"""
+		Draw each of the entities individually, using the precomputed matrices.
+		Entities are drawn with the model of their group, which is the
+		placeholder for those whose model hasn't loaded.
+		
+		\param select_program  Gives the program to draw each mesh with.
+		"""
+		for model, start, end in transforms.groups:
+			for i in range(start, end):
+				self.drawEntity(model, transforms.modelMatrices[i], transforms.normalMatrices[i], select_program)
+		
+		
+	def drawEntity(self, model, model_matrix, normal_matrix, select_program):
+		# type: (Model, ndarray, ndarray, Callable[[Mesh], ShaderProgram]) -> None
+		
+		profiler.begin('drawEntity')
 		
 		for mesh in model.meshes:
-			self.renderShader.matTextureSampler.set(mesh.material.texture)
-			self.renderShader.matDiffuseColour.set(mesh.material.colour)
-			self.renderShader.matAlpha.set(mesh.material.alpha)
+			program = select_program(mesh)
+			self._useProgram(program)
 			
+			program.modelMatrix.set(model_matrix)
+			program.normalMatrix.set(normal_matrix)
+			program.matTextureSampler.set(texture_registry.use(mesh.material.texture))
+			program.matDiffuseColour.set(mesh.material.colour)
+			program.matAlpha.set(mesh.material.alpha)
+			
+			mesh.page.bind()
 			mesh.draw()
-	
-	
+		
+		profiler.end()
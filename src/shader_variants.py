@@ -0,0 +1,116 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from collections import namedtuple, OrderedDict
+
+from shaders import VertexShader, FragmentShader, ShaderProgram
+
+
+
+# The features a variant of the render program is built for.  The light
+# counts are the number of light block slots the variant loops over, and
+# shadowMaps the number of layers of the shadow map array it samples.
+ShaderFeatures = namedtuple('ShaderFeatures', ['directionalLights',
+                                               'pointLights',
+                                               'shadowMaps',
+                                               'clusteredLighting',
+                                               'textured'])
+
+
+
+def light_count_bucket(count):
+	# type: (int) -> int
+	""" Rounds a light count up to a power of two, so that few variants are needed. """
+	bucket = 0 if count == 0 else 1
+	while bucket < count:
+		bucket *= 2
+	return bucket
+
+
+
+class ShaderVariants(object):
+	"""
+	Builds variants of a program from the same sources, each specialised for a
+	set of features which are defined as preprocessor constants.  Compiled
+	variants are kept in a least recently used cache of limited size.
+	"""
+	
+	MaxPrograms = 16
+	
+	def __init__(self, vertex_file, fragment_file, consts, setup):
+		# type: (str, str, Dict[str, Any], Callable[[ShaderProgram, ShaderFeatures], None]) -> None
+		"""
+		\param consts  Constants substituted into every variant.
+		\param setup   Called with each newly built program, while it is in use,
+		               to create its uniforms and attributes.
+		"""
+		self.vertexFile = vertex_file
+		self.fragmentFile = fragment_file
+		self.consts = consts
+		self.setup = setup
+		
+		self._programs = OrderedDict()
+		self.compiled = 0
+		self.loadedFromCache = 0
+		
+		
+	@staticmethod
+	def featureConsts(features):
+		# type: (ShaderFeatures) -> Dict[str, int]
+		return {'NUM_DIRECTIONAL_LIGHTS': features.directionalLights,
+		        'NUM_POINT_LIGHTS':       features.pointLights,
+		        'NUM_SHADOW_MAPS':        features.shadowMaps,
+		        'CLUSTERED_LIGHTING':     int(features.clusteredLighting),
+		        'TEXTURED':               int(features.textured)}
+		
+		
+	def get(self, features):
+		# type: (ShaderFeatures) -> ShaderProgram
+		""" Returns the variant for the features, building it if it isn't cached. """
+		program = self._programs.pop(features, None)
+		
+		if program is None:
+			consts = dict(self.consts)
+			consts.update(self.featureConsts(features))
+			
+			program = ShaderProgram(VertexShader(  shader_file=self.vertexFile,   consts=consts),
+			                        FragmentShader(shader_file=self.fragmentFile, consts=consts))
+			program.use()
+			self.setup(program, features)
+			if program.fromBinaryCache:
+				self.loadedFromCache += 1
+			else:
+				self.compiled += 1
+			
+			if len(self._programs) >= self.MaxPrograms:
+				self._programs.popitem(last=False)
+		
+		self._programs[features] = program
+		return program
+		
+		
+	def programs(self):
+		# type: () -> List[ShaderProgram]
+		""" Returns the cached variants, least recently used first. """
+		return self._programs.values()
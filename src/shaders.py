@@ -22,8 +22,14 @@
 #                                                                             #
 #=============================================================================#
 
+import hashlib
+import os
 from sets import Set
+from numpy import array, array_equal, frombuffer, zeros, int32, uint8, uint32
 from OpenGL.GL import *
+from OpenGL.error import GLError
+
+from cache_files import write_file_atomically
 
 
 
@@ -33,11 +39,12 @@ class ShaderError(Exception):
 
 class Shader(object):
 	"""
-	
+	The shader isn't compiled until it is first attached to a program, so that
+	no time is spent compiling shaders of programs loaded from the binary cache.
 	"""
 
 	def __init__(self, shader_src=None, shader_file=None, consts={}):
-		self.shader = glCreateShader(self.ShaderType)
+		self.shader = None
 		
 		if not shader_src and not shader_file:
 			raise TypeError("No source file or string provided.")
@@ -49,14 +56,24 @@ class Shader(object):
 			for key, value in consts.items():
 				shader_src = shader_src.replace('@'+key+'@', str(value))
 		
-		self.compileSrc(shader_src)
+		self.source = shader_src
 			
 		
 	def __del__(self):
-		glDeleteShader(self.shader)
+		if self.shader is not None:
+			glDeleteShader(self.shader)
+		
+	
+	def compile(self):
+		""" Compiles the shader, if it hasn't been already. """
+		if self.shader is None:
+			self.compileSrc(self.source)
 		
 	
 	def compileSrc(self, src):
+		if self.shader is None:
+			self.shader = glCreateShader(self.ShaderType)
+		
 		glShaderSource(self.shader, src)
 		glCompileShader(self.shader)
 		
@@ -66,6 +83,7 @@ class Shader(object):
 		
 		
 	def attachToProgram(self, program):
+		self.compile()
 		glAttachShader(program, self.shader)
 		
 		
@@ -97,129 +115,341 @@ class VertexAttribute(object):
 
 
 class ShaderUniformVariable(object):
+	"""
+	Base class for uniform variables.  If \p cached is set, the value most
+	recently uploaded is kept and set() skips the upload when called again with
+	an equal value.  The hits and misses counters record how often that happens.
+	
+	The cache assumes that the uniform is only ever set through this object.
+	"""
 
-	def __init__(self, program, var_name):
+	def __init__(self, program, var_name, cached=False):
 		self.location = glGetUniformLocation(program, var_name)
+		self.cached = cached
+		self.hits = 0
+		self.misses = 0
+		self._value = None
+	
+	
+	def invalidate(self):
+		""" Forget the cached value, so that the next set() always uploads. """
+		self._value = None
+	
+	
+	def _scalarChanged(self, val):
+		if not self.cached:
+			return True
+		
+		if val == self._value:
+			self.hits += 1
+			return False
+		
+		self.misses += 1
+		self._value = val
+		return True
+	
+	
+	def _arrayChanged(self, val):
+		if not self.cached:
+			return True
+		
+		if self._value is not None and array_equal(val, self._value):
+			self.hits += 1
+			return False
+		
+		# keep a copy, as the caller may go on to modify its array in place
+		self.misses += 1
+		self._value = array(val)
+		return True
 		
 
 class ShaderUniformInt(ShaderUniformVariable):
 		
 	def set(self, val):
-		glUniform1i(self.location, val)
+		if self._scalarChanged(val):
+			glUniform1i(self.location, val)
 		
 
 class ShaderUniformFloat(ShaderUniformVariable):
 		
 	def set(self, val):
-		glUniform1f(self.location, val)
+		if self._scalarChanged(val):
+			glUniform1f(self.location, val)
 		
 
 class ShaderUniformVector3(ShaderUniformVariable):
 		
 	def set(self, v):
-		if isinstance(v, list):	count = len(v)
-		else:  									count = 1
-		glUniform3fv(self.location, count, v)
+		if self._arrayChanged(v):
+			if isinstance(v, list):	count = len(v)
+			else:  									count = 1
+			glUniform3fv(self.location, count, v)
 		
 
 class ShaderUniformMatrix3(ShaderUniformVariable):
 		
 	def set(self, m, transpose=False):
-		if isinstance(m, list):	count = len(m)
-		else:  									count = 1
-		glUniformMatrix3fv(self.location, count, transpose, m)
+		if self._arrayChanged(m):
+			if isinstance(m, list):	count = len(m)
+			else:  									count = 1
+			glUniformMatrix3fv(self.location, count, transpose, m)
 		
 		
 class ShaderUniformMatrix4(ShaderUniformVariable):
 		
 	def set(self, m, transpose=False):
-		if isinstance(m, list):	count = len(m)
-		else:  									count = 1
-		glUniformMatrix4fv(self.location, count, transpose, m)
+		if self._arrayChanged(m):
+			if isinstance(m, list):	count = len(m)
+			else:  									count = 1
+			glUniformMatrix4fv(self.location, count, transpose, m)
 		
 		
 class ShaderUniformBlockVariable(object):
 	
 	def __init__(self, program, block_name):
+		self.program = program
 		self.location = glGetUniformBlockIndex(program, block_name)
+		
+	def bind(self, binding_point):
+		""" Source the block from the buffer bound to the uniform buffer binding point. """
+		glUniformBlockBinding(self.program, self.location, binding_point)
 
 		
+# The texture most recently bound to each texture unit by a sampler uniform.
+# Unlike other uniform values this is global state, so is shared by all
+# samplers, in all programs, using the same unit.
+_boundTextures = {}
+
+
+def invalidate_texture_bindings():
+	"""
+	Forget which textures the samplers have bound.  This must be called after
+	anything else binds a texture, such as when textures are created.
+	"""
+	_boundTextures.clear()
+
+
 class ShaderUniformSampler(ShaderUniformVariable):
 
-	def __init__(self, program, var_name, texture_unit):
-		super(ShaderUniformSampler, self).__init__(program, var_name)
+	def __init__(self, program, var_name, texture_unit, cached=False, target=GL_TEXTURE_2D):
+		super(ShaderUniformSampler, self).__init__(program, var_name, cached)
 		self.textureUnit = texture_unit
+		self.target = target
 		glUniform1i(self.location, self.textureUnit)
 		
+	def invalidate(self):
+		_boundTextures.pop(self.textureUnit, None)
+		
+	def set(self, val):
+		if self.cached:
+			if _boundTextures.get(self.textureUnit) == val:
+				self.hits += 1
+				return
+			
+			self.misses += 1
+			_boundTextures[self.textureUnit] = val
+		
+		glActiveTexture(GL_TEXTURE0 + self.textureUnit)
+		glBindTexture(self.target, val)
+
+
+
+class TextureBinding(object):
+	"""
+	Binds textures to a fixed texture unit, independently of any program.
+	Samplers of any program which read the unit will see the texture.  Shares
+	the cache of bound textures with the samplers.
+	"""
+	
+	def __init__(self, texture_unit, target=GL_TEXTURE_2D):
+		self.textureUnit = texture_unit
+		self.target = target
+	
 	def set(self, val):
+		if _boundTextures.get(self.textureUnit) == val:
+			return
+		
+		_boundTextures[self.textureUnit] = val
 		glActiveTexture(GL_TEXTURE0 + self.textureUnit)
-		glBindTexture(GL_TEXTURE_2D, val)
+		glBindTexture(self.target, val)
 
 
 
 class ShaderProgram(object):
+	"""
+	A linked program.  Linked programs are kept in an on-disk cache, in the
+	driver's binary format, and are loaded from it rather than compiled from
+	source when possible.  Cached binaries are keyed by the shaders' sources,
+	with their constants substituted, and by the driver's vendor, renderer and
+	version strings; a binary that the driver rejects is discarded and the
+	program is compiled as normal.
+	"""
+
+	# whether uniforms created by the program cache their values by default
+	CacheUniforms = True
+	
+	# the directory linked program binaries are cached in, or None to always
+	# compile programs from source
+	BinaryCacheDir = 'shader_cache'
 
 	def __init__(self, *args):
 		self.program = glCreateProgram()
 		self.shaders = args
+		self.attached = False
 		
 		self.fsTextureUnitPool = Set(range(glGetInteger(GL_MAX_TEXTURE_IMAGE_UNITS)))
 		
-		for shader in self.shaders:
-			shader.attachToProgram(self.program)
-		
-		glLinkProgram(self.program)
+		cache_file = self._binaryCacheFile()
+		self.fromBinaryCache = cache_file is not None and self._loadBinary(cache_file)
 		
-		if not glGetProgramiv(self.program, GL_LINK_STATUS):
-			raise ShaderError(glGetProgramInfoLog(self.program))
+		if not self.fromBinaryCache:
+			for shader in self.shaders:
+				shader.attachToProgram(self.program)
+			self.attached = True
+			
+			if cache_file is not None:
+				glProgramParameteri(self.program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+			
+			glLinkProgram(self.program)
+			
+			if not glGetProgramiv(self.program, GL_LINK_STATUS):
+				raise ShaderError(glGetProgramInfoLog(self.program))
+			
+			if cache_file is not None:
+				self._saveBinary(cache_file)
 			
 	
 	def __del__(self):
-		for shader in self.shaders:
-			shader.detachFromProgram(self.program)
+		if self.attached:
+			for shader in self.shaders:
+				shader.detachFromProgram(self.program)
 		
 		glDeleteProgram(self.program)
 		
 		
-	def uniformInt(self, var_name):
+	def _binaryCacheFile(self):
+		# type: () -> Optional[str]
+		""" Returns the path the program's binary is cached at, or None if it can't be cached. """
+		if self.BinaryCacheDir is None or not glGetInteger(GL_NUM_PROGRAM_BINARY_FORMATS):
+			return None
+		
+		key = hashlib.sha1()
+		for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+			key.update(glGetString(name) + '\0')
+		for shader in self.shaders:
+			key.update(str(shader.ShaderType) + '\0' + shader.source + '\0')
+		
+		return os.path.join(self.BinaryCacheDir, key.hexdigest() + '.bin')
+		
+		
+	def _loadBinary(self, cache_file):
+		# type: (str) -> bool
+		""" Loads the program from the cache file, returns whether it succeeded. """
+		try:
+			with open(cache_file, 'rb') as f:
+				data = f.read()
+		except IOError:
+			return False
+		
+		# the file holds the binary's format followed by the binary itself
+		if len(data) > 4:
+			binary_format = int(frombuffer(data, uint32, 1)[0])
+			binary = frombuffer(data, uint8, offset=4)
+			
+			try:
+				glProgramBinary(self.program, binary_format, binary, len(binary))
+				if glGetProgramiv(self.program, GL_LINK_STATUS):
+					return True
+			except GLError:
+				pass
+		
+		# the driver has been updated, or the file is corrupt
+		try:
+			os.remove(cache_file)
+		except OSError:
+			pass
+		
+		return False
+		
+		
+	def _saveBinary(self, cache_file):
+		# type: (str) -> None
+		length = glGetProgramiv(self.program, GL_PROGRAM_BINARY_LENGTH)
+		if not length:
+			return
+		
+		binary = zeros(length, uint8)
+		binary_format = zeros(1, uint32)
+		written = zeros(1, int32)
+		glGetProgramBinary(self.program, length, written, binary_format, binary)
+		
+		def write(f):
+			f.write(binary_format.tostring())
+			f.write(binary[:written[0]].tostring())
+		
+		# a partly written binary is never loaded
+		write_file_atomically(cache_file, write)
+		
+		
+	def uniformInt(self, var_name, cached=None):
 		if var_name not in self.__dict__:
-			self.__dict__[var_name] = ShaderUniformInt(self.program, var_name)
+			if cached is None:  cached = self.CacheUniforms
+			self.__dict__[var_name] = ShaderUniformInt(self.program, var_name, cached)
 			
 		return self.__dict__[var_name]
 		
 		
-	def uniformFloat(self, var_name):
+	def uniformFloat(self, var_name, cached=None):
 		if var_name not in self.__dict__:
-			self.__dict__[var_name] = ShaderUniformFloat(self.program, var_name)
+			if cached is None:  cached = self.CacheUniforms
+			self.__dict__[var_name] = ShaderUniformFloat(self.program, var_name, cached)
 			
 		return self.__dict__[var_name]
 		
 		
-	def uniformMatrix3(self, var_name):
+	def uniformMatrix3(self, var_name, cached=None):
 		if var_name not in self.__dict__:
-			self.__dict__[var_name] = ShaderUniformMatrix3(self.program, var_name)
+			if cached is None:  cached = self.CacheUniforms
+			self.__dict__[var_name] = ShaderUniformMatrix3(self.program, var_name, cached)
 			
 		return self.__dict__[var_name]
 		
 		
-	def uniformMatrix4(self, var_name):
+	def uniformMatrix4(self, var_name, cached=None):
 		if var_name not in self.__dict__:
-			self.__dict__[var_name] = ShaderUniformMatrix4(self.program, var_name)
+			if cached is None:  cached = self.CacheUniforms
+			self.__dict__[var_name] = ShaderUniformMatrix4(self.program, var_name, cached)
 			
 		return self.__dict__[var_name]
 		
 		
-	def uniformVector3(self, var_name):
+	def uniformVector3(self, var_name, cached=None):
 		if var_name not in self.__dict__:
-			self.__dict__[var_name] = ShaderUniformVector3(self.program, var_name)
+			if cached is None:  cached = self.CacheUniforms
+			self.__dict__[var_name] = ShaderUniformVector3(self.program, var_name, cached)
 			
 		return self.__dict__[var_name]
 		
 		
-	def uniformSampler(self, var_name):
+	def uniformBlock(self, block_name):
+		if block_name not in self.__dict__:
+			self.__dict__[block_name] = ShaderUniformBlockVariable(self.program, block_name)
+		
+		return self.__dict__[block_name]
+		
+		
+	def uniformSampler(self, var_name, cached=None, target=GL_TEXTURE_2D, texture_unit=None):
+		"""
+		\param texture_unit  The unit the sampler reads, if it is not given an unused
+		                     unit is taken from the pool.  The program must be in use.
+		"""
 		if var_name not in self.__dict__:
-			texture_unit = self.fsTextureUnitPool.pop()
-			self.__dict__[var_name] = ShaderUniformSampler(self.program, var_name, texture_unit)
+			if cached is None:  cached = self.CacheUniforms
+			if texture_unit is None:
+				texture_unit = self.fsTextureUnitPool.pop()
+			else:
+				self.fsTextureUnitPool.discard(texture_unit)
+			self.__dict__[var_name] = ShaderUniformSampler(self.program, var_name, texture_unit, cached, target)
 		
 		return self.__dict__[var_name]
 		
@@ -231,5 +461,23 @@ class ShaderProgram(object):
 		return self.__dict__[var_name]
 		
 		
+	def uniforms(self):
+		""" Returns all of the uniform variables created through the program. """
+		return [var for var in self.__dict__.values() if isinstance(var, ShaderUniformVariable)]
+		
+		
+	def uniformCacheStats(self):
+		# type: () -> Tuple[int, int]
+		""" Returns the total (hits, misses) of the program's uniform caches. """
+		uniforms = self.uniforms()
+		return (sum(var.hits for var in uniforms), sum(var.misses for var in uniforms))
+		
+		
+	def resetUniformCacheStats(self):
+		for var in self.uniforms():
+			var.hits = 0
+			var.misses = 0
+		
+		
 	def use(self):
 		glUseProgram(self.program)
@@ -28,11 +28,31 @@
 // Input vertex data
 layout (location = 0) in vec3 vertexPosition;
 
+// Per-instance data, only read when useInstancing is set
+layout (location = 3) in mat4 instanceModelMatrix;
+
 uniform mat4 modelMatrix;
 uniform mat4 viewMatrix;
 
+uniform bool useInstancing;
+
+// The depth pre-pass is followed by the render program testing for equal
+// depths, so both must compute positions in exactly the same way
+invariant gl_Position;
+
 
 void main()
 {
-	gl_Position = viewMatrix * modelMatrix * vec4(vertexPosition, 1.0);
+	mat4 model_matrix;
+	
+	if (useInstancing)
+	{
+		model_matrix = instanceModelMatrix;
+	}
+	else
+	{
+		model_matrix = modelMatrix;
+	}
+	
+	gl_Position = viewMatrix * (model_matrix * vec4(vertexPosition, 1.0));
 }
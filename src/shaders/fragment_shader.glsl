@@ -24,11 +24,24 @@
 
 #version 330 core
 
+// Features of this variant, see shader_variants.py
+#define NUM_DIRECTIONAL_LIGHTS @NUM_DIRECTIONAL_LIGHTS@
+#define NUM_POINT_LIGHTS       @NUM_POINT_LIGHTS@
+#define NUM_SHADOW_MAPS        @NUM_SHADOW_MAPS@
+#define CLUSTERED_LIGHTING     @CLUSTERED_LIGHTING@
+#define TEXTURED               @TEXTURED@
+
+// Directional lights take the first slots of the light block, and point
+// lights the rest
+#define MAX_DIRECTIONAL_LIGHTS @MAX_DIRECTIONAL_LIGHTS@
+
 
 in vec2 uv;
 in vec3 normal;
 in vec3 modelPosition;
-in vec4 modelPositionLightView[@NUM_LIGHTS@];
+#if NUM_SHADOW_MAPS > 0
+in vec4 modelPositionLightView[NUM_SHADOW_MAPS];
+#endif
 
 out vec4 colour;
 
@@ -44,51 +57,95 @@ uniform vec3      matAmbientColour  = vec3(1.0, 1.0, 1.0);
 uniform vec3      matDiffuseColour  = vec3(1.0, 1.0, 1.0);
 uniform vec3      matSpecularColour = vec3(1.0, 1.0, 1.0);
 
-uniform float ambientLightAmplitude = float(0.0);
-uniform vec3  ambientLightColour    = vec3(1.0, 1.0, 1.0);
+struct Light
+{
+	vec3  vector;
+	float amplitude;
+	vec3  colour;
+	int   type;
+	
+	// the light's layer of the shadow map array, or -1
+	int   shadowIndex;
+};
+
+struct Shadow
+{
+	mat4  viewMatrix;
+	
+	// per shadow cascade: the cascade's projection from light view space and
+	// its region of the shadow atlas
+	vec4  cascadeScale[@NUM_CASCADES@];
+	vec4  cascadeOffset[@NUM_CASCADES@];
+	vec4  cascadeRect[@NUM_CASCADES@];
+};
 
-uniform int       lightType[@NUM_LIGHTS@];
-uniform vec3      lightVector[@NUM_LIGHTS@];
-uniform float     lightAmplitude[@NUM_LIGHTS@];
-uniform vec3      lightColour[@NUM_LIGHTS@];
-uniform sampler2D lightShadowMapSampler[@NUM_LIGHTS@];
+// Light state, laid out to match LightBlock in lighting.py
+layout (std140) uniform LightBlock
+{
+	vec3   ambientLightColour;
+	float  ambientLightAmplitude;
+	Light  lights[@NUM_LIGHTS@];
+	Shadow shadows[@MAX_SHADOW_MAPS@];
+};
 
+// every light's shadow map, one layer each
+uniform sampler2DArray shadowMapSampler;
 
-float calculate_shadow_coef(vec4      model_pos_light_view,
-                            sampler2D shadow_map_sampler,
-                            vec3      light_direction)
+// Clustered point lights, assigned to a grid of clusters by LightClusters in
+// light_clusters.py.  Each light is two texels of clusterLightData, position
+// and amplitude then colour and radius.  Each cluster's texel of clusterGrid
+// is an offset and count into clusterLightIndices.
+const ivec3 clusterGridSize = ivec3(@CLUSTER_GRID_X@, @CLUSTER_GRID_Y@, @CLUSTER_GRID_Z@);
+
+uniform samplerBuffer  clusterLightData;
+uniform usamplerBuffer clusterGrid;
+uniform usamplerBuffer clusterLightIndices;
+
+// maps window coordinates to tiles, and log(view depth) to slices
+uniform vec3  clusterScale;
+uniform float clusterDepthBias;
+
+
+float calculate_shadow_coef(vec4   model_pos_light_view,
+                            Shadow shadow,
+                            int    shadow_index)
 {
-	vec3 model_pos_light_view_proj = (model_pos_light_view.xyz/model_pos_light_view.w)*0.5 + 0.5;
-	float frag_depth = model_pos_light_view_proj.z;
-	
-	if (frag_depth > 1.0) return 0.0;
-	
+	vec2 texel_size = 1.0/textureSize(shadowMapSampler, 0).xy;
 	float bias = 0.002;//max(0.002*(1.0 - dot(normal, light_direction)), 0.0002);
 	//bias *= 1.0 - dot(normal, light_direction);
-	float shadow_coef = 0.0;
-	vec2 texel_size = 1.0/textureSize(shadow_map_sampler, 0);
 	
-	for (int x = -1; x <= 1; x++)
+	// use the first, and so finest, cascade that contains the fragment
+	for (int c = 0; c < @NUM_CASCADES@; c++)
 	{
-		for (int y = -1; y <= 1; y++)
+		vec3 cascade_pos = (model_pos_light_view.xyz*shadow.cascadeScale[c].xyz + shadow.cascadeOffset[c].xyz)*0.5 + 0.5;
+		float frag_depth = cascade_pos.z;
+		
+		// keep the filter's samples inside the cascade's region of the atlas
+		vec2 margin = 1.5*texel_size/shadow.cascadeRect[c].zw;
+		
+		if (any(lessThan(cascade_pos.xy, margin)) || any(greaterThan(cascade_pos.xy, 1.0 - margin)) ||
+		    frag_depth > 1.0)
 		{
-			vec2 frag_coords = model_pos_light_view_proj.xy + vec2(x, y)*texel_size;
-			float light_depth = texture(shadow_map_sampler, frag_coords).r;
-			shadow_coef += frag_depth-bias > light_depth ? 1.0 : 0.0;
+			continue;
 		}
+		
+		vec2 atlas_coords = cascade_pos.xy*shadow.cascadeRect[c].zw + shadow.cascadeRect[c].xy;
+		float shadow_coef = 0.0;
+		
+		for (int x = -1; x <= 1; x++)
+		{
+			for (int y = -1; y <= 1; y++)
+			{
+				vec2 frag_coords = atlas_coords + vec2(x, y)*texel_size;
+				float light_depth = texture(shadowMapSampler, vec3(frag_coords, shadow_index)).r;
+				shadow_coef += frag_depth-bias > light_depth ? 1.0 : 0.0;
+			}
+		}
+		
+		return shadow_coef/9.0;
 	}
 	
-	shadow_coef /= 9.0;
-	
-	//float light_depth = texture(shadow_map_sampler, model_pos_light_view_proj.xy).r;
-	//float bias = 0.002;//max(0.002*(1.0 - dot(normal, light_direction)), 0.0002);
-	////bias *= 1.0 - dot(normal, light_direction);
-	//
-	////float shadow_coef = (frag_depth-bias) > light_depth ? 1.0 : 0.0;
-	//float shadow_coef = frag_depth-bias > light_depth ? 1.0 : 0.0;
-	////if (frag_depth > 1.0) shadow_coef = 0.0;
-	
-	return shadow_coef;
+	return 0.0;
 }
 
 
@@ -113,58 +170,121 @@ vec3 calculate_specular_light(vec3 base_colour,
 }
 
 
+vec3 calculate_point_light(vec3  base_colour,
+                           vec3  light_position,
+                           float amplitude,
+                           vec3  light_colour,
+                           vec3  camera_direction,
+                           vec3  normalized_normal)
+{
+	vec3 light_to_model = modelPosition-light_position;
+	float r = length(light_to_model);
+	float a = amplitude;
+	
+	vec3 colour_amplitude = light_colour/((0.1/a)*r*r+(1/(a*a))*r+1);
+	vec3 specular_amplitude = colour_amplitude*a;
+	vec3 light_direction = normalize(light_to_model);
+	
+	return calculate_diffuse_light(base_colour,
+	                               colour_amplitude,
+	                               light_direction,
+	                               normalized_normal) +
+	       calculate_specular_light(base_colour,
+	                                specular_amplitude,
+	                                camera_direction,
+	                                light_direction,
+	                                normalized_normal);
+}
+
+
+vec3 apply_clustered_lighting(vec3 base_colour,
+                              vec3 camera_direction,
+                              vec3 normalized_normal)
+{
+	vec3 lit_colour = vec3(0.0, 0.0, 0.0);
+	
+	// gl_FragCoord.w is the reciprocal of the view depth
+	ivec3 cell = ivec3(vec3(gl_FragCoord.xy, -log(gl_FragCoord.w))*clusterScale + vec3(0.0, 0.0, clusterDepthBias));
+	cell = clamp(cell, ivec3(0), clusterGridSize - 1);
+	int cluster = (cell.z*clusterGridSize.y + cell.y)*clusterGridSize.x + cell.x;
+	
+	uvec2 lights_range = texelFetch(clusterGrid, cluster).rg;
+	
+	for (uint j = 0u; j < lights_range.y; j++)
+	{
+		int light_index = int(texelFetch(clusterLightIndices, int(lights_range.x + j)).r);
+		vec4 position_amplitude = texelFetch(clusterLightData, 2*light_index);
+		vec4 colour_radius      = texelFetch(clusterLightData, 2*light_index + 1);
+		
+		lit_colour += calculate_point_light(base_colour,
+		                                    position_amplitude.xyz,
+		                                    position_amplitude.w,
+		                                    colour_radius.rgb,
+		                                    camera_direction,
+		                                    normalized_normal);
+	}
+	
+	return lit_colour;
+}
+
+
 vec3 apply_lighting(vec3 base_colour)
 {
 	vec3 lit_colour = vec3(0.0, 0.0, 0.0);
 	vec3 camera_direction = normalize(cameraPosition-modelPosition);
 	vec3 normalized_normal = normalize(normal);
-	float shadow_coef;
-	vec3 shadowed_light;
 	int i;
 	
-	for (i = 0; i < @NUM_LIGHTS@; i++)
+#if NUM_DIRECTIONAL_LIGHTS > 0
+	for (i = 0; i < NUM_DIRECTIONAL_LIGHTS; i++)
 	{
-		switch (lightType[i])
+		if (lights[i].type == 1)
 		{
-		case 1: // directional
-			shadow_coef = calculate_shadow_coef(modelPositionLightView[i],
-			                                    lightShadowMapSampler[i],
-			                                    lightVector[i]);
-			shadowed_light = lightColour[i]*(1.0 - shadow_coef);
+			vec3 light_colour = lights[i].colour;
 			
-			lit_colour += calculate_diffuse_light(base_colour,
-			                                      shadowed_light,
-			                                      lightVector[i],
-			                                      normalized_normal);
-		
-			lit_colour += calculate_specular_light(base_colour,
-			                                       shadowed_light,
-			                                       camera_direction,
-			                                       lightVector[i],
-			                                       normalized_normal);
-			break;
-		
-		case 2: // point
-			vec3 light_to_model = modelPosition-lightVector[i];
-			float r = length(light_to_model);
-			
-			vec3 colour_amplitude = lightColour[i]/((0.1/lightAmplitude[i])*r*r+(1/(lightAmplitude[i]*lightAmplitude[i]))*r+1);
-			vec3 specular_amplitude = colour_amplitude*lightAmplitude[i];
-			vec3 light_direction = normalize(light_to_model);
+#if NUM_SHADOW_MAPS > 0
+			int s = lights[i].shadowIndex;
+			if (s >= 0 && s < NUM_SHADOW_MAPS)
+			{
+				float shadow_coef = calculate_shadow_coef(modelPositionLightView[s],
+				                                          shadows[s],
+				                                          s);
+				light_colour *= 1.0 - shadow_coef;
+			}
+#endif
 			
 			lit_colour += calculate_diffuse_light(base_colour,
-			                                      colour_amplitude,
-			                                      light_direction,
+			                                      light_colour,
+			                                      lights[i].vector,
 			                                      normalized_normal);
 		
 			lit_colour += calculate_specular_light(base_colour,
-			                                       specular_amplitude,
+			                                       light_colour,
 			                                       camera_direction,
-			                                       light_direction,
+			                                       lights[i].vector,
 			                                       normalized_normal);
-			break;
 		}
 	}
+#endif
+	
+#if NUM_POINT_LIGHTS > 0
+	for (i = MAX_DIRECTIONAL_LIGHTS; i < MAX_DIRECTIONAL_LIGHTS + NUM_POINT_LIGHTS; i++)
+	{
+		if (lights[i].type == 2)
+		{
+			lit_colour += calculate_point_light(base_colour,
+			                                    lights[i].vector,
+			                                    lights[i].amplitude,
+			                                    lights[i].colour,
+			                                    camera_direction,
+			                                    normalized_normal);
+		}
+	}
+#endif
+	
+#if CLUSTERED_LIGHTING
+	lit_colour += apply_clustered_lighting(base_colour, camera_direction, normalized_normal);
+#endif
 	
 	lit_colour += base_colour*ambientLightColour*ambientLightAmplitude;
 	
@@ -174,14 +294,18 @@ vec3 apply_lighting(vec3 base_colour)
 
 void main()
 {
+#if TEXTURED
 	vec3 tex_colour = texture(matTextureSampler, uv).rgb;
+#else
+	vec3 tex_colour = vec3(1.0, 1.0, 1.0);
+#endif
 	if (useLighting)
 	{
 		colour = vec4(apply_lighting(tex_colour), matAlpha);
 	}
 	else
 	{
-		//colour = vec4(vec3(texture(lightShadowMapSampler[0], uv).r), matAlpha);
+		//colour = vec4(vec3(texture(shadowMapSampler, vec3(uv, 0)).r), matAlpha);
 		colour = vec4(matDiffuseColour*tex_colour, matAlpha);
 	}
 }
@@ -24,38 +24,97 @@
 
 #version 330 core
 
+// Features of this variant, see shader_variants.py
+#define NUM_SHADOW_MAPS @NUM_SHADOW_MAPS@
+
 
 // Input vertex data
 layout (location = 0) in vec3 vertexPosition;
 layout (location = 1) in vec2 vertexUv;
 layout (location = 2) in vec3 vertexNormal;
 
+// Per-instance data, only read when useInstancing is set
+layout (location = 3) in mat4 instanceModelMatrix;
+layout (location = 7) in mat4 instanceNormalMatrix;
+
 out vec2 uv;
 out vec3 normal;
 out vec3 modelPosition;
-out vec4 modelPositionLightView[@NUM_LIGHTS@];
+#if NUM_SHADOW_MAPS > 0
+out vec4 modelPositionLightView[NUM_SHADOW_MAPS];
+#endif
 
 uniform mat4 modelMatrix;
 uniform mat4 normalMatrix;
 uniform mat4 viewMatrix;
 
-uniform mat4 lightViewMatrix[@NUM_LIGHTS@];
+uniform bool useInstancing;
+
+// must match the depth pre-pass exactly, see depth_vertex_shader.glsl
+invariant gl_Position;
+
+struct Light
+{
+	vec3  vector;
+	float amplitude;
+	vec3  colour;
+	int   type;
+	
+	// the light's layer of the shadow map array, or -1
+	int   shadowIndex;
+};
+
+struct Shadow
+{
+	mat4  viewMatrix;
+	
+	// per shadow cascade: the cascade's projection from light view space and
+	// its region of the shadow atlas
+	vec4  cascadeScale[@NUM_CASCADES@];
+	vec4  cascadeOffset[@NUM_CASCADES@];
+	vec4  cascadeRect[@NUM_CASCADES@];
+};
+
+// Light state, laid out to match LightBlock in lighting.py
+layout (std140) uniform LightBlock
+{
+	vec3   ambientLightColour;
+	float  ambientLightAmplitude;
+	Light  lights[@NUM_LIGHTS@];
+	Shadow shadows[@MAX_SHADOW_MAPS@];
+};
 
 
 void main()
 {
 	vec4 modelPosition4;
+	mat4 model_matrix;
+	mat4 normal_matrix;
+	
+	if (useInstancing)
+	{
+		model_matrix  = instanceModelMatrix;
+		normal_matrix = instanceNormalMatrix;
+	}
+	else
+	{
+		model_matrix  = modelMatrix;
+		normal_matrix = normalMatrix;
+	}
 	
-	modelPosition4 = modelMatrix * vec4(vertexPosition, 1.0);
+	modelPosition4 = model_matrix * vec4(vertexPosition, 1.0);
 	gl_Position = viewMatrix * modelPosition4;
 	
 	uv = vertexUv;
-	normal = mat3(normalMatrix)*vertexNormal;
+	normal = mat3(normal_matrix)*vertexNormal;
 	modelPosition = modelPosition4.xyz;
 	
+#if NUM_SHADOW_MAPS > 0
+	// one position per shadow map, rather than per light
 	int i;
-	for (i = 0; i < @NUM_LIGHTS@; i++)
+	for (i = 0; i < NUM_SHADOW_MAPS; i++)
 	{
-		modelPositionLightView[i] = lightViewMatrix[i] * modelPosition4;
+		modelPositionLightView[i] = shadows[i].viewMatrix * modelPosition4;
 	}
+#endif
 }
@@ -0,0 +1,169 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+from math import tan
+from numpy import array, array_equal, arange, ones
+from numpy.linalg import inv
+from OpenGL.GL import *
+
+
+
+def cascade_splits(near, far, count, weight):
+	# type: (float, float, int, float) -> ndarray
+	"""
+	Divides the distance from \p near to \p far into slices, one per cascade.
+	Each split is a blend of evenly and logarithmically spaced distances.
+	
+	\param weight  How logarithmic the spacing is, from 0 (even) to 1.
+	\return (count + 1) array of distances, starting at \p near and ending at \p far.
+	"""
+	i = arange(count + 1, dtype=float)/count
+	return weight*near*(far/near)**i + (1. - weight)*(near + (far - near)*i)
+
+
+
+def frustum_slice_corners(camera_matrix, fov, aspect, near, far):
+	# type: (ndarray, float, float, float, float) -> ndarray
+	"""
+	\param camera_matrix  The camera's world to view space matrix.
+	\param fov            (rad) The camera's field of view in the y direction.
+	\param aspect         The camera's aspect ratio, width/height.
+	\param near           Distance from the camera to the near side of the slice.
+	\param far            Distance from the camera to the far side of the slice.
+	\return (8, 3) array of the corners of the slice in world space.
+	"""
+	corners = ones((8, 4))
+	
+	for i, z in enumerate((near, far)):
+		y = z*tan(fov/2.)
+		x = y*aspect
+		corners[4*i:4*i+4, 0:3] = ((-x, -y, -z), (x, -y, -z), (-x, y, -z), (x, y, -z))
+	
+	return corners.dot(inv(camera_matrix))[:, 0:3]
+
+
+
+class ShadowMapCache(object):
+	"""
+	Records what one cascade of a directional light's shadow map was last
+	rendered from, so that it is only rendered again when something that
+	affects it has changed.
+	
+	It also holds the cascade's static layer: a depth texture containing only
+	the static shadow casters.  The static layer is rendered when the cascade
+	or the set of static entities changes, and is copied into the cascade
+	before the dynamic casters are drawn over it.
+	"""
+	
+	def __init__(self, light, cascade):
+		# type: (DirectionalLight, ShadowCascade) -> None
+		self.light = light
+		self.cascade = cascade
+		
+		self._staticState = None
+		self._dynamicState = None
+		self._casterEntities = None
+		self._casterMatrices = None
+		self._casterLods = None
+		
+		self.hasStaticLayer = False
+		self.staticBuffer  = glGenFramebuffers(1)
+		self.staticTexture = glGenTextures(1)
+		
+		glBindTexture(GL_TEXTURE_2D, self.staticTexture)
+		glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT,
+		             cascade.resolution, cascade.resolution, 0, GL_DEPTH_COMPONENT,
+		             GL_FLOAT, None)
+		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+		
+		glBindFramebuffer(GL_FRAMEBUFFER, self.staticBuffer)
+		glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, self.staticTexture, 0)
+		glDrawBuffer(GL_NONE)
+		glReadBuffer(GL_NONE)
+		glBindFramebuffer(GL_FRAMEBUFFER, 0)
+		
+		
+	def __del__(self):
+		glDeleteFramebuffers(1, [self.staticBuffer])
+		glDeleteTextures([self.staticTexture])
+		
+		
+	def staticChanged(self, static_version, model_version):
+		# type: (int, Tuple[int, int]) -> bool
+		"""
+		\param static_version  A counter that changes whenever the static entities
+		                       change.
+		\param model_version   Changes whenever the models, or their transforms,
+		                       change.
+		\return True if the static layer must be rendered again, in which case it
+		        is assumed that it will be.
+		"""
+		state = (self.cascade.version, static_version, model_version)
+		if state == self._staticState:
+			return False
+		
+		self._staticState = state
+		return True
+		
+		
+	def castersChanged(self, model_version, casters):
+		# type: (Tuple[int, int], EntityTransforms) -> bool
+		"""
+		\param model_version  Changes whenever the models, or their transforms, change.
+		\param casters        The dynamic casters the shadow map would be drawn with.
+		\return True if the cascade or the dynamic casters, or their levels of
+		        detail, differ from those it was last rendered with, in which case
+		        it is assumed that it will be rendered with these.
+		"""
+		state = (self.cascade.version, model_version)
+		
+		if (state == self._dynamicState and
+		    casters.entities == self._casterEntities and
+		    array_equal(casters.modelMatrices, self._casterMatrices) and
+		    array_equal(casters.lods, self._casterLods)):
+			return False
+		
+		self._dynamicState = state
+		self._casterEntities = list(casters.entities)
+		self._casterMatrices = array(casters.modelMatrices)
+		self._casterLods = array(casters.lods)
+		return True
+		
+		
+	def invalidate(self):
+		""" Forces both the static layer and the cascade to be rendered again. """
+		self._staticState = None
+		self._dynamicState = None
+		
+		
+	def copyStaticLayer(self):
+		"""
+		Copies the static layer into the cascade's region of the light's shadow
+		atlas, leaving the atlas bound for drawing.
+		"""
+		x, y, size = self.cascade.x, self.cascade.y, self.cascade.resolution
+		glBindFramebuffer(GL_READ_FRAMEBUFFER, self.staticBuffer)
+		glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.light.depthBuffer)
+		glBlitFramebuffer(0, 0, size, size, x, y, x + size, y + size, GL_DEPTH_BUFFER_BIT, GL_NEAREST)
@@ -0,0 +1,539 @@
+#=============================================================================#
+#                                                                             #
+# Copyright (c) 2016                                                          #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+#                                                                             #
+#=============================================================================#
+
+import hashlib
+import os
+from threading import Lock
+from PIL import Image
+from numpy import asarray, array, empty, pad, float32, uint8, clip, einsum, argmin, argmax, arange
+from OpenGL.GL import *
+from OpenGL.GL.EXT.texture_compression_s3tc import GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+
+from cache_files import write_cache_file, map_cache_file
+from shaders import invalidate_texture_bindings
+
+
+
+# The directory preprocessed textures are cached in.
+TextureCacheDir = 'texture_cache'
+
+# Changed whenever the contents of the cache files change.
+TextureCacheVersion = 1
+
+# Whether opaque textures are block compressed with BC1 (DXT1), which takes 4
+# bits per texel, an eighth of the space of an uncompressed texture.  BC1 isn't
+# part of core OpenGL, so textures are only compressed if the context supports
+# it, see init_texture_compression.
+CompressTextures = True
+
+# whether the context supports BC1 textures, set by init_texture_compression
+_compressionSupported = False
+
+# The wrap mode, magnification filter and minification filter of a texture.
+DefaultSampler = (GL_REPEAT, GL_LINEAR, GL_LINEAR_MIPMAP_LINEAR)
+
+_Magic = 'OGLXTEX1'
+
+# the internal format and pixel format of each kind of texture data
+_Formats = {'rgb':  (GL_RGB8,  GL_RGB),
+            'rgba': (GL_RGBA8, GL_RGBA),
+            'bc1':  (GL_COMPRESSED_RGB_S3TC_DXT1_EXT, None)}
+
+_BC1BlockDtype = [('colour0', '<u2'), ('colour1', '<u2'), ('indices', '<u4')]
+
+
+
+class TextureData(object):
+	"""
+	A texture's whole mip chain, ready to be uploaded level by level.  Creating
+	it needs no GL context, only upload() does.
+	"""
+	
+	def __init__(self, data_format, levels):
+		# type: (str, List[Tuple[int, int, numpy.ndarray]]) -> None
+		"""
+		\param data_format  'rgb' or 'rgba' for 8 bit channels, or 'bc1'.
+		\param levels       The width, height and data of each level, largest first.
+		"""
+		self.format = data_format
+		self.levels = levels
+	
+	@property
+	def compressed(self):
+		# type: () -> bool
+		return self.format == 'bc1'
+	
+	@property
+	def size(self):
+		# type: () -> int
+		"""
+		The estimated video memory taken by the texture, in bytes.  Drivers
+		usually pad RGB texels to 4 bytes.
+		"""
+		if self.compressed:
+			return sum(data.nbytes for width, height, data in self.levels)
+		else:
+			return sum(width*height*4 for width, height, data in self.levels)
+	
+	def upload(self, sampler=DefaultSampler):
+		# type: (Tuple[int, int, int]) -> int
+		""" Creates a texture from the levels, which is left bound. """
+		internal_format, pixel_format = _Formats[self.format]
+		
+		texture = glGenTextures(1)
+		glBindTexture(GL_TEXTURE_2D, texture)
+		
+		# rows of RGB levels aren't padded to 4 bytes
+		glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+		
+		for level, (width, height, data) in enumerate(self.levels):
+			if self.compressed:
+				glCompressedTexImage2D(GL_TEXTURE_2D, level, internal_format,
+				                       width, height, 0, data.nbytes, data)
+			else:
+				glTexImage2D(GL_TEXTURE_2D, level, internal_format,
+				             width, height, 0, pixel_format,
+				             GL_UNSIGNED_BYTE, data)
+		
+		glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+		
+		wrap, mag_filter, min_filter = sampler
+		glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(self.levels) - 1)
+		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, wrap)
+		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, wrap)
+		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, mag_filter)
+		glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, min_filter)
+		
+		return texture
+
+
+
+def mip_chain(pixels):
+	# type: (numpy.ndarray) -> List[numpy.ndarray]
+	"""
+	Box filters an image of shape (height, width, channels) down to 1x1.  Each
+	level is half the size of the previous, rounded down as OpenGL expects, so
+	the last row or column of odd sized levels is dropped.
+	"""
+	levels = [pixels]
+	level = pixels.astype(float32)
+	
+	while level.shape[0] > 1 or level.shape[1] > 1:
+		for axis in (0, 1):
+			size = level.shape[axis]
+			if size > 1:
+				even = size // 2 * 2
+				level = (level.take(arange(0, even, 2), axis) + level.take(arange(1, even, 2), axis)) * 0.5
+		
+		levels.append(clip(level + 0.5, 0, 255).astype(uint8))
+	
+	return levels
+
+
+
+def _expand_565(colours):
+	# type: (numpy.ndarray) -> numpy.ndarray
+	""" Expands packed 5:6:5 colours to 8 bit channels, as the GPU does. """
+	r = (colours >> 11) & 31
+	g = (colours >> 5) & 63
+	b = colours & 31
+	
+	expanded = empty(colours.shape + (3,), dtype=float32)
+	expanded[..., 0] = (r << 3) | (r >> 2)
+	expanded[..., 1] = (g << 2) | (g >> 4)
+	expanded[..., 2] = (b << 3) | (b >> 2)
+	return expanded
+
+
+
+def _pack_565(colours):
+	# type: (numpy.ndarray) -> numpy.ndarray
+	r = (colours[..., 0] * (31/255.) + 0.5).astype('<u2')
+	g = (colours[..., 1] * (63/255.) + 0.5).astype('<u2')
+	b = (colours[..., 2] * (31/255.) + 0.5).astype('<u2')
+	return (r << 11) | (g << 5) | b
+
+
+
+def compress_bc1(pixels):
+	# type: (numpy.ndarray) -> numpy.ndarray
+	"""
+	Compresses an RGB image to BC1 blocks, in the order OpenGL expects them.
+	Each 4x4 block's end points are its two texels furthest apart along the
+	principal axis of its colours, and each texel takes the nearest of the
+	four colours interpolated between them.
+	
+	\return The blocks as bytes.
+	"""
+	height, width = pixels.shape[:2]
+	
+	# partial blocks at the edges are filled out by repeating the edge texels
+	pixels = pad(pixels[..., :3], ((0, -height % 4), (0, -width % 4), (0, 0)), 'edge')
+	blocks_high = pixels.shape[0] // 4
+	blocks_wide = pixels.shape[1] // 4
+	
+	blocks = pixels.reshape(blocks_high, 4, blocks_wide, 4, 3).swapaxes(1, 2).reshape(-1, 16, 3).astype(float32)
+	
+	# the principal axis by power iteration on each block's covariance, starting
+	# from the covariance of the channel which varies most
+	centred = blocks - blocks.mean(axis=1)[:, None, :]
+	covariance = einsum('nki,nkj->nij', centred, centred)
+	block_index = arange(len(blocks))
+	axis = covariance[block_index, argmax(einsum('nii->ni', covariance), axis=1)]
+	for i in range(8):
+		axis = einsum('nij,nj->ni', covariance, axis)
+		axis /= abs(axis).max(axis=1)[:, None] + 1e-20
+	
+	projections = einsum('nki,ni->nk', centred, axis)
+	end0 = blocks[block_index, argmax(projections, axis=1)]
+	end1 = blocks[block_index, argmin(projections, axis=1)]
+	
+	# the end points must be in decreasing order to select the four colour mode,
+	# equal end points select the three colour mode, but all texels take the
+	# first colour in that case anyway
+	colour0 = _pack_565(end0)
+	colour1 = _pack_565(end1)
+	swap = colour0 < colour1
+	colour0[swap], colour1[swap] = colour1[swap], colour0[swap]
+	
+	expanded0 = _expand_565(colour0)
+	expanded1 = _expand_565(colour1)
+	palette = array([expanded0, expanded1,
+	                 (2*expanded0 + expanded1) / 3.,
+	                 (expanded0 + 2*expanded1) / 3.]).swapaxes(0, 1)
+	
+	distances = ((blocks[:, :, None, :] - palette[:, None, :, :])**2).sum(axis=3)
+	indices = argmin(distances, axis=2).astype('<u4')
+	
+	compressed = empty(len(blocks), dtype=_BC1BlockDtype)
+	compressed['colour0'] = colour0
+	compressed['colour1'] = colour1
+	compressed['indices'] = (indices << (arange(16, dtype='<u4') * 2)).sum(axis=1)
+	
+	return compressed.view(uint8)
+
+
+
+def init_texture_compression():
+	"""
+	Checks whether the context supports BC1 textures.  Must be called on the
+	context's thread before any textures are loaded, until then they aren't
+	compressed.
+	"""
+	global _compressionSupported
+	
+	extensions = [glGetStringi(GL_EXTENSIONS, i) for i in range(glGetInteger(GL_NUM_EXTENSIONS))]
+	_compressionSupported = 'GL_EXT_texture_compression_s3tc' in extensions
+
+
+
+def _compression(compress):
+	# type: (Optional[bool]) -> bool
+	""" Whether textures are to be compressed, given an override of CompressTextures. """
+	if compress is None:
+		compress = CompressTextures
+	return compress and _compressionSupported
+
+
+
+def build_texture(image, compress=None):
+	# type: (PIL.Image.Image, Optional[bool]) -> TextureData
+	"""
+	Builds a texture's mip chain from an RGB or RGBA image, block compressing it
+	if it is opaque and compression is enabled.
+	
+	\param compress  Overrides CompressTextures, though textures are still only
+	                 compressed if the context supports it.
+	"""
+	if image.mode == "RGB":
+		data_format = 'rgb'
+	elif image.mode == "RGBA":
+		data_format = 'rgba'
+	else:
+		raise TypeError("Texture mode "+image.mode+" not supported")
+	
+	compress = _compression(compress)
+	
+	pixels = asarray(image)
+	if data_format == 'rgba' and (pixels[..., 3] == 255).all():
+		pixels = pixels[..., :3]
+		data_format = 'rgb'
+	
+	levels = mip_chain(pixels)
+	
+	if compress and data_format == 'rgb':
+		return TextureData('bc1', [(level.shape[1], level.shape[0], compress_bc1(level)) for level in levels])
+	else:
+		return TextureData(data_format, [(level.shape[1], level.shape[0], level.reshape(-1)) for level in levels])
+
+
+
+def texture_cache_file(filename, compress):
+	# type: (str, bool) -> str
+	"""
+	Returns the path an image file's texture is cached at, keyed by a hash of
+	its contents and by whether it is compressed, which depends on the
+	context's support for compression as well as on CompressTextures.
+	"""
+	key = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		key.update(f.read())
+	key.update(repr((TextureCacheVersion, compress)))
+	
+	return os.path.join(TextureCacheDir, key.hexdigest() + '.tex')
+
+
+
+def save_texture(texture, cache_file):
+	# type: (TextureData, str) -> None
+	header = {'format': texture.format,
+	          'levels': [[width, height] for width, height, data in texture.levels]}
+	
+	write_cache_file(cache_file, _Magic, header, [data for width, height, data in texture.levels])
+
+
+
+def load_cached_texture(cache_file):
+	# type: (str) -> TextureData
+	"""
+	Maps a texture's cache file into memory, so its levels are read straight
+	from the file as they are uploaded.
+	
+	Raises IOError if there is no such file and ValueError if it isn't valid.
+	"""
+	header, arrays = map_cache_file(cache_file, _Magic)
+	
+	return TextureData(str(header['format']),
+	                   [(width, height, data) for (width, height), data in zip(header['levels'], arrays)])
+
+
+
+def load_texture(filename, compress=None):
+	# type: (str, Optional[bool]) -> TextureData
+	"""
+	Loads an image file's texture from the texture cache, or on a cache miss
+	decodes the image, builds the texture and adds it to the cache.
+	
+	Raises IOError if the file can't be read.
+	
+	\param compress  Overrides CompressTextures, though textures are still only
+	                 compressed if the context supports it.
+	"""
+	compress = _compression(compress)
+	
+	cache_file = texture_cache_file(filename, compress)
+	
+	try:
+		return load_cached_texture(cache_file)
+	except (IOError, OSError, ValueError, KeyError):
+		pass
+	
+	image = Image.open(filename)
+	try:
+		texture = build_texture(image, compress)
+	finally:
+		image.close()
+	
+	save_texture(texture, cache_file)
+	
+	return texture
+
+
+
+class Texture(object):
+	"""
+	A texture shared through the registry.  Its levels stay mapped from the
+	texture cache for as long as it is referenced, so the GL texture can be
+	evicted and created again when it is next used.
+	"""
+	
+	def __init__(self, key, sampler):
+		self.key = key
+		self.sampler = sampler
+		self.references = 0
+		
+		self.data = None  # type: Optional[TextureData]
+		
+		# the GL texture, while it is resident
+		self.name = None
+		self.size = 0
+		self.lastUsed = -1
+		
+		# held while the levels are loaded, so that only one thread loads them
+		self._loadLock = Lock()
+
+
+
+class TextureRegistry(object):
+	"""
+	Shares textures between materials, so that each image file is loaded once
+	for each set of sampler settings it is used with, however many models use
+	it.  Textures are reference counted: acquiring one adds a reference, which
+	the material holding it releases along with its model, and a texture is
+	deleted when no references remain.
+	
+	GL textures are only created when a texture is used, and when the total
+	estimated size of the resident textures would exceed the budget, the least
+	recently used ones that haven't been used this frame are evicted, to be
+	created again when they are next used.
+	
+	acquire() may be called from any thread, everything else must be called on
+	the context's thread.
+	"""
+	
+	def __init__(self, budget=None):
+		# type: (Optional[int]) -> None
+		"""
+		\param budget  The video memory the textures may take, in bytes, or None
+		               for no limit.
+		"""
+		self.budget = budget
+		
+		self.residentSize = 0
+		self.uploads = 0
+		self.evictions = 0
+		
+		self._textures = {}
+		self._lock = Lock()
+		self._frame = 0
+	
+	
+	def __len__(self):
+		return len(self._textures)
+	
+	
+	def acquire(self, filename, sampler=DefaultSampler):
+		# type: (str, Tuple[int, int, int]) -> Texture
+		"""
+		Returns the texture of an image file, adding a reference to it.  The
+		image is loaded through the texture cache if it isn't already.
+		
+		Raises IOError if the file can't be read.
+		"""
+		return self._acquire((os.path.realpath(filename), sampler), sampler, lambda: load_texture(filename))
+	
+	
+	def white(self, sampler=DefaultSampler):
+		# type: (Tuple[int, int, int]) -> Texture
+		""" Returns a 1x1 white texture for untextured materials, adding a reference to it. """
+		return self._acquire(('', sampler), sampler,
+		                     lambda: TextureData('rgb', [(1, 1, array([255, 255, 255], dtype=uint8))]))
+	
+	
+	def _acquire(self, key, sampler, load):
+		# type: (Any, Tuple[int, int, int], Callable[[], TextureData]) -> Texture
+		with self._lock:
+			texture = self._textures.get(key)
+			if texture is None:
+				texture = self._textures[key] = Texture(key, sampler)
+			texture.references += 1
+		
+		with texture._loadLock:
+			if texture.data is None:
+				try:
+					texture.data = load()
+				except:
+					self.release(texture)
+					raise
+		
+		return texture
+	
+	
+	def release(self, texture):
+		# type: (Texture) -> None
+		""" Removes a reference to the texture, deleting it if it was the last. """
+		with self._lock:
+			texture.references -= 1
+			if texture.references > 0:
+				return
+			
+			del self._textures[texture.key]
+		
+		if texture.name is not None:
+			self._evict(texture)
+		texture.data = None
+	
+	
+	def use(self, texture):
+		# type: (Texture) -> int
+		"""
+		Marks the texture as used this frame, creating its GL texture if it
+		isn't resident.
+		
+		\return The GL texture.
+		"""
+		texture.lastUsed = self._frame
+		
+		if texture.name is None:
+			size = texture.data.size
+			self._makeRoom(size)
+			
+			texture.name = texture.data.upload(texture.sampler)
+			texture.size = size
+			self.residentSize += size
+			self.uploads += 1
+			
+			# creating the texture disturbs the texture bindings
+			invalidate_texture_bindings()
+		
+		return texture.name
+	
+	
+	def nextFrame(self):
+		""" Starts a new frame, textures used in earlier frames may be evicted. """
+		self._frame += 1
+	
+	
+	def _makeRoom(self, size):
+		# type: (int) -> None
+		if self.budget is None:
+			return
+		
+		with self._lock:
+			resident = [texture for texture in self._textures.values()
+			            if texture.name is not None and texture.lastUsed < self._frame]
+		
+		resident.sort(key=lambda texture: texture.lastUsed)
+		
+		for texture in resident:
+			if self.residentSize + size <= self.budget:
+				break
+			self._evict(texture)
+	
+	
+	def _evict(self, texture):
+		# type: (Texture) -> None
+		glDeleteTextures([texture.name])
+		texture.name = None
+		self.residentSize -= texture.size
+		texture.size = 0
+		self.evictions += 1
+		
+		# the deleted texture's name may be reused while still in the bindings cache
+		invalidate_texture_bindings()
+
+
+
+# The registry all materials share.
+texture_registry = TextureRegistry()